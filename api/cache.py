@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+cache.py
+
+In-memory caches, and the indexes kept in them, shared by the server threads.
+
+"""
+
+import time
+import array
+import bisect
+import threading
+
+
+class LRUCache(object):
+    """
+        A thread-safe dictionary holding at most capacity items, evicting the least recently used when it's full. If
+        given a weigh function (e.g. returning an item's size in bytes), it also keeps the total weight of the items
+        within max_weight, and refuses items that are heavier than that on their own.
+    """
+
+    def __init__(self, capacity = 256, max_weight = None, weigh = None):
+        self.capacity = capacity
+        self.max_weight = max_weight
+        self.weigh = weigh
+        self.weight = 0
+
+        # key -> [key, value, previous, next, weight], in a circular linked list running from the least to the most recently used
+        self.items = {}
+        self.root = [None, None, None, None, 0]
+        self.root[2] = self.root
+        self.root[3] = self.root
+
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default = None):
+        self.lock.acquire()
+        try:
+            link = self.items.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._unlink(link)
+            self._link(link)
+            return link[1]
+        finally:
+            self.lock.release()
+
+    def put(self, key, value):
+        """
+            Adds (or replaces) an item, returning False if it was too heavy to keep.
+        """
+        weight = 0
+        if self.weigh is not None:
+            weight = self.weigh(value)
+
+        self.lock.acquire()
+        try:
+            link = self.items.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+                self.weight -= link[4]
+
+            if self.max_weight is not None and weight > self.max_weight:
+                return False
+
+            while len(self.items) > 0 and (len(self.items) >= self.capacity or (self.max_weight is not None and self.weight + weight > self.max_weight)):
+                oldest = self.root[3]
+                self._unlink(oldest)
+                del self.items[oldest[0]]
+                self.weight -= oldest[4]
+                self.evictions += 1
+
+            link = [key, value, None, None, weight]
+            self.items[key] = link
+            self._link(link)
+            self.weight += weight
+            return True
+        finally:
+            self.lock.release()
+
+    def remove(self, key):
+        self.lock.acquire()
+        try:
+            link = self.items.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+                self.weight -= link[4]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.items = {}
+            self.root[2] = self.root
+            self.root[3] = self.root
+            self.weight = 0
+        finally:
+            self.lock.release()
+
+    def values(self):
+        self.lock.acquire()
+        try:
+            return [link[1] for link in self.items.values()]
+        finally:
+            self.lock.release()
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def stats(self):
+        return {
+            "size" : len(self.items),
+            "capacity" : self.capacity,
+            "weight" : self.weight,
+            "max_weight" : self.max_weight,
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "evictions" : self.evictions
+        }
+
+    def _link(self, link):
+        # in at the most recently used end, i.e. just before the root
+        last = self.root[2]
+        link[2] = last
+        link[3] = self.root
+        last[3] = link
+        self.root[2] = link
+
+    def _unlink(self, link):
+        link[2][3] = link[3]
+        link[3][2] = link[2]
+
+
+class IntervalIndex(object):
+    """
+        A nested containment list over closed intervals, answering overlap queries in O(log n + k). The intervals are 
+        sorted by start (longest first), and each is filed under the last interval that contains it. Siblings then have 
+        increasing ends as well as starts, so the first overlap in each list can be found with a bisection. 
+    """
+
+    def __init__(self, starts, ends):
+        order = range(len(starts))
+        order.sort(key = lambda i: (starts[i], -ends[i]))
+
+        # positions in sorted order -> the original indices, starts and ends
+        self.order = array.array("l", order)
+        self.starts = array.array("l", [starts[i] for i in order])
+        self.ends = array.array("l", [ends[i] for i in order])
+
+        children = {}
+        containing = []
+        for position in range(len(order)):
+            while len(containing) > 0 and self.ends[containing[-1]] < self.ends[position]:
+                containing.pop()
+            if len(containing) > 0:
+                parent = containing[-1]
+            else:
+                parent = -1
+            if parent not in children:
+                children[parent] = []
+            children[parent].append(position)
+            containing.append(position)
+
+        # parent position (-1 for the top level) -> (the children's ends, the children's positions)
+        self.sublists = {}
+        for parent, positions in children.items():
+            self.sublists[parent] = (array.array("l", [self.ends[position] for position in positions]), array.array("l", positions))
+
+    def overlapping(self, start, end):
+        """
+            Returns the original indices of the intervals overlapping start to end (inclusive), in no particular order.
+        """
+        results = []
+        if len(self.order) == 0:
+            return results
+
+        pending = [-1]
+        while len(pending) > 0:
+            (ends, positions) = self.sublists[pending.pop()]
+            i = bisect.bisect_left(ends, start)
+            while i < len(positions):
+                position = positions[i]
+                if self.starts[position] > end:
+                    break
+                results.append(self.order[position])
+                if position in self.sublists:
+                    pending.append(position)
+                i += 1
+        return results
+
+    def __len__(self):
+        return len(self.order)
+
+
+class TileCache(object):
+    """
+        The results of range queries, cached per fixed-size tile, so that overlapping windows (e.g. of a browser 
+        scrolling along a region) reuse each other's work. A request is snapped to the tiles it covers, any missing 
+        tiles are computed, and the cached rows are merged, deduplicated (features spanning a tile boundary are in 
+        both tiles) and trimmed back to the requested range. The rows are shared between requests, so mustn't be 
+        modified. The tiles are bounded both by count and by their (estimated) size in bytes. 
+    """
+
+    def __init__(self, tile_size = 25000, capacity = 1024, ttl = 300, enabled = True, max_memory = 134217728):
+        self.configure(tile_size, capacity, ttl, enabled, max_memory)
+
+    def configure(self, tile_size = 25000, capacity = 1024, ttl = 300, enabled = True, max_memory = 134217728):
+        self.tile_size = tile_size
+        self.tiles = LRUCache(capacity, max_memory, lambda cached: cached[1])
+        self.max_memory = max_memory
+        self.ttl = ttl
+        self.enabled = enabled
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version, start, end, compute, coordinates, identity):
+        """
+            Returns the rows overlapping start to end (inclusive), ordered by their coordinates. The key identifies 
+            the query (e.g. its name, region and other arguments), and the version what it was run against, if known. 
+            compute(tile_start, tile_end) returns the rows overlapping a tile, coordinates(row) a row's (start, end), 
+            and identity(row) what makes rows from different tiles the same. 
+        """
+        now = time.time()
+        results = []
+        seen = {}
+        for tile in range(start // self.tile_size, end // self.tile_size + 1):
+            tile_key = (key, version, tile)
+            cached = self.tiles.get(tile_key)
+            if cached is None or now - cached[0] >= self.ttl:
+                self.misses += 1
+                rows = compute(tile * self.tile_size, (tile + 1) * self.tile_size - 1)
+                cached = (now, self._measure(rows), rows)
+                self.tiles.put(tile_key, cached)
+            else:
+                self.hits += 1
+
+            tile_seen = {}
+            for row in cached[2]:
+                row_identity = identity(row)
+                if row_identity in seen:
+                    continue
+                tile_seen[row_identity] = True
+
+                (row_start, row_end) = coordinates(row)
+                if row_start <= end and row_end >= start:
+                    results.append(row)
+            seen.update(tile_seen)
+
+        results.sort(key = coordinates)
+        return results
+
+    def fill(self, key, version, start, end, rows, coordinates):
+        """
+            Caches the tiles that lie wholly within start to end, from rows that are all those overlapping start to 
+            end (e.g. got from a query that the tiles couldn't be used for), so that later requests can use them. 
+        """
+        now = time.time()
+        for tile in range((start + self.tile_size - 1) // self.tile_size, (end + 1) // self.tile_size):
+            tile_start = tile * self.tile_size
+            tile_end = (tile + 1) * self.tile_size - 1
+            tile_rows = []
+            for row in rows:
+                (row_start, row_end) = coordinates(row)
+                if row_start <= tile_end and row_end >= tile_start:
+                    tile_rows.append(row)
+            self.tiles.put((key, version, tile), (now, self._measure(tile_rows), tile_rows))
+
+    def _measure(self, rows):
+        # roughly, the characters in the rows' keys and values, plus something for each object
+        size = 0
+        for row in rows:
+            size += 64
+            for key, value in row.items():
+                size += len(key) + len(str(value)) + 64
+        return size
+
+    def stats(self):
+        stats = self.tiles.stats()
+        stats["tile_size"] = self.tile_size
+        stats["max_memory"] = self.max_memory
+        stats["ttl"] = self.ttl
+        stats["enabled"] = self.enabled
+
+        # counting stale tiles as misses, unlike the LRU cache's own numbers
+        stats["hits"] = self.hits
+        stats["misses"] = self.misses
+        if self.hits + self.misses > 0:
+            stats["hit_ratio"] = float(self.hits) / (self.hits + self.misses)
+        else:
+            stats["hit_ratio"] = 0.0
+
+        stats["memory"] = self.tiles.weight
+        return stats
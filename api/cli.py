@@ -175,19 +175,19 @@ def execute(path, function, args, database_uri, password):
     connectionFactory = query.ConnectionFactory(host, database, user, password, port)
     api.queries = db.Queries(connectionFactory)
     
-    # make the call
-    result = call_method(api, function, args)
-    
-    # tidy up
-    connectionFactory.close()
-    
-    return ropy.Formatter(result).formatJSON()
+    try:
+        # make the call, and format it while the connection is still open, as streamed results are only read then
+        result = call_method(api, function, args)
+        return ropy.Formatter(result, pretty = True).formatJSON()
+    finally:
+        # tidy up
+        connectionFactory.close()
 
 
 def fail_with_json(code):
     error_data = ropy.generate_error_data()
     handler = ropy.ErrorController()
-    formatted = handler.format(error_data, "json", "error")
+    formatted = handler.format(error_data, "json", "error", pretty = True)
     print formatted
     sys.exit(code)
 
@@ -16,13 +16,31 @@ import os
 import cherrypy
 import logging
 import re
+import threading
 
 logger = logging.getLogger("crawl")
 
 import ropy
 import db
+import query
 import sys
 
+def run_concurrently(funcs):
+    """
+        Runs functions that call controllers (e.g. the calls of a ropy.Root.batch) at the same time, each in a fan-out 
+        worker thread with the worker's connection standing in as the thread's own. 
+    """
+    def bind(func):
+        def call(queries):
+            cherrypy.thread_data.connectionFactory = queries.connectionFactory
+            try:
+                return func()
+            finally:
+                del cherrypy.thread_data.connectionFactory
+        return call
+    return db.fan_out.map([bind(func) for func in funcs])
+
+
 class BaseController(ropy.RESTController):
     """
         An abstract class with common methods shared by crawl controllers. Not to be instantiated directly.
@@ -31,16 +49,42 @@ class BaseController(ropy.RESTController):
     def __init__(self, queries = None):
         self.templateFilePath = os.path.dirname(__file__) + "/../tpl/"
         
+        # controllers are shared by all the server threads, so their queries are kept per thread
+        self._local = threading.local()
+        
         # declaring an instance variable, which will be called by most methods, must set if the controller is instantiated out of a server context
         # designed to be a db.Queries instance
         self.queries = queries
-        
+    
+    def _get_queries(self):
+        return getattr(self._local, "queries", None)
+    
+    def _set_queries(self, queries):
+        self._local.queries = queries
+    
+    queries = property(_get_queries, _set_queries)
     
     def init_handler(self):
+        # the registry is loaded once, so this just binds it to the thread's connection factory
         self.queries = db.Queries(cherrypy.thread_data.connectionFactory)
         #self.api = api.API(cherrypy.thread_data.connectionFactory)
         super(BaseController, self).init_handler()
     
+    def recover(self):
+        # a batched call failed, so roll back in case it left the transaction aborted, for the sake of the next one
+        connectionFactory = getattr(cherrypy.thread_data, "connectionFactory", None)
+        if connectionFactory is not None and connectionFactory.leased is not None:
+            connectionFactory.getConnection().rollback()
+    
+    def _fan_out(self, funcs):
+        """
+            Runs independent queries, each a function taking a db.Queries instance, returning their results in order. 
+            They are run concurrently on their own connections when serving, otherwise one after the other.
+        """
+        if db.fan_out is None:
+            return [func(self.queries) for func in funcs]
+        return db.fan_out.map(funcs)
+    
     def _get_relationship_ids(self, relationships):
         relationship_ids = []
         
@@ -140,36 +184,45 @@ class BaseController(ropy.RESTController):
     
     
     
-    def _search_for_relations(self, feature_object, relationship_ids, searching_for = "parents"):
+    def _search_for_relations(self, feature_objects, relationship_ids):
         """
-           A recursive trawl up or down feature relationships. Can go up (parents) or down (children).
+           Fills in the parents and children of feature objects (keyed on uniquename), all the way up and down their 
+           feature relationships. 
         """
-        uniquename = feature_object["uniquename"]
-
-        if searching_for == "parents":
-            relations = self.queries.getRelationshipsParents([uniquename], relationship_ids)
-        elif searching_for == "children":
-            relations = self.queries.getRelationshipsChildren([uniquename], relationship_ids)
-        else:
-            raise ropy.ServerException("Wrong searching_for value: " + searching_for, ropy.ERROR_CODES["BAD_PARAMETER"])
-
+        if len(feature_objects) == 0:
+            return
+        
+        relations = self.queries.getRelationshipsHierarchy(feature_objects.keys(), relationship_ids)
+        
+        # the objects in the tree, keyed on where they are in it, ready for their own relations
+        relation_objects = {}
+        
         for relation in relations:
+            searching_for = relation["direction"]
+            
             relation_object = {
                 "uniquename" : relation["uniquename"],
                 searching_for : [], 
                 "type": relation["type"],
                 "relationship": relation["relationship_type"],
             }
-
+            
             if relation["name"] != "None":
                 relation_object["name"] = relation["name"]
-
-            if searching_for not in feature_object:
-                feature_object[searching_for] = []
-            feature_object[searching_for].append(relation_object)
-
-            self._search_for_relations(relation_object, relationship_ids, searching_for)
-
+            
+            parent_key = (relation["feature"], searching_for, relation["parent_path"])
+            if parent_key in relation_objects:
+                parent_object = relation_objects[parent_key]
+            else:
+                # nothing above it in the tree, so it's a direct relation of the feature
+                parent_object = feature_objects[relation["feature"]]
+            
+            if searching_for not in parent_object:
+                parent_object[searching_for] = []
+            parent_object[searching_for].append(relation_object)
+            
+            relation_objects[(relation["feature"], searching_for, relation["path"])] = relation_object
+    
     
     def getOrganismID(self, organism):
         """
@@ -270,7 +323,8 @@ class Genes(BaseController):
             Returns a list of genes in an organism.
         """
         organism_id = self.getOrganismID(organism)
-        results = self.queries.getCDSs(organism_id)
+        # whole organisms can be large, so the results are streamed from the database as they are formatted
+        results = self.queries.getCDSs(organism_id, stream = True)
         data = {
             "response" : {
                 "name" : "genes/list",
@@ -369,7 +423,8 @@ class Genes(BaseController):
            Returns the exons coordinates for a list of genes.
         """
         genes = ropy.to_array(genes)
-        results = self.queries.getExons(region, genes)
+        # if no genes are specified, that's all the exons on the region, so these are streamed
+        results = self.queries.getExons(region, genes, stream = True)
         data = {
             "response" : {
                 "name" :"genes/exons",
@@ -664,7 +719,7 @@ class Features(BaseController):
            Gets all the orthologues in an organism.
         """
         organism_id = self.getOrganismID(organism)
-        results = self.queries.getOrthologuesInOrganism(organism_id)
+        results = self.queries.getOrthologuesInOrganism(organism_id, stream = True)
         return ({
             "response" : {
                 "name" : "features/orthologuesinorganism",
@@ -733,6 +788,9 @@ class Features(BaseController):
         feature_store = {}
         cvterm_store = {}
         
+        # the pubs and dbxrefs are fetched for all the terms at once, after they've been collected
+        terms_by_feature_cvterm_id = {}
+        
         for result in results:
             if result["feature"] not in feature_store:
                 feature_store[result["feature"]] =  {
@@ -753,11 +811,8 @@ class Features(BaseController):
                         "props" : []
                     }
                     
-                    if pubs is True:
-                        term_to_store["pubs"] = self.queries.getFeatureCVTermPub(result["feature_cvterm_id"])
-                    
-                    if dbxrefs is True:
-                        term_to_store ["dbxrefs"] = self.queries.getFeatureCVTermDbxrefs(result["feature_cvterm_id"])
+                    if pubs is True or dbxrefs is True:
+                        terms_by_feature_cvterm_id[result["feature_cvterm_id"]] = term_to_store
                     
                     # store the term
                     cvterm_store[cvterm_store_key] = term_to_store
@@ -770,6 +825,18 @@ class Features(BaseController):
                         "proptypecv" : result["proptypecv"]
                     })
             
+        feature_cvterm_ids = terms_by_feature_cvterm_id.keys()
+        
+        if pubs is True:
+            term_pubs = self.queries.getFeatureCVTermsPubs(feature_cvterm_ids)
+            for feature_cvterm_id, term in terms_by_feature_cvterm_id.items():
+                term["pubs"] = term_pubs.get(feature_cvterm_id, [])
+        
+        if dbxrefs is True:
+            term_dbxrefs = self.queries.getFeatureCVTermsDbxrefs(feature_cvterm_ids)
+            for feature_cvterm_id, term in terms_by_feature_cvterm_id.items():
+                term["dbxrefs"] = term_dbxrefs.get(feature_cvterm_id, [])
+        
         feature_store = None
         cvterm_store = None
         return to_return
@@ -880,7 +947,7 @@ class Features(BaseController):
     def withtermproperty(self, organism, vocabularies = [], term_property_type = ""):
         vocabularies = ropy.to_array(vocabularies)
         organism_id = self.getOrganismID(organism)
-        results = self.queries.getFeaturesWithTermProperty(organism_id, vocabularies, term_property_type)
+        results = self.queries.getFeaturesWithTermProperty(organism_id, vocabularies, term_property_type, stream = True)
         data = {
             "response" : {
                 "name" :"features/withtermproperty",
@@ -923,16 +990,26 @@ class Features(BaseController):
         """
         
         features = ropy.to_array(features)
+        relationship_ids = self._get_relationship_ids(["derives_from", "part_of"])
         
-        featureproperties = self._sql_results_to_collection("feature", "props",self.queries.getFeatureProps(features))
-        terms = self._parse_feature_cvterms(self.queries.getFeatureCVTerm(features, []))
-        featurecoordinates = self._sql_results_to_collection("feature", "regions", self.queries.getFeatureCoordinates(features))
+        # none of these depend on each other, so they can all be run at once
+        (prop_results, term_results, coordinate_results, pub_results, dbxref_results, relationship_results) = self._fan_out([
+            lambda queries: queries.getFeatureProps(features),
+            lambda queries: queries.getFeatureCVTerm(features, []),
+            lambda queries: queries.getFeatureCoordinates(features),
+            lambda queries: queries.getFeaturePub(features),
+            lambda queries: queries.getFeatureDbxrefs(features),
+            lambda queries: queries.getRelationships(features, relationship_ids)
+        ])
         
-        pubs = self._sql_results_to_collection("feature", "pubs", self.queries.getFeaturePub(features))
-        dbxrefs = self._sql_results_to_collection("feature", "dbxrefs", self.queries.getFeatureDbxrefs(features))
+        featureproperties = self._sql_results_to_collection("feature", "props", prop_results)
+        terms = self._parse_feature_cvterms(term_results)
+        featurecoordinates = self._sql_results_to_collection("feature", "regions", coordinate_results)
         
-        relationship_ids = self._get_relationship_ids(["derives_from", "part_of"])
-        relationship_results = self._sql_results_to_collection("feature", "relations", self.queries.getRelationships(features, relationship_ids))
+        pubs = self._sql_results_to_collection("feature", "pubs", pub_results)
+        dbxrefs = self._sql_results_to_collection("feature", "dbxrefs", dbxref_results)
+        
+        relationship_results = self._sql_results_to_collection("feature", "relations", relationship_results)
         
         return {
             "response" : {
@@ -1009,19 +1086,24 @@ class Features(BaseController):
             names[names_result["uniquename"]] = names_result["name"]
         
         results = []
+        feature_objects = {}
         for feature in features:
-            feature_object = {
-                "uniquename" : feature, 
-                "parents" : [], 
-                "children" : []
-            }
-            
-            if feature in names and names[feature] != "None":
-                feature_object["name"] = names[feature]
+            if feature not in feature_objects:
+                feature_object = {
+                    "uniquename" : feature, 
+                    "parents" : [], 
+                    "children" : []
+                }
+                
+                if feature in names and names[feature] != "None":
+                    feature_object["name"] = names[feature]
+                
+                feature_objects[feature] = feature_object
             
-            self._search_for_relations(feature_object, relationship_ids, "parents")
-            self._search_for_relations(feature_object, relationship_ids, "children")
-            results.append(feature_object)
+            results.append(feature_objects[feature])
+        
+        # the whole tree, in both directions, for all the features in one go
+        self._search_for_relations(feature_objects, relationship_ids)
         return {
             "response" : {
                 "name" : "features/hierarchy", 
@@ -1530,12 +1612,27 @@ class Regions(BaseController):
         """
             Returns the sequence of a source feature.
         """
-        rows = self.queries.getRegionSequence(uniqueName)
+        try:
+            first = int(start)
+            last = int(end)
+        except ValueError:
+            raise ropy.ServerException("The start and end must be integers.", ropy.ERROR_CODES["BAD_PARAMETER"])
+        if first < 1 or last < first:
+            raise ropy.ServerException("The start must be at least 1, and the end no less than the start.", ropy.ERROR_CODES["BAD_PARAMETER"])
+        
+        rows = self.queries.getRegionSequenceInfo(uniqueName)
+        if len(rows) == 0:
+            raise ropy.ServerException("Could not find a source feature with the uniqueName " + uniqueName, ropy.ERROR_CODES["DATA_NOT_FOUND"])
         row = rows[0]
         
         length = row["length"]
-        dna = row["dna"]
-        dna = dna[int(start)-1:int(end)-1]
+        try:
+            seqlen = int(length)
+        except ValueError:
+            raise ropy.ServerException("The source feature " + uniqueName + " has no sequence length.", ropy.ERROR_CODES["DATA_NOT_FOUND"])
+        
+        # as before, the residues from start up to (but not including) end, trimmed to the sequence
+        dna = db.sequences.getSequence(self.queries, uniqueName, row["timelastmodified"], first - 1, min(last - 1, seqlen))
         
         data = {
             "response" : {
@@ -1570,28 +1667,20 @@ class Regions(BaseController):
         a = datetime.datetime.now()
         
         
+        try:
+            start = int(start)
+            end = int(end)
+        except ValueError:
+            raise ropy.ServerException("The start and end must be integers.", ropy.ERROR_CODES["BAD_PARAMETER"])
+        
         regionID = self.queries.getFeatureID(region)
         exclude = ropy.to_array(exclude)
         
         # trying to speed up the boundary query by determining the types in advance
         gene_types = self.queries.getCvtermID("sequence", ["gene", "pseudogene"])
         
-        actual_boundaries = self.queries.getFeatureLocationsMaxAndMinBoundaries(regionID, start, end, gene_types)[0]
-        
-        logger.debug(actual_boundaries)
-        
-        actual_start = start
-        if actual_boundaries["start"] != "None" and actual_boundaries["start"] < start:
-            actual_start = actual_boundaries["start"]
-        
-        actual_end = end
-        if actual_boundaries["end"] != "None" and actual_boundaries["end"] > end:
-            actual_end = actual_boundaries["end"]
-        
-        # actual_start = actual_boundaries["start"] if actual_boundaries["start"] != "None" else start
-        # actual_end = actual_boundaries["end"] if actual_boundaries["end"] != "None" else end
-        
-        locations = self.queries.getFeatureLocations(regionID, actual_start, actual_end, exclude)
+        # widened to take in the whole of any genes overlapping the ends
+        (actual_start, actual_end, locations) = self.queries.getFeatureLocationsExpanded(regionID, start, end, gene_types, exclude)
         
         b = datetime.datetime.now()
         
@@ -2571,13 +2660,141 @@ class SamRecord(object):
     def readName(self):
         return self.aligned_read.qname
 
+class Admin(BaseController):
+    """
+        Server administration and monitoring queries.
+    """
+    
+    @cherrypy.expose
+    @ropy.service_format(coalesce = False)
+    def slowqueries(self):
+        """
+            Returns the most recent slow queries, and the slow query log settings.
+        """
+        return {
+            "response" : {
+                "name" : "admin/slowqueries",
+                "settings" : query.slow_queries.stats(),
+                "queries" : query.slow_queries.entries()
+            }
+        }
+    slowqueries.arguments = {}
+    
+    @cherrypy.expose
+    @ropy.service_format(coalesce = False)
+    def templates(self):
+        """
+            Returns the template cache statistics.
+        """
+        return {
+            "response" : {
+                "name" : "admin/templates",
+                "templates" : ropy.templates.stats()
+            }
+        }
+    templates.arguments = {}
+    
+    @cherrypy.expose
+    @ropy.service_format(coalesce = False)
+    def coalescing(self):
+        """
+            Returns how many web method calls have been run, and how many were coalesced with identical concurrent ones.
+        """
+        return {
+            "response" : {
+                "name" : "admin/coalescing",
+                "coalescing" : ropy.single_flight.stats()
+            }
+        }
+    coalescing.arguments = {}
+    
+    @cherrypy.expose
+    @ropy.service_format(coalesce = False)
+    def vocabulary(self, refresh = False):
+        """
+            Returns the vocabulary cache statistics, reloading it first if refresh is true.
+        """
+        if ropy.to_bool(refresh):
+            db.vocabulary.load(self.queries)
+        return {
+            "response" : {
+                "name" : "admin/vocabulary",
+                "vocabulary" : db.vocabulary.stats()
+            }
+        }
+    vocabulary.arguments = {
+        "refresh" : "reload the cv and cvterm tables (optional, defaults to false)"
+    }
+    
+    @cherrypy.expose
+    @ropy.service_format(coalesce = False)
+    def organisms(self, refresh = False):
+        """
+            Returns the organism directory statistics, reloading it (and the organism metadata) first if refresh is true.
+        """
+        if ropy.to_bool(refresh):
+            db.organisms.load(self.queries)
+            db.organism_metadata.load(self.queries)
+        return {
+            "response" : {
+                "name" : "admin/organisms",
+                "organisms" : db.organisms.stats()
+            }
+        }
+    organisms.arguments = {
+        "refresh" : "reload the organism directory and metadata (optional, defaults to false)"
+    }
+    
+    @cherrypy.expose
+    @ropy.service_format(coalesce = False)
+    def sequences(self):
+        """
+            Returns the sequence block cache statistics.
+        """
+        return {
+            "response" : {
+                "name" : "admin/sequences",
+                "sequences" : db.sequences.stats()
+            }
+        }
+    sequences.arguments = {}
+    
+    @cherrypy.expose
+    @ropy.service_format(coalesce = False)
+    def locations(self):
+        """
+            Returns the region location index statistics.
+        """
+        return {
+            "response" : {
+                "name" : "admin/locations",
+                "locations" : db.region_locations.stats()
+            }
+        }
+    locations.arguments = {}
+    
+    @cherrypy.expose
+    @ropy.service_format(coalesce = False)
+    def tiles(self):
+        """
+            Returns the region tile cache statistics, including its hit ratio and (roughly) how much memory it uses.
+        """
+        return {
+            "response" : {
+                "name" : "admin/tiles",
+                "tiles" : db.region_tiles.stats()
+            }
+        }
+    tiles.arguments = {}
+
+
 class Testing(BaseController):
     """
         Test related queries.
     """
     
     @cherrypy.expose
-    @ropy.service_format()
+    @ropy.service_format(coalesce = False)
     def forceclose(self):
         """
             Forces the connection to be closed for testing.
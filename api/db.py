@@ -13,24 +13,659 @@ or dictionaries.
 
 import os
 import time
+import array
+import Queue
 import logging
+import threading
 
-from query import QueryProcessor, QueryProcessorException
+from query import QueryProcessor, QueryProcessorException, QueryRegistry, FanOutExecutor, PooledConnectionFactory
 from ropy import ServerException, ERROR_CODES
+from cache import LRUCache, IntervalIndex, TileCache
 
 logger = logging.getLogger("crawl")
 
+# the queries in the sql folder, shared by all Queries instances, see load_queries()
+registry = None
+
+def load_queries(reload = False):
+    """
+        Loads (or reloads) the queries from the sql folder. Should be called once at startup, otherwise it's called 
+        by the first Queries instance. If reload is True, modified sql files are picked up without a restart. 
+    """
+    global registry
+    registry = QueryRegistry(os.path.dirname(__file__) + "/../sql/", reload)
+    return registry
+
+class Vocabulary(object):
+    """
+        An in-memory copy of the cv and cvterm tables, so that cvterm_ids can be looked up without a database round 
+        trip. Reloaded wholesale, and swapped in one assignment, so lookups by other threads never see a partial copy. 
+    """
+    
+    def __init__(self):
+        # (cv name -> cvterm name -> cvterm_id, cvterm_id -> (cv name, cvterm name))
+        self._maps = ({}, {})
+        self.loaded = None
+    
+    def load(self, queries):
+        """
+            Loads all the cvterms, using a Queries instance.
+        """
+        terms = {}
+        names = {}
+        for cv, cvterm, cvterm_id in queries.runQuery("get_all_cvterms"):
+            if cv not in terms:
+                terms[cv] = {}
+            terms[cv][cvterm] = cvterm_id
+            names[cvterm_id] = (cv, cvterm)
+        
+        self._maps = (terms, names)
+        self.loaded = time.time()
+        logger.info("Loaded %s cvterms from %s cvs" % (len(names), len(terms)))
+    
+    def getIDs(self, cvname, cvtermnames):
+        """
+            Returns the cvterm_ids in the same order as the names, or None if any of them aren't known. 
+        """
+        terms = self._maps[0].get(cvname)
+        if terms is None:
+            return None
+        ids = []
+        for cvtermname in cvtermnames:
+            if cvtermname not in terms:
+                return None
+            ids.append(terms[cvtermname])
+        return ids
+    
+    def getName(self, cvterm_id):
+        """
+            Returns the (cv name, cvterm name) of a cvterm_id, or None if it isn't known.
+        """
+        return self._maps[1].get(cvterm_id)
+    
+    def stats(self):
+        terms, names = self._maps
+        loaded = None
+        if self.loaded is not None:
+            loaded = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.loaded))
+        return {
+            "cvs" : len(terms),
+            "cvterms" : len(names),
+            "loaded" : loaded
+        }
+
+
+# the cvterms, shared by all Queries instances, see load_vocabulary()
+vocabulary = Vocabulary()
+
+def load_vocabulary(connectionFactory):
+    """
+        (Re)loads the vocabulary. Until it is loaded, cvterm lookups go to the database. 
+    """
+    vocabulary.load(Queries(connectionFactory))
+    return vocabulary
+
+class OrganismDirectory(object):
+    """
+        An in-memory index of organism_ids by taxonID, common name and organism_id, for resolving the organism 
+        parameters of web methods without a database round trip. Like the Vocabulary, it is swapped in whole on load. 
+    """
+    
+    def __init__(self):
+        # (taxonID -> organism_id, common_name -> organism_id, organism_ids)
+        self._maps = ({}, {}, {})
+        self.loaded = None
+    
+    def load(self, queries):
+        by_taxon = {}
+        by_common_name = {}
+        organism_ids = {}
+        for organism_id, common_name, taxonID in queries.runQuery("get_organism_directory"):
+            organism_ids[organism_id] = True
+            # if there is more than one, the database would return any of them, so the first will do
+            if common_name is not None and common_name not in by_common_name:
+                by_common_name[common_name] = organism_id
+            if taxonID is not None and taxonID not in by_taxon:
+                by_taxon[taxonID] = organism_id
+        
+        self._maps = (by_taxon, by_common_name, organism_ids)
+        self.loaded = time.time()
+        logger.info("Loaded %s organisms" % len(organism_ids))
+    
+    def fromTaxon(self, taxonID):
+        return self._maps[0].get(taxonID)
+    
+    def fromCommonName(self, common_name):
+        return self._maps[1].get(common_name)
+    
+    def fromOrganismID(self, organism_id):
+        try:
+            organism_id = int(organism_id)
+        except ValueError:
+            return None
+        if organism_id in self._maps[2]:
+            return organism_id
+        return None
+    
+    def stats(self):
+        by_taxon, by_common_name, organism_ids = self._maps
+        loaded = None
+        if self.loaded is not None:
+            loaded = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.loaded))
+        return {
+            "organisms" : len(organism_ids),
+            "taxons" : len(by_taxon),
+            "common_names" : len(by_common_name),
+            "loaded" : loaded
+        }
+
+
+# the organisms, shared by all Queries instances, see load_organisms()
+organisms = OrganismDirectory()
+
+def load_organisms(connectionFactory):
+    """
+        (Re)loads the organism directory. Until it is loaded, or for organisms added since, lookups go to the database. 
+    """
+    organisms.load(Queries(connectionFactory))
+    return organisms
+
+class OrganismMetadata(object):
+    """
+        The organisms with their taxonIDs, and all of their properties, loaded in one query each and kept for ttl 
+        seconds. When they expire, one thread reloads them while any others carry on with the old copy. Copies of the 
+        rows are handed out, because the controllers modify them. 
+    """
+    
+    def __init__(self, ttl = 300):
+        self.ttl = ttl
+        
+        # (loaded, organisms, organism_id -> properties)
+        self._data = None
+        self.lock = threading.Lock()
+    
+    def load(self, queries):
+        organisms = queries.runQueryAndMakeDictionary("get_all_organisms_and_taxon_ids")
+        
+        props = {}
+        for prop in queries.runQueryAndMakeDictionary("get_all_organism_props"):
+            organism_id = prop.pop("organism_id")
+            if organism_id not in props:
+                props[organism_id] = []
+            props[organism_id].append(prop)
+        
+        self._data = (time.time(), organisms, props)
+        return self._data
+    
+    def getOrganisms(self, queries):
+        organisms = self._get(queries)[1]
+        return [dict(organism) for organism in organisms]
+    
+    def getProps(self, queries, organism_id, cv = None, cvterm = None):
+        props = self._get(queries)[2].get(str(organism_id), [])
+        results = []
+        for prop in props:
+            if cv is not None and len(cv) > 0 and prop["vocubulary"] != cv:
+                continue
+            if cvterm is not None and len(cvterm) > 0 and prop["term"] != cvterm:
+                continue
+            results.append(dict(prop))
+        return results
+    
+    def _get(self, queries):
+        data = self._data
+        if data is not None and time.time() - data[0] < self.ttl:
+            return data
+        
+        # only wait for the reload if there's nothing to be going on with
+        if not self.lock.acquire(data is None):
+            return data
+        try:
+            # another thread may have just reloaded it
+            data = self._data
+            if data is None or time.time() - data[0] >= self.ttl:
+                data = self.load(queries)
+            return data
+        finally:
+            self.lock.release()
+
+
+# the organisms' metadata, shared by all Queries instances
+organism_metadata = OrganismMetadata()
+
+class SequenceCache(object):
+    """
+        Source feature residues, held as fixed-size blocks in an LRU cache, so that neighbouring requests (e.g. a 
+        browser scrolling along a chromosome) are served from memory. The missing blocks are fetched with one server-side 
+        substr, rather than shipping whole chromosomes over the wire. Blocks are keyed on the feature's full 
+        timelastmodified (as text, not the date that makeDictionary would make of it), so edited sequences are never 
+        served stale. Regions in the packed store, if there is one, are read from that instead. 
+    """
+    
+    def __init__(self, block_size = 65536, capacity = 512):
+        self.configure(block_size, capacity)
+    
+    def configure(self, block_size = 65536, capacity = 512, store = None):
+        self.block_size = block_size
+        self.blocks = LRUCache(capacity)
+        
+        # a sequences.SequenceStore
+        self.store = store
+    
+    def getPacked(self, queries, uniqueName, version = None):
+        """
+            Returns the region's sequences.PackedSequence, if it's in the store and up to date, otherwise None. It must 
+            be released when done with. 
+        """
+        if self.store is None or uniqueName not in self.store:
+            return None
+        
+        if version is None:
+            rows = queries.getRegionSequenceInfo(uniqueName)
+            if len(rows) == 0:
+                return None
+            version = rows[0]["timelastmodified"]
+        
+        return self.store.get(uniqueName, version)
+    
+    def getSequence(self, queries, uniqueName, version, start, end):
+        """
+            Returns the residues from start to end, counting from 0 and excluding the end, like a slice.
+        """
+        if end <= start:
+            return ""
+        
+        packed = self.getPacked(queries, uniqueName, version)
+        if packed is not None:
+            try:
+                return packed.read(start, end)
+            finally:
+                packed.release()
+        
+        block_size = self.block_size
+        first = start // block_size
+        last = (end - 1) // block_size
+        
+        blocks = {}
+        missing = []
+        for index in range(first, last + 1):
+            block = self.blocks.get((uniqueName, version, index))
+            if block is None:
+                missing.append(index)
+            else:
+                blocks[index] = block
+        
+        # fetch each contiguous run of missing blocks in one go
+        while len(missing) > 0:
+            run_start = missing[0]
+            run_end = run_start
+            while run_end - run_start + 1 < len(missing) and missing[run_end - run_start + 1] == run_end + 1:
+                run_end += 1
+            missing = missing[run_end - run_start + 1:]
+            
+            dna = queries.getRegionSubsequence(uniqueName, run_start * block_size + 1, (run_end - run_start + 1) * block_size)
+            for index in range(run_start, run_end + 1):
+                offset = (index - run_start) * block_size
+                block = dna[offset:offset + block_size]
+                self.blocks.put((uniqueName, version, index), block)
+                blocks[index] = block
+        
+        dna = "".join([blocks[index] for index in range(first, last + 1)])
+        offset = first * block_size
+        return dna[start - offset:end - offset]
+    
+    def stats(self):
+        stats = self.blocks.stats()
+        stats["block_size"] = self.block_size
+        if self.store is not None:
+            stats["store"] = self.store.stats()
+        return stats
+
+
+# the source feature sequence blocks, shared by all Queries instances
+sequences = SequenceCache()
+
+class RegionIndex(object):
+    """
+        The feature locations on one region, with an interval index over them. Rather than a dictionary per location, 
+        they're kept as columns : arrays of the coordinates and feature ids, arrays of codes into the few distinct 
+        values of the types, strands, phases and flags, and lists of the (interned) uniquenames. The rows are put back 
+        together, as strings like the sql's, for the locations asked for. Holds no locations if the region has too many 
+        to be worth keeping in memory. 
+    """
+    
+    # the columns of get_region_locations kept as codes, and as names
+    CODED = ("type", "strand", "phase", "is_obsolete", "is_fmin_partial", "is_fmax_partial", "type_id")
+    NAMED = ("feature", "part_of")
+    
+    def __init__(self, signature, rows = None):
+        self.signature = signature
+        self.checked = time.time()
+        self.index = None
+        self.size = 0
+        if rows is not None:
+            self._load(rows)
+    
+    def _load(self, rows):
+        self.starts = array.array("l")
+        self.ends = array.array("l")
+        self.feature_ids = array.array("l")
+        
+        # column -> the codes of its values by location, the distinct values by code, and the code of each value
+        self.codes = {}
+        self.values = {}
+        self.coding = {}
+        for column in self.CODED:
+            self.codes[column] = array.array("H")
+            self.values[column] = []
+            self.coding[column] = {}
+        
+        # column -> the names by location
+        self.names = {}
+        for column in self.NAMED:
+            self.names[column] = []
+        
+        for row in rows:
+            self.starts.append(int(row["start"]))
+            self.ends.append(int(row["end"]))
+            self.feature_ids.append(int(row["feature_id"]))
+            
+            for column in self.CODED:
+                value = row[column]
+                code = self.coding[column].get(value)
+                if code is None:
+                    code = len(self.values[column])
+                    self.coding[column][value] = code
+                    self.values[column].append(value)
+                self.codes[column].append(code)
+            
+            for column in self.NAMED:
+                value = row[column]
+                if type(value) is str:
+                    value = intern(value)
+                self.names[column].append(value)
+        
+        self.index = IntervalIndex(self.starts, self.ends)
+        self.size = self._measure()
+    
+    def _measure(self):
+        # roughly, in bytes : the arrays (the index's included), a pointer per name, and each distinct name once
+        arrays = [self.starts, self.ends, self.feature_ids, self.index.order, self.index.starts, self.index.ends]
+        arrays.extend(self.codes.values())
+        for (ends, positions) in self.index.sublists.values():
+            arrays.append(ends)
+            arrays.append(positions)
+        size = 0
+        for values in arrays:
+            size += values.itemsize * len(values) + 64
+        
+        names = {}
+        for column in self.NAMED:
+            size += 8 * len(self.names[column])
+            for name in self.names[column]:
+                names[name] = True
+        for name in names:
+            size += len(str(name)) + 40
+        return size
+    
+    def overlapping(self, start, end):
+        """
+            The positions of the locations overlapping start to end, ordered like the sql, by fmin and fmax. 
+        """
+        positions = self.index.overlapping(start, end)
+        positions.sort(key = lambda i: (self.starts[i], self.ends[i], i))
+        return positions
+    
+    def getLocations(self, start, end, exclude = []):
+        excluded = {}
+        for type in exclude:
+            if type in self.coding["type"]:
+                excluded[self.coding["type"][type]] = True
+        
+        results = []
+        for i in self.overlapping(start, end):
+            if self.codes["type"][i] in excluded:
+                continue
+            location = {
+                "start" : str(self.starts[i]),
+                "end" : str(self.ends[i])
+            }
+            for column in self.CODED:
+                if column != "type_id":
+                    location[column] = self.values[column][self.codes[column][i]]
+            for column in self.NAMED:
+                location[column] = self.names[column][i]
+            results.append(location)
+        return results
+    
+    def getBoundaries(self, start, end, types):
+        """
+            The lowest start and highest end of the features of the types overlapping start to end, or (None, None). 
+        """
+        included = {}
+        for type in types:
+            if str(type) in self.coding["type_id"]:
+                included[self.coding["type_id"][str(type)]] = True
+        
+        starts = []
+        ends = []
+        for i in self.overlapping(start, end):
+            if self.codes["type_id"][i] in included:
+                starts.append(self.starts[i])
+                ends.append(self.ends[i])
+        if len(starts) == 0:
+            return (None, None)
+        return (min(starts), max(ends))
+    
+    def getFeatureIDs(self, start, end):
+        feature_ids = []
+        seen = {}
+        for i in self.overlapping(start, end):
+            if self.feature_ids[i] not in seen:
+                seen[self.feature_ids[i]] = True
+                feature_ids.append(self.feature_ids[i])
+        return feature_ids
+
+
+class RegionLocations(object):
+    """
+        Interval indexes of the regions' feature locations, kept in an LRU cache holding at most max_memory bytes of 
+        them, so that the overlap queries of a browser panning and zooming along a region are answered from memory. 
+        
+        The indexes are built by a background thread, on a connection from the pool, one at a time. A region that 
+        isn't indexed yet is queued on first use, and its queries go to the database (or the tiles) until the index 
+        is ready. Every ttl seconds, an index is queued to be checked against a signature of the region's locations 
+        (their count, last modification and coordinates), and rebuilt if it has changed; it's still used until then. 
+        Without a pool (e.g. from the command line), nothing is indexed. 
+        
+        The signatures are kept up to date the same way for the regions that aren't indexed (because they're too big, 
+        or indexing is off), as the versions of the regions' tiles. 
+    """
+    
+    def __init__(self, max_memory = 268435456, ttl = 60, max_features = 500000, enabled = True):
+        self.pool = None
+        self.thread = None
+        self.requests = Queue.Queue()
+        self.lock = threading.Lock()
+        
+        # the keys of the regions queued or being built
+        self.pending = {}
+        
+        self.configure(max_memory, ttl, max_features, enabled)
+    
+    def configure(self, max_memory = 268435456, ttl = 60, max_features = 500000, enabled = True):
+        # the count is only there to bound the regions that are too big to index, which weigh nothing
+        self.indexes = LRUCache(4096, max_memory, lambda region_index: region_index.size)
+        self.max_memory = max_memory
+        self.ttl = ttl
+        self.max_features = max_features
+        self.enabled = enabled
+    
+    def start(self, pool):
+        """
+            Lets the indexes be built, on connections from the pool.
+        """
+        self.pool = pool
+    
+    def close(self):
+        """
+            Stops the background thread, once it's finished the index it's building.
+        """
+        self.lock.acquire()
+        try:
+            if self.thread is not None:
+                self.requests.put(None)
+                self.thread = None
+        finally:
+            self.lock.release()
+    
+    def get(self, region_id):
+        """
+            Returns the region's RegionIndex, or None if it's not indexed (yet). Never waits for the database. 
+        """
+        if not self.enabled:
+            return None
+        return self._usable(self._lookup(region_id))
+    
+    def version(self, region_id):
+        """
+            Returns the signature of the region's locations, as of at most ttl seconds (plus the time it takes to check 
+            it) ago, or None if it isn't known (yet). Never waits for the database. 
+        """
+        region_index = self._lookup(region_id)
+        if region_index is None:
+            return None
+        return region_index.signature
+    
+    def _lookup(self, region_id):
+        if self.pool is None:
+            return None
+        region_index = self.indexes.get(str(region_id))
+        if region_index is None or time.time() - region_index.checked >= self.ttl:
+            self._queue(region_id)
+        return region_index
+    
+    def refresh(self, queries, region_id):
+        """
+            Checks the region's index against its signature, and (re)builds it if it's missing or out of date.
+        """
+        key = str(region_id)
+        region_index = self.indexes.get(key)
+        
+        signature = tuple(queries.runQuery("get_region_locations_signature", { "regionid" : region_id })[0])
+        if region_index is not None and region_index.signature == signature:
+            region_index.checked = time.time()
+            return
+        
+        if not self.enabled or signature[0] > self.max_features:
+            region_index = RegionIndex(signature)
+        else:
+            region_index = RegionIndex(signature, queries.iterQuery("get_region_locations", { "regionid" : region_id }))
+        
+        # too big to keep within max_memory, so remember not to index it
+        if not self.indexes.put(key, region_index):
+            self.indexes.put(key, RegionIndex(signature))
+    
+    def _queue(self, region_id):
+        key = str(region_id)
+        self.lock.acquire()
+        try:
+            if key in self.pending:
+                return
+            self.pending[key] = True
+            
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._work, name="RegionLocations")
+                self.thread.setDaemon(True)
+                self.thread.start()
+            
+            self.requests.put(region_id)
+        finally:
+            self.lock.release()
+    
+    def _work(self):
+        while True:
+            region_id = self.requests.get()
+            if region_id is None:
+                break
+            
+            connectionFactory = PooledConnectionFactory(self.pool)
+            try:
+                try:
+                    self.refresh(Queries(connectionFactory), region_id)
+                except Exception, e:
+                    logger.error("could not index the feature locations of region %s" % region_id)
+                    logger.error(e)
+                    
+                    # don't try again until the index would next have been checked
+                    self.indexes.put(str(region_id), RegionIndex(None))
+            finally:
+                connectionFactory.release()
+                
+                self.lock.acquire()
+                try:
+                    del self.pending[str(region_id)]
+                finally:
+                    self.lock.release()
+    
+    def _usable(self, region_index):
+        if region_index is None or region_index.index is None:
+            return None
+        return region_index
+    
+    def stats(self):
+        stats = self.indexes.stats()
+        stats["max_memory"] = self.max_memory
+        stats["ttl"] = self.ttl
+        stats["max_features"] = self.max_features
+        stats["enabled"] = self.enabled
+        stats["pending"] = len(self.pending)
+        return stats
+
+
+# the regions' feature location indexes, shared by all Queries instances
+region_locations = RegionLocations()
+
+# the tiles of the regions' feature locations, shared by all Queries instances
+region_tiles = TileCache()
+
+def _location_coordinates(row):
+    return (int(row["start"]), int(row["end"]))
+
+def _location_identity(row):
+    return (row["feature"], row["start"], row["end"], row["part_of"])
+
+def _feature_loc_coordinates(row):
+    return (int(row["l1_fmin"]), int(row["l1_fmax"]))
+
+def _feature_loc_identity(row):
+    return (row["l1_feature_id"], row["l2_feature_id"], row["l2_reltype"], row["l3_feature_id"], row["l3_reltype"])
+
+# runs independent queries concurrently, see setup_fan_out()
+fan_out = None
+
+def setup_fan_out(pool, workers = 4, timeout = 30, reserved = None):
+    """
+        Lets controllers run independent Queries calls at the same time, on connections from the pool (reserved of 
+        which are kept for them). Without it (e.g. from the command line), they are run one after the other. 
+    """
+    global fan_out
+    fan_out = FanOutExecutor(pool, Queries, workers, timeout, reserved)
+    return fan_out
+
 class Queries(QueryProcessor):
+    """
+        Cheap to make, these bind the shared query registry to a connection factory. 
+    """
     
     def __init__(self, connectionFactory):
-        super(Queries, self).__init__(connection=connectionFactory)
+        if registry is None:
+            load_queries()
         
-        # reset the path to this the sql subfolder at the location class
-        self.setSQLFilePath(os.path.dirname(__file__) + "/../sql/")
+        super(Queries, self).__init__(connection=connectionFactory, registry=registry)
         
-        # load the SQL files fom the sql folder
-        for file in os.listdir(self.sqlPath):
-            if file.endswith(".sql"): self.addQueryFromFile(file.replace(".sql", ""), file )
+        # a no-op unless the registry was loaded with reload on
+        registry.refresh()
     
     def getAllChangedFeaturesForOrganism(self, date, organism_id):
         self.validateDate(date)
@@ -38,6 +673,10 @@ class Queries(QueryProcessor):
         return rows
     
     def getOrganismFromTaxon(self, taxonID):
+        organism_id = organisms.fromTaxon(taxonID)
+        if organism_id is not None:
+            return organism_id
+        
         rows = self.runQuery("get_organism_id_from_taxon_id", (taxonID, ))
         try:
             # return the first value of the first row... 
@@ -106,13 +745,27 @@ class Queries(QueryProcessor):
         return rows
     
     def getAllOrganismsAndTaxonIDs(self):
-        return self.runQueryAndMakeDictionary("get_all_organisms_and_taxon_ids")
+        return organism_metadata.getOrganisms(self)
     
     
     def getRegionSequence(self, uniqueName):
         return self.runQueryAndMakeDictionary("region_sequence", (uniqueName, ))
     
+    def getRegionSequenceInfo(self, uniqueName):
+        return self.runQueryAndMakeDictionary("region_sequence_info", (uniqueName, ))
+    
+    def getRegionSubsequence(self, uniqueName, start, length):
+        rows = self.runQuery("region_subsequence", { "uniquename" : uniqueName, "start" : start, "length" : length })
+        if len(rows) == 0 or rows[0][0] is None:
+            return ""
+        return rows[0][0]
+    
     def getCvtermID(self, cvname, cvtermnames ):
+        # terms added since the vocabulary was loaded still need looking up
+        results = vocabulary.getIDs(cvname, cvtermnames)
+        if results is not None:
+            return results
+        
         args = {"cvtermnames" : tuple(cvtermnames), "cvname" : cvname }
         rows = self.runQuery("get_cvterm_id", args)
         results=[]
@@ -121,6 +774,14 @@ class Queries(QueryProcessor):
         return results
     
     def getFeatureLocs(self, region_id, start, end, relationships):
+        version = self._getRegionVersion(region_id, start, end)
+        if version is not None:
+            return region_tiles.get(("feature_locs", str(region_id), tuple(relationships)), version, int(start), int(end), 
+                lambda tile_start, tile_end: self._getFeatureLocs(region_id, tile_start, tile_end, relationships), 
+                _feature_loc_coordinates, _feature_loc_identity)
+        return self._getFeatureLocs(region_id, start, end, relationships)
+    
+    def _getFeatureLocs(self, region_id, start, end, relationships):
         args = {
             "regionid": region_id,
             "start":start,
@@ -128,6 +789,16 @@ class Queries(QueryProcessor):
             "relationships":tuple(relationships), # must convert arrays to tuples
         }
         
+        region_index = self._getRegionIndex(region_id, start, end)
+        if region_index is not None:
+            feature_ids = region_index.getFeatureIDs(int(start), int(end))
+            if len(feature_ids) == 0:
+                return []
+            del args["start"]
+            del args["end"]
+            args["features"] = tuple(feature_ids)
+            return self.runQueryAndMakeDictionary("feature_locs_by_id", args)
+        
         rows = self.runQueryAndMakeDictionary("feature_locs", args)
         
         # import json
@@ -139,6 +810,18 @@ class Queries(QueryProcessor):
     
     
     def getFeatureLocations(self, region_id, start, end, exclude = []):
+        version = self._getRegionVersion(region_id, start, end)
+        if version is not None:
+            return region_tiles.get(("locations", str(region_id), tuple(sorted(exclude))), version, int(start), int(end), 
+                lambda tile_start, tile_end: self._getFeatureLocations(region_id, tile_start, tile_end, exclude), 
+                _location_coordinates, _location_identity)
+        return self._getFeatureLocations(region_id, start, end, exclude)
+    
+    def _getFeatureLocations(self, region_id, start, end, exclude = []):
+        region_index = self._getRegionIndex(region_id, start, end)
+        if region_index is not None:
+            return region_index.getLocations(int(start), int(end), exclude)
+        
         args = {
             "regionid": region_id,
             "start": start,
@@ -150,18 +833,82 @@ class Queries(QueryProcessor):
         return self.runQueryAndMakeDictionary("get_locations", args)
     
     
-    def getFeatureLocationsMaxAndMinBoundaries(self, region_id, start, end, types):
+    def getFeatureLocationsExpanded(self, region_id, start, end, types, exclude = []):
+        """
+            Widens start and end to take in the whole of any features of the types that overlap them (e.g. genes), and 
+            returns the widened coordinates with the feature locations in between. The coordinates must be integers. 
+            
+            If the region is indexed, that takes no round trips, otherwise one. The tiles can't be read from for that one, 
+            as the widened window isn't known beforehand, but the locations are used to fill the tiles wholly within it. 
+        """
+        region_index = self._getRegionIndex(region_id, start, end)
+        if region_index is not None:
+            (boundary_start, boundary_end) = region_index.getBoundaries(start, end, types)
+            actual_start = start
+            if boundary_start is not None:
+                actual_start = min(start, boundary_start)
+            actual_end = end
+            if boundary_end is not None:
+                actual_end = max(end, boundary_end)
+            return (actual_start, actual_end, self.getFeatureLocations(region_id, actual_start, actual_end, exclude))
+        
         args = {
             "regionid": region_id,
             "start": start,
-            "end": end, 
+            "end": end,
             "types" : tuple(types)
         }
-        return self.runQueryAndMakeDictionary("get_location_min_and_max_boundaries", args)
+        
+        # the version is got first, so that a change in between leaves the tiles out of date rather than wrong
+        version = self._getRegionVersion(region_id, start, end)
+        
+        if len(exclude) > 0:
+            args["exclude"] = tuple(exclude)
+            rows = self.runQueryAndMakeDictionary("get_locations_expanded_excluding", args)
+        else:
+            rows = self.runQueryAndMakeDictionary("get_locations_expanded", args)
+        
+        # every row carries the boundaries, and if there are no features, there's just the one without any
+        actual_start = int(rows[0]["actual_start"])
+        actual_end = int(rows[0]["actual_end"])
+        locations = []
+        for row in rows:
+            del row["actual_start"]
+            del row["actual_end"]
+            if row["feature"] != "None":
+                locations.append(row)
+        
+        if version is not None:
+            region_tiles.fill(("locations", str(region_id), tuple(sorted(exclude))), version, actual_start, actual_end, locations, _location_coordinates)
+        
+        return (actual_start, actual_end, locations)
+    
+    def _getRegionIndex(self, region_id, start, end):
+        # the index only matches the sql's overlap predicate for numeric, ordered coordinates
+        if not self._orderedCoordinates(start, end):
+            return None
+        return region_locations.get(region_id)
+    
+    def _getRegionVersion(self, region_id, start, end):
+        # the tiles are keyed on the signature of the region's locations, so they stop being used once it changes, 
+        # and aren't used at all until it's known (or for coordinates the tiles can't handle)
+        if not region_tiles.enabled or not self._orderedCoordinates(start, end):
+            return None
+        return region_locations.version(region_id)
+    
+    def _orderedCoordinates(self, start, end):
+        try:
+            return int(start) <= int(end)
+        except (ValueError, TypeError):
+            return False
 
     
     
     def getTopLevelTypeID(self):
+        results = vocabulary.getIDs("genedb_misc", ["top_level_seq"])
+        if results is not None:
+            return results[0]
+        
         rows = self.runQueryExpectingSingleRow("get_top_level_type_id")
         return rows[0][0]
     
@@ -210,9 +957,12 @@ class Queries(QueryProcessor):
         return self.runQueryAndMakeDictionary("get_featureprop",  {"uniquenames" : tuple(uniqueNames) })
 
     
-    def getCDSs(self, organism_id):
+    def getCDSs(self, organism_id, stream = False):
         #logger.info(organism_id)
-        return self.runQueryAndMakeDictionary("get_all_cds_features_for_organism", (organism_id, ))
+        # both columns are text, so with native values the rows need no conversion at all
+        if stream:
+            return self.iterQuery("get_all_cds_features_for_organism", (organism_id, ), native = True)
+        return self.runQueryAndConvert("get_all_cds_features_for_organism", (organism_id, ), native = True)
     
     def getMRNAs(self, gene_unique_names):
         return self.runQueryAndMakeDictionary("get_cds_mrna_sequence", { "genenames": tuple(gene_unique_names) } )
@@ -221,13 +971,34 @@ class Queries(QueryProcessor):
         return self.runQueryAndMakeDictionary("get_cds_pep_sequence", { "genenames": tuple(gene_unique_names) } )
     
     def getGeneSequence(self, region, genes):
+        packed = sequences.getPacked(self, region)
         if len(genes) == 0:
+            if packed is not None:
+                return self._sliceLocations(packed, "get_gene_locations_all", { 'region': region})
             return self.runQueryAndMakeDictionary("get_gene_sequence_all", { 'region': region})
+        if packed is not None:
+            return self._sliceLocations(packed, "get_gene_locations", { 'region': region, "genes" : tuple(genes)})
         return self.runQueryAndMakeDictionary("get_gene_sequence", { 'region': region, "genes" : tuple(genes)})
     
     def getFeatureSequenceFromRegion(self, region, features):
+        packed = sequences.getPacked(self, region)
+        if packed is not None:
+            return self._sliceLocations(packed, "get_feature_locations_on_region", { 'region': region, 'features' : tuple(features)})
         return self.runQueryAndMakeDictionary("get_feature_sequence", { 'region': region, 'features' : tuple(features)})
     
+    def _sliceLocations(self, packed, queryName, args):
+        # gives the same as the substr(src.residues, fl.fmin, fl.fmax) in the *_sequence queries, and releases the packed sequence
+        try:
+            results = []
+            for location in self.runQueryAndMakeDictionary(queryName, args):
+                fmin = int(location.pop("fmin"))
+                fmax = int(location.pop("fmax"))
+                location["sequence"] = packed.read(max(fmin, 1) - 1, fmin + fmax - 1)
+                results.append(location)
+            return results
+        finally:
+            packed.release()
+    
     def getFeatureLength(self, uniquename):
         try:
             return self.runQueryExpectingSingleRow("feature_length", (uniquename, ))[0][0]
@@ -235,21 +1006,7 @@ class Queries(QueryProcessor):
             raise ServerException(qpe.value, ERROR_CODES["DATA_NOT_FOUND"])
     
     def getOrganismProp(self, organism_id, cv, cvterm):
-        query_string = self.getQuery("get_organism_prop")
-        
-        args = {
-            "organism_id" : organism_id
-        }
-        
-        if cv is not None and len(cv) > 0:
-            query_string += " AND cv.name = %(cv)s "
-            args["cv"] = cv
-        
-        if cvterm is not None and len(cvterm) > 0:
-            query_string += " AND cvterm.name = %(cvterm)s "
-            args["cvterm"] = cvterm
-        
-        return self.runQueryStringAndMakeDictionary(query_string, args)
+        return organism_metadata.getProps(self, organism_id, cv, cvterm)
     
     def getOrganismFromID(self, id):
         result = self.runQueryStringAndMakeDictionary(
@@ -260,6 +1017,10 @@ class Queries(QueryProcessor):
         raise ServerException("Could not find organism with common_name " + common_name, ERROR_CODES["DATA_NOT_FOUND"])
     
     def getOrganismIDFromCommonName(self, common_name):
+        organism_id = organisms.fromCommonName(common_name)
+        if organism_id is not None:
+            return organism_id
+        
         result = self.runQueryStringAndMakeDictionary(
             "SELECT organism_id FROM organism WHERE organism.common_name = %(common_name)s", 
             {"common_name" : common_name})
@@ -268,6 +1029,9 @@ class Queries(QueryProcessor):
         raise ServerException("Could not find organism with common_name " + common_name, ERROR_CODES["DATA_NOT_FOUND"])
     
     def getOrganismIDFromOrganismID(self, organism_id):
+        if organisms.fromOrganismID(organism_id) is not None:
+            return int(organism_id)
+        
         result = self.runQueryStringAndMakeDictionary(
             "SELECT organism_id FROM organism WHERE organism.organism_id = %(organism_id)s", 
             {"organism_id" : organism_id})
@@ -283,8 +1047,10 @@ class Queries(QueryProcessor):
             return self.runQueryAndMakeDictionary("get_feature_coordinates_on_all_sourcefeatuess", { "features" : tuple(features) } )
         return self.runQueryAndMakeDictionary("get_feature_coordinates", {"region" : region, "features" : tuple(features) } )
     
-    def getExons(self, region, genes):
+    def getExons(self, region, genes, stream = False):
         if len(genes) == 0:
+            if stream:
+                return self.iterQuery("get_exons_all", { "region" : region })
             return self.runQueryAndMakeDictionary("get_exons_all", { "region" : region })
         return self.runQueryAndMakeDictionary("get_exons", {"region" : region, "genenames" : tuple(genes) })
     
@@ -360,6 +1126,41 @@ class Queries(QueryProcessor):
             to_return.append(result[0])
         return to_return
     
+    def getFeatureCVTermsPubs(self, feature_cvterm_ids):
+        """
+            The batch version of getFeatureCVTermPub, returning a dictionary of pubs keyed on (string) feature_cvterm_id.
+        """
+        to_return = {}
+        if len(feature_cvterm_ids) == 0:
+            return to_return
+        
+        results = self.runQuery("get_feature_cvterms_pubs", {"feature_cvterm_ids" : tuple(feature_cvterm_ids) })
+        for result in results:
+            feature_cvterm_id = str(result[0])
+            if feature_cvterm_id not in to_return:
+                to_return[feature_cvterm_id] = []
+            if result[1] != "null":
+                split = result[1].split(":")
+                to_return[feature_cvterm_id].append({"database" : split[0], "accession" : split[1]})
+        return to_return
+    
+    def getFeatureCVTermsDbxrefs(self, feature_cvterm_ids):
+        """
+            The batch version of getFeatureCVTermDbxrefs, returning a dictionary of dbxref accessions keyed on 
+            (string) feature_cvterm_id.
+        """
+        to_return = {}
+        if len(feature_cvterm_ids) == 0:
+            return to_return
+        
+        results = self.runQuery("get_feature_cvterms_dbxrefs", {"feature_cvterm_ids" : tuple(feature_cvterm_ids) })
+        for result in results:
+            feature_cvterm_id = str(result[0])
+            if feature_cvterm_id not in to_return:
+                to_return[feature_cvterm_id] = []
+            to_return[feature_cvterm_id].append(result[1])
+        return to_return
+    
     def getAnnotationChangeCvterms(self):
         return self.runQueryAndMakeDictionary("get_annotation_change_cvterms")
     
@@ -369,7 +1170,9 @@ class Queries(QueryProcessor):
     def getOrthologueClusters(self, orthologues):
         return self.runQueryAndMakeDictionary("get_orthologue_clusters", {"orthologues" : tuple(orthologues)})
     
-    def getOrthologuesInOrganism(self, organism_id):
+    def getOrthologuesInOrganism(self, organism_id, stream = False):
+        if stream:
+            return self.iterQuery("get_orthologues_inorganism", {"organism_id" : organism_id})
         return self.runQueryAndMakeDictionary("get_orthologues_inorganism", {"organism_id" : organism_id})
         
     def getDomains(self, genes, relationships):
@@ -402,6 +1205,18 @@ class Queries(QueryProcessor):
             "relationships" : tuple(relationships)
         })
     
+    def getRelationshipsHierarchy(self, features, relationships, max_depth = 20):
+        """
+            All the ancestors (direction "parents") and descendants (direction "children") of the features, up to 
+            max_depth relationships away, in one query. Each row has the path of feature_ids leading to it from the 
+            feature, and the path of its parent in the tree, and parents come before their children. 
+        """
+        return self.runQueryAndMakeDictionary("get_relationships_hierarchy", {
+            "features" : tuple(features),
+            "relationships" : tuple(relationships),
+            "max_depth" : max_depth
+        })
+    
     def getFeatureNameFromUniqueNames(self, uniquenames):
         return self.runQueryAndMakeDictionary("get_feature_name_from_uniquename", {"uniquenames" : tuple(uniquenames)})
     
@@ -461,6 +1276,16 @@ class Queries(QueryProcessor):
         
         
     def getFeatureLocsWithNameLike(self, regionID, start, end, term):
+        region_index = self._getRegionIndex(regionID, start, end)
+        if region_index is not None:
+            feature_ids = region_index.getFeatureIDs(int(start), int(end))
+            if len(feature_ids) == 0:
+                return []
+            return self.runQueryAndMakeDictionary("feature_locs_like_by_id", {
+                "regionid": regionID,
+                "features": tuple(feature_ids),
+                "term":term
+            })
         return self.runQueryAndMakeDictionary("feature_locs_like", {
             "regionid": regionID,
             "start":start,
@@ -476,7 +1301,7 @@ class Queries(QueryProcessor):
             return self.runQueryAndMakeDictionary("get_synonym_of_type", {"uniquenames" : tuple(uniquenames), "types" : tuple(types) })
         return self.runQueryAndMakeDictionary("get_synonym", {"uniquenames" : tuple(uniquenames)})
     
-    def getFeaturesWithTermProperty(self, organism_id, vocabularies = [], term_property_type = ""):
+    def getFeaturesWithTermProperty(self, organism_id, vocabularies = [], term_property_type = "", stream = False):
         query_string = self.getQuery("get_features_with_term_property")
         
         args = { "organism_id" : organism_id }
@@ -491,6 +1316,8 @@ class Queries(QueryProcessor):
         
         query_string += " ORDER BY f.uniqueName "
         
+        if stream:
+            return self.iterQueryString(query_string, args)
         return self.runQueryStringAndMakeDictionary(query_string, args)
     
     def getBlastMatch(self, subject, start, end, target = None, score = None):
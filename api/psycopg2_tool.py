@@ -18,7 +18,9 @@ logger=logging.getLogger("PGTransaction")
 
 class PGTransaction(cherrypy.Tool):
     """
-        Similar to the alchemy.sqlalchemy_tool, designed to catch exceptions and rollback if necessary. 
+        Similar to the alchemy.sqlalchemy_tool, designed to catch exceptions and rollback if necessary. Also hands 
+        the thread's pooled connection back to the pool as soon as the response body is ready, or, for streamed 
+        responses (whose body is still being read from the database), once it has been sent. 
         Needs testing.
     """
     def __init__(self):
@@ -28,17 +30,16 @@ class PGTransaction(cherrypy.Tool):
 
     def _setup(self):
         cherrypy.request.hooks.attach('on_end_resource', self.on_end_resource)
+        cherrypy.request.hooks.attach('on_end_request', self.on_end_request)
         cherrypy.Tool._setup(self)
 
     def callable(self):
-        logger.debug (cherrypy.thread_data.connectionFactory.getConnection())
-        if cherrypy.thread_data.connectionFactory.getConnection().closed == True:
-            logger.warn("Connection has been found to be closed. Trying to reset...")
-            try:
-                cherrypy.thread_data.connectionFactory.reset()
-                logger.warn("Reset.")
-            except Exception, e:
-                logger.error("Could not reset connection")
+        # connections are leased lazily on the first query, and liveness is checked by the pool on checkout, so 
+        # all that's left to do here is make sure nothing is still leased from a previous request
+        connectionFactory = cherrypy.thread_data.connectionFactory
+        if connectionFactory.leased is not None:
+            logger.warn("Connection still leased at the start of a request. Releasing...")
+            connectionFactory.release()
     
     
     
@@ -52,13 +53,26 @@ class PGTransaction(cherrypy.Tool):
             logger.error(trace)
 
             # try to recover from whatever caused the problem
-            try:
-                cherrypy.thread_data.connectionFactory.getConnection().rollback()
-            except Exception, e:
-                logger.error("failed rollback")
-                logger.error(e)
+            connectionFactory = cherrypy.thread_data.connectionFactory
+            if connectionFactory.leased is not None:
+                try:
+                    connectionFactory.getConnection().rollback()
+                except Exception, e:
+                    logger.error("failed rollback, discarding connection")
+                    logger.error(e)
+                    connectionFactory.close()
         
-        logger.debug (cherrypy.thread_data.connectionFactory.getConnection())
+        logger.debug (cherrypy.thread_data.connectionFactory)
+        
+        # a body that isn't streamed has been collapsed by now, so there's no need to hold on to the connection 
+        # while a (possibly slow) client reads it
+        if not cherrypy.response.stream:
+            cherrypy.thread_data.connectionFactory.release()
+    
+    def on_end_request(self):
+        # this runs after the body has been written, so streamed responses have finished with the connection by now
+        # (and the others have already released it)
+        cherrypy.thread_data.connectionFactory.release()
 
 
-cherrypy.tools.PGTransaction = PGTransaction()
\ No newline at end of file
+cherrypy.tools.PGTransaction = PGTransaction()
@@ -5,7 +5,14 @@ Created on Nov 21, 2010
 '''
 
 import datetime
+import itertools
 import logging
+import os
+import Queue
+import random
+import re
+import threading
+import time
 import types
 import sys
 
@@ -25,7 +32,12 @@ if sys.platform[:4] == 'java':
         
         def execute(self, query, params):
             query_string = self.make_query_string(query, params)
+            timed = slow_queries.sample()
+            if timed:
+                start = time.time()
             self.cursor.execute(query_string)
+            if timed:
+                slow_queries.check(time.time() - start, query_string)
             self.description = self.cursor.description
         
         def __iter__(self):
@@ -40,6 +52,12 @@ if sys.platform[:4] == 'java':
         def fetchone(self):
             return self.cursor.fetchone()
         
+        def fetchmany(self, size):
+            return self.cursor.fetchmany(size)
+        
+        def close(self):
+            self.cursor.close()
+        
         def param_to_array(self, params):
             mogrified = []
             for param in params:
@@ -78,9 +96,10 @@ if sys.platform[:4] == 'java':
                             param = self.stringify(param)
                         modified_parameters[param_key] = param
 
-                logger.debug (query_string)
-                logger.debug(params)
-                logger.debug (modified_parameters)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug (query_string)
+                    logger.debug(params)
+                    logger.debug (modified_parameters)
 
                 query_string = query_string % modified_parameters
 
@@ -97,16 +116,27 @@ else:
     
     class LoggingCursor(psycopg2.extensions.cursor):
         """
-           This class extends the psycopg2 cursor, so we can log the statements.
+           This class extends the psycopg2 cursor, so we can log the statements, and time them for the slow query log. 
+           Statements are only mogrified (i.e. have their parameters interpolated) if they are going to be logged.
         """
         def execute(self, sql, args=None):
-            try:
+            if logger.isEnabledFor(logging.DEBUG):
                 logger.debug("\n" + self.mogrify(sql, args))
+            
+            timed = slow_queries.sample()
+            if timed:
+                start = time.time()
+            
+            try:
                 psycopg2.extensions.cursor.execute(self, sql, args) #@UndefinedVariable
             except Exception, exc:
                 #logger.debug(self.mogrify(sql, args))
                 logger.error("%s: %s" % (exc.__class__.__name__, exc))
                 raise
+            
+            if timed:
+                # only mogrified if it turns out to be slow
+                slow_queries.check(time.time() - start, lambda: self.mogrify(sql, args))
 
 
 
@@ -125,6 +155,116 @@ class QueryProcessorException(Exception):
     def __str__(self):
         return repr(self.value)
 
+class SlowQueryLog(object):
+    """
+        Keeps the most recent slow queries (those taking at least threshold seconds) in a bounded ring buffer, 
+        with their parameters interpolated. 
+        
+        threshold   - in seconds
+        sample_rate - the fraction (between 0 and 1) of statements that are timed at all, to keep the overhead 
+                      predictable under heavy traffic, 0 switches the log off
+        capacity    - the number of slow queries kept, older ones are overwritten
+    """
+    
+    def __init__(self, threshold = 1.0, sample_rate = 1.0, capacity = 100):
+        self.lock = threading.Lock()
+        self.configure(threshold, sample_rate, capacity)
+    
+    def configure(self, threshold = 1.0, sample_rate = 1.0, capacity = 100):
+        self.lock.acquire()
+        try:
+            self.threshold = float(threshold)
+            self.sample_rate = float(sample_rate)
+            self.capacity = int(capacity)
+            self.buffer = [None] * self.capacity
+            self.position = 0
+            self.timed = 0
+            self.slow = 0
+        finally:
+            self.lock.release()
+    
+    def sample(self):
+        """
+            Whether the statement about to run should be timed.
+        """
+        if self.sample_rate >= 1:
+            return True
+        if self.sample_rate <= 0:
+            return False
+        return random.random() < self.sample_rate
+    
+    def check(self, elapsed, statement):
+        """
+            Records a timed statement, keeping it if it was slow. The statement can be a function returning it, so 
+            that it's only made (e.g. mogrified) for slow ones. 
+        """
+        slow = elapsed >= self.threshold and self.capacity > 0
+        if slow:
+            if callable(statement):
+                statement = statement()
+            logger.warn("Slow query (%.3fs)" % elapsed)
+        
+        self.lock.acquire()
+        try:
+            self.timed += 1
+            if not slow:
+                return
+            
+            self.slow += 1
+            self.buffer[self.position] = {
+                "when" : datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "time" : round(elapsed * 1000, 3),
+                "query" : statement
+            }
+            self.position = (self.position + 1) % self.capacity
+        finally:
+            self.lock.release()
+    
+    def entries(self):
+        """
+            Returns the recorded slow queries, the most recent first.
+        """
+        self.lock.acquire()
+        try:
+            ordered = self.buffer[self.position:] + self.buffer[:self.position]
+        finally:
+            self.lock.release()
+        ordered.reverse()
+        return [entry for entry in ordered if entry is not None]
+    
+    def stats(self):
+        return {
+            "threshold" : self.threshold,
+            "sample_rate" : self.sample_rate,
+            "capacity" : self.capacity,
+            "timed" : self.timed,
+            "slow" : self.slow
+        }
+
+# the process-wide slow query log, written to by all the cursors
+slow_queries = SlowQueryLog()
+
+
+def connect(host, database, user, password, port):
+    """
+        Opens a new raw connection, using zxJDBC under Jython and psycopg2 everywhere else.
+    """
+    if sys.platform[:4] == 'java':
+        conn = driver.connect("jdbc:postgresql://%s:%s/%s" % (host, port, database), user, password, "org.postgresql.Driver")
+
+    else:
+        connect_cmd = "dbname='%s' user='%s' host='%s'" % (database, user, host)
+        if password:
+            # required to handle trusted connection without password
+            connect_cmd = connect_cmd + " password='%s'" % password
+
+        if port:
+            # required to connect to non-default postgresql port value e.g. pathdbsrv1b.internal.sanger.ac.uk:10120/bigtest5
+            connect_cmd = connect_cmd + " port=%s" % port
+
+        conn = driver.connect(connect_cmd);
+    return conn
+
 class ConnectionFactory(object):
     
     def __init__(self, host, database, user, password, port=5432):
@@ -138,33 +278,31 @@ class ConnectionFactory(object):
         
         self.connections = {}
         self.connection = None
+        
+        # the statements prepared on each connection
+        self.statements = {}
     
     def _connect(self):
-        if sys.platform[:4] == 'java':
-            conn = driver.connect("jdbc:postgresql://%s:%s/%s" % (self.host, self.port, self.database), self.user, self.password, "org.postgresql.Driver")
-
-        else:
-            connect_cmd = "dbname='%s' user='%s' host='%s'" % (self.database, self.user, self.host)
-            if self.password:
-                # required to handle trusted connection without password
-                connect_cmd = connect_cmd + " password='%s'" % self.password
-
-            if self.port:
-                # required to connect to non-default postgresql port value e.g. pathdbsrv1b.internal.sanger.ac.uk:10120/bigtest5
-                connect_cmd = connect_cmd + " port=%s" % self.port
-
-            conn = driver.connect(connect_cmd);
-        return conn
+        return connect(self.host, self.database, self.user, self.password, self.port)
     
     def getConnection(self, name = "DEFAULT"):
         if name not in self.connections:
             logger.debug ("Can't find connection '%s'. Creating." % name)
             self.connections[name] = self._connect()
+            self.statements[name] = {}
         if self.connections[name].closed != 0:
             logger.debug ("Connection '%s' is closed. Reopening." % name)
             self.connections[name] = self._connect()
+            self.statements[name] = {}
         return self.connections[name]
     
+    def getStatementCache(self, name = "DEFAULT"):
+        """
+            Returns the statements prepared on the current connection, keyed on query name (None if it failed).
+        """
+        self.getConnection(name)
+        return self.statements[name]
+    
     def close(self, name = "DEFAULT"):
         if self.getConnection(name).closed != 1:
             self.getConnection(name).close()
@@ -184,14 +322,901 @@ class ConnectionFactory(object):
         s= "<ConnectionFactory(" + s + ")>"
         return s
 
+
+class PooledConnection(object):
+    """
+        A raw connection plus the bookkeeping the ConnectionPool needs to decide when to recycle it.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.created = time.time()
+        self.last_used = self.created
+        
+        # the statements prepared on this connection
+        self.statements = {}
+        
+        # whether it's leased from the pool's reserved connections (see ConnectionPool.reserve), or None if it's idle
+        self.reserved = None
+    
+    def __repr__(self):
+        return "<PooledConnection(created=%s, last_used=%s)>" % (self.created, self.last_used)
+
+
+class ConnectionPool(object):
+    """
+        A bounded, thread-safe pool of connections shared by all the server threads. Connections are checked out
+        for the duration of a request and checked back in at the end of it, so that many more threads than 
+        connections can be served. 
+        
+        minconn         - the number of connections opened up front, and never reaped
+        maxconn         - the hard cap on the number of open connections
+        timeout         - how long (in seconds) checkout() waits for a free connection before giving up
+        max_idle        - idle connections above minconn are closed by reap() after this many seconds
+        max_lifetime    - connections older than this many seconds are closed instead of being returned to the pool
+        ping_after      - connections idle for longer than this many seconds are tested with a SELECT 1 on checkout
+        
+        Some of the maxconn connections can be reserved (see reserve()) for checkouts that other checkouts may be 
+        waiting on, e.g. the fan-out workers', so that they can't be starved by the threads waiting for them.
+    """
+    
+    def __init__(self, host, database, user, password, port=5432, minconn=1, maxconn=20, timeout=30, max_idle=300, max_lifetime=3600, ping_after=60):
+        self.host = host
+        self.database = database
+        self.port = port
+        self.user = user
+        self.password = password
+        
+        self.minconn = int(minconn)
+        self.maxconn = int(maxconn)
+        self.timeout = float(timeout)
+        self.max_idle = float(max_idle)
+        self.max_lifetime = float(max_lifetime)
+        self.ping_after = float(ping_after)
+        
+        if self.maxconn < 1 or self.minconn > self.maxconn:
+            raise QueryProcessorException("Invalid pool size: minconn (%s) must be no greater than maxconn (%s), and maxconn must be at least 1." % (self.minconn, self.maxconn))
+        
+        # idle connections are used as a stack, so the most recently used (and warmest) connection is handed out first
+        self.idle = []
+        
+        # the number of connections currently open, both idle and checked out
+        self.size = 0
+        
+        # how many of the maxconn only reserved checkouts can have, and the numbers of connections leased
+        self.reserved = 0
+        self.leased = 0
+        self.leased_reserved = 0
+        
+        self.waiting = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        
+        self.closed = False
+        self.condition = threading.Condition()
+    
+    def _connect(self):
+        return PooledConnection(connect(self.host, self.database, self.user, self.password, self.port))
+    
+    def _close(self, pooled):
+        try:
+            pooled.connection.close()
+        except Exception, e:
+            logger.warn("Could not close pooled connection: %s" % e)
+    
+    def _expired(self, pooled, now):
+        return self.max_lifetime > 0 and now - pooled.created > self.max_lifetime
+    
+    def _usable(self, pooled):
+        """
+            The liveness check made on checkout. Connections that have been sitting idle for a while are pinged, 
+            because the server (or a firewall) may have dropped them in the meantime.
+        """
+        if pooled.connection.closed != 0:
+            return False
+        now = time.time()
+        if self._expired(pooled, now):
+            return False
+        if now - pooled.last_used > self.ping_after:
+            try:
+                cursor = pooled.connection.cursor()
+                cursor.execute("SELECT 1")
+                cursor.fetchall()
+                pooled.connection.rollback()
+            except Exception, e:
+                logger.warn("Pooled connection failed its liveness check: %s" % e)
+                return False
+        return True
+    
+    def _discarded(self, reserved = None):
+        """
+            Gives a slot back to the pool after a connection has been closed, or failed to open (along with its lease, 
+            if it was being checked out).
+        """
+        self.condition.acquire()
+        try:
+            self.size -= 1
+            self._unlease(reserved)
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+    
+    def _unlease(self, reserved):
+        # called with the lock held
+        if reserved is not None:
+            self.leased -= 1
+            if reserved:
+                self.leased_reserved -= 1
+    
+    def reserve(self, count):
+        """
+            Keeps count of the maxconn connections for checkouts made with reserved = True. The others can't lease more 
+            than maxconn - count between them, while reserved checkouts can use any connection.
+        """
+        count = int(count)
+        if count < 0 or count >= self.maxconn:
+            raise QueryProcessorException("Invalid reservation: %s connections must leave some of maxconn (%s) for the others." % (count, self.maxconn))
+        self.condition.acquire()
+        try:
+            self.reserved = count
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+    
+    def fill(self):
+        """
+            Opens connections up to minconn.
+        """
+        while True:
+            self.condition.acquire()
+            try:
+                if self.closed or self.size >= self.minconn:
+                    return
+                self.size += 1
+            finally:
+                self.condition.release()
+            
+            try:
+                pooled = self._connect()
+            except:
+                self._discarded()
+                raise
+            self.checkin(pooled)
+    
+    def checkout(self, timeout = None, reserved = False):
+        """
+            Leases a connection, waiting up to timeout seconds for one to come free if the pool is at maxconn (or, unless 
+            reserved, if the unreserved connections are all leased). New connections are opened outside of the lock, so 
+            that slow connects don't stall the other threads.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        
+        pooled = None
+        self.condition.acquire()
+        try:
+            while True:
+                if self.closed:
+                    raise QueryProcessorException("The connection pool has been closed.")
+                if reserved or self.leased - self.leased_reserved < self.maxconn - self.reserved:
+                    if len(self.idle) > 0:
+                        pooled = self.idle.pop()
+                        break
+                    if self.size < self.maxconn:
+                        self.size += 1
+                        break
+                
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise QueryProcessorException("Timed out after %ss waiting for a database connection (%s in use)." % (timeout, self.size))
+                
+                self.waiting += 1
+                try:
+                    self.condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.checkouts += 1
+            self.leased += 1
+            if reserved:
+                self.leased_reserved += 1
+        finally:
+            self.condition.release()
+        
+        if pooled is not None:
+            if self._usable(pooled):
+                pooled.reserved = reserved
+                return pooled
+            logger.warn("Replacing a stale pooled connection.")
+            self._close(pooled)
+        
+        # either there was no idle connection, or the idle one was stale, either way we hold a slot we need to fill
+        try:
+            pooled = self._connect()
+        except:
+            self._discarded(reserved)
+            raise
+        pooled.reserved = reserved
+        return pooled
+    
+    def checkin(self, pooled, discard = False):
+        """
+            Returns a connection to the pool. Any open transaction is rolled back first. If discard is True, or the 
+            connection is broken or too old, it is closed instead.
+        """
+        now = time.time()
+        
+        if not discard and pooled.connection.closed == 0:
+            try:
+                pooled.connection.rollback()
+            except Exception, e:
+                logger.warn("Could not rollback pooled connection, discarding it: %s" % e)
+                discard = True
+        
+        self.condition.acquire()
+        try:
+            # connections from fill() weren't leased
+            self._unlease(pooled.reserved)
+            pooled.reserved = None
+            
+            if discard or self.closed or pooled.connection.closed != 0 or self._expired(pooled, now):
+                self.size -= 1
+                pooled_to_close = pooled
+            else:
+                pooled.last_used = now
+                self.idle.append(pooled)
+                pooled_to_close = None
+            
+            # waking them all, as a reserved checkout may be able to go ahead when the others can't
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+        
+        if pooled_to_close is not None:
+            self._close(pooled_to_close)
+    
+    def reap(self):
+        """
+            Closes idle connections that have outlived max_lifetime, or that have been idle for more than max_idle 
+            seconds, while keeping at least minconn open. Designed to be called periodically.
+        """
+        now = time.time()
+        reaped = []
+        self.condition.acquire()
+        try:
+            # the oldest idle connections are at the bottom of the stack
+            keep = []
+            for pooled in self.idle:
+                idle_for = now - pooled.last_used
+                if self._expired(pooled, now) or (self.max_idle > 0 and idle_for > self.max_idle and self.size > self.minconn):
+                    reaped.append(pooled)
+                    self.size -= 1
+                else:
+                    keep.append(pooled)
+            self.idle = keep
+        finally:
+            self.condition.release()
+        
+        for pooled in reaped:
+            self._close(pooled)
+        
+        if len(reaped) > 0:
+            logger.info("Reaped %s pooled connection(s)." % len(reaped))
+        
+        # replace any expired connections that took us below the minimum
+        self.fill()
+    
+    def close(self):
+        """
+            Closes all idle connections, and stops handing out new ones. Checked out connections are closed as they are checked in.
+        """
+        self.condition.acquire()
+        try:
+            self.closed = True
+            idle = self.idle
+            self.idle = []
+            self.size -= len(idle)
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+        
+        for pooled in idle:
+            self._close(pooled)
+    
+    def stats(self):
+        self.condition.acquire()
+        try:
+            return {
+                "size" : self.size,
+                "idle" : len(self.idle),
+                "in_use" : self.size - len(self.idle),
+                "reserved" : self.reserved,
+                "reserved_in_use" : self.leased_reserved,
+                "waiting" : self.waiting,
+                "minconn" : self.minconn,
+                "maxconn" : self.maxconn,
+                "checkouts" : self.checkouts,
+                "timeouts" : self.timeouts
+            }
+        finally:
+            self.condition.release()
+    
+    def __repr__(self):
+        return "<ConnectionPool(host=\"%s\", database=\"%s\", user=\"%s\", port=\"%s\", size=%s, idle=%s)>" % (self.host, self.database, self.user, self.port, self.size, len(self.idle))
+
+
+class PooledConnectionFactory(object):
+    """
+        Stands in for a ConnectionFactory, but leases its connection from a shared ConnectionPool instead of owning one. The
+        lease is taken lazily by the first getConnection() call, and must be handed back with release() when the work is done. 
+        
+        Not thread-safe, each thread should have its own. If reserved, it leases from the pool's reserved connections.
+    """
+    
+    def __init__(self, pool, reserved = False):
+        self.pool = pool
+        self.reserved = reserved
+        self.leased = None
+    
+    def getConnection(self, name = "DEFAULT"):
+        if self.leased is not None and self.leased.connection.closed != 0:
+            logger.debug ("Leased connection is closed. Discarding.")
+            self.pool.checkin(self.leased, True)
+            self.leased = None
+        if self.leased is None:
+            self.leased = self.pool.checkout(reserved = self.reserved)
+        return self.leased.connection
+    
+    def getStatementCache(self, name = "DEFAULT"):
+        """
+            Returns the statements prepared on the leased connection, keyed on query name (None if it failed).
+        """
+        self.getConnection(name)
+        return self.leased.statements
+    
+    def release(self):
+        """
+            Hands the leased connection (if any) back to the pool.
+        """
+        if self.leased is not None:
+            leased = self.leased
+            self.leased = None
+            self.pool.checkin(leased)
+    
+    def close(self, name = "DEFAULT"):
+        """
+            Closes the leased connection (if any), rather than returning it to the pool.
+        """
+        if self.leased is not None:
+            leased = self.leased
+            self.leased = None
+            self.pool.checkin(leased, True)
+    
+    def reset(self, name = "DEFAULT"):
+        self.close(name)
+        return self.getConnection(name)
+    
+    def __repr__(self):
+        return "<PooledConnectionFactory(pool=%s, leased=%s)>" % (self.pool, self.leased)
+
+class FanOutCall(object):
+    """
+        One call submitted to a FanOutExecutor, and its outcome.
+    """
+    
+    def __init__(self, func):
+        self.func = func
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self.done = threading.Event()
+
+
+class FanOutExecutor(object):
+    """
+        Runs independent queries concurrently, each on its own connection leased from the pool, so that an endpoint 
+        that needs several of them only waits as long as the slowest. Calls are functions that are passed a queries 
+        object (an instance of queries_class, bound to the leased connection). 
+        
+        Each call also gets a statement_timeout on its connection, so that queries still running when the fan-out 
+        times out are stopped by the server rather than left to tie up a connection.
+        
+        The worker threads are started on first use. A map from inside a call (e.g. a batched endpoint that fans out 
+        itself) is run there and then, one call after the other, on the worker's own connection, because waiting 
+        for other workers from a worker can leave all of them waiting with none free to do the work. 
+        
+        For the same reason, the workers lease from reserved connections of the pool (by default, one per worker, 
+        within maxconn - 1), so that a burst of requests waiting on them can't hold every connection. 
+    """
+    
+    def __init__(self, pool, queries_class, workers = 4, timeout = 30, reserved = None):
+        if reserved is None:
+            reserved = min(workers, pool.maxconn - 1)
+        pool.reserve(reserved)
+        
+        self.pool = pool
+        self.queries_class = queries_class
+        self.workers = workers
+        self.timeout = timeout
+        
+        self.calls = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+        
+        # the queries object of the call a worker thread is running
+        self.local = threading.local()
+    
+    def map(self, funcs, timeout = None):
+        """
+            Runs the functions, and returns their results in the same order. If any of them raises an exception, the 
+            first (in order) is re-raised. If they haven't all finished within timeout seconds (the executor's timeout 
+            by default), a QueryProcessorException is raised. 
+        """
+        queries = getattr(self.local, "queries", None)
+        if queries is not None:
+            return [func(queries) for func in funcs]
+        
+        if timeout is None:
+            timeout = self.timeout
+        
+        self._start()
+        
+        calls = [FanOutCall(func) for func in funcs]
+        for call in calls:
+            self.calls.put((call, timeout))
+        
+        deadline = time.time() + timeout
+        for call in calls:
+            call.done.wait(max(0, deadline - time.time()))
+            if not call.done.isSet():
+                # don't bother running any that haven't started yet
+                for other in calls:
+                    other.cancelled = True
+                raise QueryProcessorException("Timed out after %s seconds waiting for %s concurrent queries." % (timeout, len(calls)))
+        
+        for call in calls:
+            if call.error is not None:
+                raise call.error[0], call.error[1], call.error[2]
+        
+        return [call.result for call in calls]
+    
+    def close(self):
+        """
+            Stops the worker threads, once they've finished what they are doing.
+        """
+        self.lock.acquire()
+        try:
+            for thread in self.threads:
+                self.calls.put(None)
+            self.threads = []
+        finally:
+            self.lock.release()
+    
+    def _start(self):
+        if len(self.threads) > 0:
+            return
+        self.lock.acquire()
+        try:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._work, name="FanOutExecutor-%s" % len(self.threads))
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+        finally:
+            self.lock.release()
+    
+    def _work(self):
+        while True:
+            item = self.calls.get()
+            if item is None:
+                break
+            
+            call, timeout = item
+            if call.cancelled:
+                call.done.set()
+                continue
+            
+            connectionFactory = PooledConnectionFactory(self.pool, reserved = True)
+            try:
+                try:
+                    # SET LOCAL only lasts until the transaction is rolled back by the release
+                    cursor = connectionFactory.getConnection().cursor()
+                    cursor.execute("SET LOCAL statement_timeout = %s" % int(timeout * 1000))
+                    cursor.close()
+                    
+                    self.local.queries = self.queries_class(connectionFactory)
+                    call.result = call.func(self.local.queries)
+                except Exception:
+                    call.error = sys.exc_info()
+            finally:
+                self.local.queries = None
+                connectionFactory.release()
+                call.done.set()
+
+
+# matches the psycopg2 (pyformat) placeholders, and escaped percent signs so they can be skipped
+PLACEHOLDER_PATTERN = re.compile(r"%%|%\((\w+)\)s|%s")
+
+# as above, but also picks up any IN (or NOT IN) in front of a placeholder, as these are passed tuples 
+PREPARABLE_PATTERN = re.compile(r"%%|(?:(\bNOT\s+)?\bIN\s*)?(?:%\((\w+)\)s|%s)", re.IGNORECASE)
+
+def to_array_literal(values):
+    """
+        Turns a list or tuple into a Postgres array literal string, e.g. {"a","b"}. Because it is sent as a string 
+        constant, Postgres will coerce it to whatever array type the prepared statement parameter turned out to be.
+    """
+    if type(values) is not types.ListType and type(values) is not types.TupleType:
+        values = [values]
+    elements = []
+    for value in values:
+        if value is None:
+            elements.append("NULL")
+        else:
+            elements.append('"' + ("%s" % value).replace('\\', '\\\\').replace('"', '\\"') + '"')
+    return "{" + ",".join(elements) + "}"
+
+class NamedQuery(object):
+    """
+        A SQL statement from the sql folder, with its placeholders parsed out in advance. 
+        
+        If preparable, it also carries a server-side prepared statement version of itself, with the psycopg2 
+        placeholders swapped for $n ones. Because a prepared statement parameter can't be expanded into a list, 
+        any "IN %(x)s" is rewritten as "= ANY($n)" (and "NOT IN" as "<> ALL"), and is passed an array.
+    """
+    def __init__(self, name, sql, path = None, mtime = None, preparable = True):
+        self.name = name
+        self.sql = sql
+        self.path = path
+        self.mtime = mtime
+        self.preparable = preparable
+        
+        parameters = []
+        positional = 0
+        for match in PLACEHOLDER_PATTERN.finditer(sql):
+            if match.group(0) == "%%":
+                continue
+            parameter = match.group(1)
+            if parameter is None:
+                positional += 1
+            elif parameter not in parameters:
+                parameters.append(parameter)
+        
+        if positional > 0 and len(parameters) > 0:
+            raise QueryProcessorException("Query '%s' mixes named and positional placeholders." % name)
+        
+        # the named parameters, in order of first appearance
+        self.parameters = tuple(parameters)
+        # the number of positional (%s) parameters
+        self.positional = positional
+        
+        if self.preparable:
+            self._make_prepared()
+    
+    def _make_prepared(self):
+        self.statement_name = "crawl_" + self.name
+        
+        # the positions (counting from 0) of the parameters that need to be passed as arrays
+        self.array_parameters = {}
+        
+        prepared = []
+        last = 0
+        positional_count = 0
+        for match in PREPARABLE_PATTERN.finditer(self.sql):
+            prepared.append(self.sql[last:match.start()])
+            last = match.end()
+            
+            if match.group(0) == "%%":
+                prepared.append("%")
+                continue
+            
+            if match.group(2) is not None:
+                position = list(self.parameters).index(match.group(2))
+            else:
+                position = positional_count
+                positional_count += 1
+            
+            placeholder = "$" + str(position + 1)
+            if match.group(0)[0] != "%":
+                self.array_parameters[position] = True
+                if match.group(1) is not None:
+                    placeholder = "<> ALL(" + placeholder + ")"
+                else:
+                    placeholder = "= ANY(" + placeholder + ")"
+            prepared.append(placeholder)
+        prepared.append(self.sql[last:])
+        
+        body = "".join(prepared).strip()
+        while body.endswith(";"):
+            body = body[0:-1].rstrip()
+        
+        self.prepare_sql = "PREPARE %s AS %s" % (self.statement_name, body)
+        
+        parameter_count = len(self.parameters) + self.positional
+        if parameter_count > 0:
+            self.execute_sql = "EXECUTE %s (%s)" % (self.statement_name, ", ".join(["%s"] * parameter_count))
+        else:
+            self.execute_sql = "EXECUTE %s" % self.statement_name
+    
+    def execute_args(self, args):
+        """
+            Turns the args, as they would be passed along with the plain SQL, into the args for the EXECUTE statement.
+        """
+        if len(self.parameters) + self.positional == 0:
+            return None
+        
+        if len(self.parameters) > 0:
+            ordered = []
+            for parameter in self.parameters:
+                ordered.append(args[parameter])
+        else:
+            ordered = list(args)
+        
+        for position in self.array_parameters:
+            ordered[position] = to_array_literal(ordered[position])
+        
+        return ordered
+    
+    def __str__(self):
+        return self.sql
+    
+    def __repr__(self):
+        return "<NamedQuery(%s, parameters=%s, positional=%s)>" % (self.name, self.parameters, self.positional)
+
+
+class QueryRegistry(object):
+    """
+        The named queries in a folder of .sql files, loaded and validated once, and shared by all QueryProcessors. 
+        The registry is never modified in place, a reload builds a new dictionary and swaps it in, so it can be 
+        read from any thread without locking. 
+        
+        If reload is True, refresh() will check the files' modification times and reload the queries if any have 
+        changed (or been added or removed), which is useful during development. 
+    """
+    
+    def __init__(self, sqlPath, reload = False):
+        self.sqlPath = sqlPath
+        self.reload = reload
+        self.lock = threading.Lock()
+        self.queries = self._load()
+        logger.info("Loaded %s queries from %s" % (len(self.queries), sqlPath))
+    
+    def _load(self):
+        queries = {}
+        for file_name in os.listdir(self.sqlPath):
+            if file_name.endswith(".sql"):
+                query = self._load_file(file_name)
+                queries[query.name] = query
+        return queries
+    
+    def _load_file(self, file_name):
+        path = os.path.join(self.sqlPath, file_name)
+        mtime = os.path.getmtime(path)
+        sql_file = open(path, 'r')
+        try:
+            sql = sql_file.read()
+        finally:
+            sql_file.close()
+        if len(sql.strip()) == 0:
+            raise QueryProcessorException("Query file %s is empty." % path)
+        return NamedQuery(file_name.replace(".sql", ""), sql, path, mtime)
+    
+    def get(self, queryName):
+        return self.queries.get(queryName)
+    
+    def names(self):
+        return self.queries.keys()
+    
+    def __contains__(self, queryName):
+        return queryName in self.queries
+    
+    def __len__(self):
+        return len(self.queries)
+    
+    def refresh(self):
+        """
+            Reloads the queries if the sql folder has changed since they were loaded. Does nothing unless reload is True. 
+        """
+        if not self.reload:
+            return False
+        
+        current = {}
+        for file_name in os.listdir(self.sqlPath):
+            if file_name.endswith(".sql"):
+                current[file_name.replace(".sql", "")] = os.path.getmtime(os.path.join(self.sqlPath, file_name))
+        
+        queries = self.queries
+        changed = len(current) != len(queries)
+        if not changed:
+            for queryName, mtime in current.items():
+                if queryName not in queries or queries[queryName].mtime != mtime:
+                    changed = True
+                    break
+        
+        if not changed:
+            return False
+        
+        self.lock.acquire()
+        try:
+            logger.info("Reloading queries from %s" % self.sqlPath)
+            self.queries = self._load()
+        finally:
+            self.lock.release()
+        return True
+
+
+def _to_string(val):
+    # the original makeDictionary behaviour, kept for columns of unknown type
+    if isinstance(val, datetime.datetime):
+        return val.strftime("%Y-%m-%d")
+    elif type(val) is types.ListType:
+        return val
+    return str(val)
+
+def _text_to_string(val):
+    if val is None:
+        return "None"
+    return val
+
+def _array_to_string(val):
+    if val is None:
+        return "None"
+    return val
+
+def _timestamp_to_string(val):
+    if val is None:
+        return "None"
+    return val.strftime("%Y-%m-%d")
+
+def _timestamp_to_native(val):
+    if val is None:
+        return None
+    return val.strftime("%Y-%m-%d")
+
+def _to_native(val):
+    if isinstance(val, datetime.datetime):
+        return val.strftime("%Y-%m-%d")
+    return val
+
+# the postgres type OIDs (as found in psycopg2's cursor.description) that can skip the generic conversion
+TEXT_TYPES = (18, 19, 25, 1042, 1043)
+TIMESTAMP_TYPES = (1114, 1184)
+ARRAY_TYPES = (1000, 1005, 1007, 1009, 1014, 1015, 1016, 1021, 1022)
+
+
+class Record(object):
+    """
+        The base of the __slots__ classes made by RowConverter for the "record" mode. Supports item access too, so 
+        it can be used where a row dictionary would be. 
+    """
+    __slots__ = ()
+    
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+    
+    def __getitem__(self, name):
+        return getattr(self, name)
+    
+    def as_dict(self):
+        d = {}
+        for name in self.__slots__:
+            d[name] = getattr(self, name)
+        return d
+    
+    def __repr__(self):
+        return "<Record(%s)>" % self.as_dict()
+
+
+class RowConverter(object):
+    """
+        Turns cursor rows into results, using a conversion plan that is worked out once per cursor description, rather 
+        than once per cell. Converters are cached, so the plan for each distinct query result shape is only built once. 
+        
+        mode    - "dict" (the default) makes a dictionary per row, keyed on column name, "tuple" makes a tuple per row, 
+                  and "record" makes an instance of a __slots__ Record class per row
+        native  - if False (the default) every value is turned into a string (with None becoming "None"), as the 
+                  controllers have always expected, if True values are kept as the driver returned them
+        
+        In both cases datetimes are formatted as YYYY-MM-DD, and arrays are kept as lists.
+    """
+    
+    MODES = ("dict", "tuple", "record")
+    
+    _cache = {}
+    _record_classes = {}
+    
+    def __init__(self, description, mode = "dict", native = False):
+        if mode not in RowConverter.MODES:
+            raise QueryProcessorException("Unknown row conversion mode '%s'." % mode)
+        
+        self.mode = mode
+        self.native = native
+        self.names = tuple([column[0] for column in description])
+        
+        # the plan, (column index, converter) pairs, leaving out the columns that can be used as they are
+        plan = []
+        for index in range(len(description)):
+            converter = self._plan_column(description[index][1])
+            if converter is not None:
+                plan.append((index, converter))
+        self.plan = tuple(plan)
+        
+        if mode == "record":
+            self.record_class = RowConverter._record_class(self.names)
+    
+    def _plan_column(self, type_code):
+        # under Jython the type codes are JDBC ones, which won't match any of these, and get the generic conversion
+        if self.native:
+            if type_code in TIMESTAMP_TYPES:
+                return _timestamp_to_native
+            if type_code in TEXT_TYPES or type_code in ARRAY_TYPES:
+                return None
+            return _to_native
+        
+        if type_code in TEXT_TYPES:
+            return _text_to_string
+        if type_code in TIMESTAMP_TYPES:
+            return _timestamp_to_string
+        if type_code in ARRAY_TYPES:
+            return _array_to_string
+        return _to_string
+    
+    def _record_class(names):
+        if names not in RowConverter._record_classes:
+            RowConverter._record_classes[names] = type("Record", (Record,), { "__slots__" : names })
+        return RowConverter._record_classes[names]
+    _record_class = staticmethod(_record_class)
+    
+    def for_description(description, mode = "dict", native = False):
+        """
+            Returns a (cached) converter for a cursor description.
+        """
+        key = (tuple([(column[0], column[1]) for column in description]), mode, native)
+        converter = RowConverter._cache.get(key)
+        if converter is None:
+            converter = RowConverter(description, mode, native)
+            RowConverter._cache[key] = converter
+        return converter
+    for_description = staticmethod(for_description)
+    
+    def convert(self, row):
+        if len(self.plan) > 0:
+            values = list(row)
+            for index, converter in self.plan:
+                values[index] = converter(values[index])
+        else:
+            values = row
+        
+        if self.mode == "dict":
+            return dict(zip(self.names, values))
+        elif self.mode == "tuple":
+            return tuple(values)
+        return self.record_class(*values)
+    
+    def convert_all(self, rows):
+        convert = self.convert
+        return [convert(row) for row in rows]
+
+
 class QueryProcessor(object):
     """
         A base class for manaing postgres queries. 
     """
+    
+    # how many rows are pulled over from a server-side cursor at a time, see iterQuery
+    stream_batch_size = 1000
+    
+    # used to name server-side cursors uniquely
+    _cursor_names = itertools.count()
     def __init__(self, **kwargs):
         
+        # queries added to this instance only, on top of those in the registry
         self.queries = {}
         
+        self.registry = kwargs.get("registry")
+        if self.registry is not None:
+            self.sqlPath = self.registry.sqlPath
+        
         if "connection" in kwargs:
             self.connectionFactory = kwargs["connection"]
             
@@ -232,8 +1257,65 @@ class QueryProcessor(object):
     def addQueryFromString(self, queryName, queryString):
         self.queries[queryName] = queryString
     
+    def _getNamedQuery(self, queryName):
+        if queryName in self.queries:
+            return NamedQuery(queryName, self.queries[queryName], preparable = False)
+        if self.registry is not None:
+            query = self.registry.get(queryName)
+            if query is not None:
+                return query
+        raise QueryProcessorException("Unknown query '%s'." % queryName)
+    
     def getQuery(self, queryName):
-        return self.queries.get(queryName)
+        if queryName in self.queries:
+            return self.queries[queryName]
+        if self.registry is not None:
+            query = self.registry.get(queryName)
+            if query is not None:
+                return query.sql
+        return None
+    
+    def _execute(self, cursor, queryName, args):
+        """
+            Runs a named query, as a server-side prepared statement if possible, so that Postgres only has to plan 
+            it once per connection. Prepared statements live as long as their connection, so the connection factory 
+            keeps track of which have been prepared on the current one (and which couldn't be, as None).
+        """
+        query = self._getNamedQuery(queryName)
+        
+        if query.preparable and sys.platform[:4] != 'java' and hasattr(self.connectionFactory, "getStatementCache"):
+            statements = self.connectionFactory.getStatementCache()
+            if query.name not in statements or statements[query.name] not in (query, None):
+                self._prepare(cursor, query, statements)
+            
+            if statements.get(query.name) is query:
+                cursor.execute(query.execute_sql, query.execute_args(args))
+                return
+        
+        cursor.execute(query.sql, args)
+    
+    def _prepare(self, cursor, query, statements):
+        # a failed PREPARE would abort the whole transaction, so it's wrapped in a savepoint (all in one round trip)
+        deallocate = ""
+        if statements.get(query.name) is not None:
+            # the query must have been reloaded from disk since it was prepared
+            deallocate = "DEALLOCATE %s; " % query.statement_name
+        
+        try:
+            cursor.execute("SAVEPOINT crawl_prepare; %s%s; RELEASE SAVEPOINT crawl_prepare" % (deallocate, query.prepare_sql))
+            statements[query.name] = query
+        except Exception, e:
+            cursor.execute("ROLLBACK TO SAVEPOINT crawl_prepare; RELEASE SAVEPOINT crawl_prepare")
+            
+            # syntax errors and undeterminable parameter types (SQLSTATE class 42) will fail the same way on every 
+            # connection, anything else (e.g. a lock timeout or a cancelled statement) may not
+            pgcode = getattr(e, "pgcode", None)
+            if pgcode is not None and str(pgcode)[:2] == "42":
+                logger.warn("Could not prepare %s, it will be sent as plain SQL from now on. %s" % (query.name, e))
+                query.preparable = False
+            else:
+                logger.warn("Could not prepare %s, it will be sent as plain SQL on this connection. %s" % (query.name, e))
+            statements[query.name] = None
     
     def commit(self):
         self.getConnection().commit() 
@@ -245,7 +1327,7 @@ class QueryProcessor(object):
         # print query % args
         
         cursor = self.getCursor()
-        cursor.execute(self.queries[queryName], args)
+        self._execute(cursor, queryName, args)
         #self.commit() 
     
     def runQueryExpectingSingleRow(self, queryName, args = None):
@@ -259,7 +1341,7 @@ class QueryProcessor(object):
     
     def runQuery(self, queryName, args = None):
         cursor = self.getCursor()
-        cursor.execute(self.queries[queryName], args)
+        self._execute(cursor, queryName, args)
         rows = cursor.fetchall()
         return rows
     
@@ -276,23 +1358,72 @@ class QueryProcessor(object):
         
     def runQueryAndMakeDictionary(self, queryName, args = None):
         cursor = self.getCursor()
-        cursor.execute(self.queries[queryName], args)
+        self._execute(cursor, queryName, args)
         return self.makeDictionary(cursor)
         
         
+    def runQueryAndConvert(self, queryName, args = None, mode = "dict", native = False):
+        """
+            Like runQueryAndMakeDictionary, but with a choice of row type (dict, tuple or record), and of whether to 
+            keep the values' native types. See RowConverter.
+        """
+        cursor = self.getCursor()
+        self._execute(cursor, queryName, args)
+        return self.convertRows(cursor, mode, native)
+    
+    def runQueryStringAndConvert(self, query_string, args = None, mode = "dict", native = False):
+        cursor = self.getCursor()
+        cursor.execute(query_string, args)
+        return self.convertRows(cursor, mode, native)
+    
+    def convertRows(self, cursor, mode = "dict", native = False):
+        if cursor.description is None:
+            return []
+        return RowConverter.for_description(cursor.description, mode, native).convert_all(cursor.fetchall())
+    
+    def iterQuery(self, queryName, args = None, mode = "dict", native = False, batch_size = None):
+        """
+            A generator version of runQueryAndConvert, that runs the query on a server-side (named) cursor, and fetches 
+            the rows in batches of batch_size as they are iterated over. Use it for queries whose results may be too large 
+            to hold in memory. The connection must still be open while the generator is being consumed. 
+            
+            Server-side cursors can't EXECUTE a prepared statement, so the query is always sent as plain SQL.
+        """
+        return self.iterQueryString(self._getNamedQuery(queryName).sql, args, mode, native, batch_size)
+    
+    def iterQueryString(self, query_string, args = None, mode = "dict", native = False, batch_size = None):
+        if batch_size is None:
+            batch_size = self.stream_batch_size
+        
+        if sys.platform[:4] == 'java':
+            # zxJDBC doesn't do named cursors, but its fetchmany still saves on converting all the rows at once
+            cursor = self.getCursor()
+        else:
+            name = "crawl_stream_%s" % QueryProcessor._cursor_names.next()
+            cursor = self.getConnection().cursor(name, cursor_factory=LoggingCursor)
+        
+        try:
+            cursor.execute(query_string, args)
+            
+            converter = None
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if len(rows) == 0:
+                    break
+                
+                # named cursors only have a description once something has been fetched
+                if converter is None:
+                    converter = RowConverter.for_description(cursor.description, mode, native)
+                
+                for row in rows:
+                    yield converter.convert(row)
+        finally:
+            try:
+                cursor.close()
+            except Exception, e:
+                # it's not a problem if the transaction has already ended, taking the cursor with it
+                logger.debug("Could not close streaming cursor: %s" % e)
+    
     def makeDictionary(self, cursor):
-        result = []
-        for currow in cursor:
-            rowdict = {}
-            for curcol in range(0,len(cursor.description)):
-                val = currow[curcol]
-                if isinstance(val, datetime.datetime):
-                    val = val.strftime("%Y-%m-%d")
-                elif type(val) is types.ListType:
-                    pass
-                else: 
-                    val = str(val) 
-                rowdict[cursor.description[curcol][0]] = val
-            result.append(rowdict)
-        return result
+        return self.convertRows(cursor)
     
\ No newline at end of file
@@ -42,17 +42,31 @@ import inspect
 import os
 import sys
 import logging
+import threading
 
 import types 
 
-import xml.dom.minidom
-
 logger = logging.getLogger("ropy")
 
-try:
-    import simplejson as json
-except ImportError:
-    import json
+def _load_json():
+    """
+        Prefers simplejson if its C speedups are compiled in, because unlike the standard library's (in python 2.7) its 
+        C encoder still gets used when sorting keys. Otherwise, falls back on the standard library json, and then on a 
+        pure python simplejson for older pythons. Returns the module and whether it has a C encoder. 
+    """
+    try:
+        import simplejson
+        if simplejson.encoder.c_make_encoder is not None:
+            return simplejson, True
+    except (ImportError, AttributeError):
+        pass
+    try:
+        import json
+    except ImportError:
+        import simplejson as json
+    return json, getattr(json.encoder, "c_make_encoder", None) is not None
+
+json, JSON_SPEEDUPS = _load_json()
 
 # an enum-type list of error codes, to standardise error responses
 ERROR_CODES = {
@@ -89,7 +103,143 @@ def serve():
 def unserve():
     globals()["serving"] = False
 
-def service_format(format_name = None):
+class Signature(object):
+    """
+        The arguments of a web method, worked out from its argspec when it's decorated: all its arguments (apart from 
+        self), their defaults, and which ones are required.
+    """
+    
+    def __init__(self, func):
+        argspec = inspect.getargspec(func)
+        
+        # ArgSpec(args=['self', 'features', 'cvs'], varargs=None, keywords=None, defaults=(['x', 'y'], []))
+        funcargs = [funcarg for funcarg in argspec[0] if funcarg != "self"]
+        defaults = argspec[3] or ()
+        
+        self.arguments = tuple(funcargs)
+        self.defaults = dict(zip(funcargs[len(funcargs) - len(defaults):], defaults))
+        self.required = tuple([funcarg for funcarg in funcargs if funcarg not in self.defaults])
+    
+    def bind(self, kwargs):
+        """
+            Returns a copy of the request's keyword arguments with any [] removed from array keys. Raises a 
+            ServerException if any required arguments are missing.
+        """
+        bound = {}
+        for k, v in kwargs.iteritems():
+            if k.endswith("[]"):
+                k = k[0:len(k)-2]
+            bound[k] = v
+        
+        missing = [funcarg for funcarg in self.required if funcarg not in bound]
+        if len(missing) > 0:
+            raise ServerException("missing args: " + ", ".join(missing), ERROR_CODES["MISSING_PARAMETER"])
+        
+        return bound
+    
+    def __repr__(self):
+        return "<Signature(%s)>" % ", ".join(self.arguments)
+
+
+class Flight(object):
+    """
+        A computation being run by SingleFlight, and its outcome.
+    """
+    
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class SingleFlight(object):
+    """
+        Coalesces identical concurrent computations: the first caller for a key runs it, and any others that arrive 
+        for the same key before it finishes wait for, and share, its result (or its exception). Nothing is kept once 
+        it has finished, so this is not a cache. Callers only wait for timeout seconds, after which they give up on 
+        the first caller and run it themselves, so that one hung computation doesn't hang every duplicate of it. 
+    """
+    
+    def __init__(self, enabled = True, timeout = 30):
+        self.enabled = enabled
+        self.timeout = timeout
+        self.flights = {}
+        self.lock = threading.Lock()
+        
+        # how many computations were run, how many callers shared one instead of running their own, and how many 
+        # of those gave up waiting
+        self.executed = 0
+        self.coalesced = 0
+        self.timeouts = 0
+    
+    def do(self, key, func):
+        self.lock.acquire()
+        try:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = Flight()
+                self.flights[key] = flight
+                self.executed += 1
+            else:
+                self.coalesced += 1
+        finally:
+            self.lock.release()
+        
+        if leader:
+            try:
+                try:
+                    flight.result = func()
+                except Exception:
+                    flight.error = sys.exc_info()
+            finally:
+                self.lock.acquire()
+                try:
+                    del self.flights[key]
+                finally:
+                    self.lock.release()
+                flight.done.set()
+        else:
+            flight.done.wait(self.timeout)
+            if not flight.done.isSet():
+                self.lock.acquire()
+                try:
+                    self.timeouts += 1
+                finally:
+                    self.lock.release()
+                logger.warn("Gave up waiting %ss for an identical call to finish, running it again." % self.timeout)
+                return func()
+        
+        if flight.error is not None:
+            raise flight.error[0], flight.error[1], flight.error[2]
+        return flight.result
+    
+    def stats(self):
+        return {
+            "enabled" : self.enabled,
+            "executed" : self.executed,
+            "coalesced" : self.coalesced,
+            "timeouts" : self.timeouts,
+            "in_flight" : len(self.flights)
+        }
+
+# coalesces identical concurrent web method calls, see service_format
+single_flight = SingleFlight()
+
+def _canonical_arguments(args, kwargs):
+    """
+        A hashable version of a call's arguments, that's the same whatever order the keyword arguments came in.
+    """
+    canonical = []
+    for k, v in kwargs.items():
+        if type(v) is types.ListType:
+            v = tuple(v)
+        canonical.append((k, v))
+    canonical.sort()
+    return (tuple(args), tuple(canonical))
+
+
+def service_format(format_name = None, coalesce = True):
     """
         A decorator maker (see http://stackoverflow.com/questions/739654/understanding-python-decorators). This extra function nesting is to allow
         setting the format_name at the method level, by permitting the methods to be decorated with parameters. For example:
@@ -99,66 +249,30 @@ def service_format(format_name = None):
                 ...
         The format_name parameter tells is passed on by the wrapper to the RESTController.format method. 
         
+        Identical requests that are in flight at the same time share one result, unless coalesce is False, which 
+        is for methods with side effects (admin actions, refreshes) that must run each time they are asked for.
+        
     """
     def service_decorator(func):
         """
             The decorator, which passes the func parameter onto the wrapper.
         """
+        # inspecting the method is slow, so it's only done the once
+        signature = Signature(func)
+        
         def wrapper(self, *args, **kwargs):
             """
                 Generates the appropriate headers, determines the format_type, calls the exposed method, and wraps the response in a 
                 JSONP callback if the appropriate parameter is present. 
             """
             
-            # remove any [] from array keys
-            for k, v in kwargs.items():
-                if k.endswith("[]"):
-                    del kwargs[k]
-                    new_k = k[0:len(k)-2]
-                    kwargs[new_k] = v
-            
-            logger.debug("args : " + str(args))
-            logger.debug("kwargs : " + str(kwargs))
-            logger.debug("format_name : " + str(format_name))
-            
-            # check the supplied arguments for missing arguments
-            argspec = inspect.getargspec(func)
-            
-            logger.debug(argspec)
-            
-            funcargs = argspec[0]
-            
-            # the func does not have the arguments attribute attached to it, but the method does, so get the method
-            # method = getattr(self, func.func_name)
-            # add any arguments declared in the method arguments attribute to the list of arguments to check for
-            # for m_argname, m_argval in method.arguments.items():
-            #     if m_argname not in funcargs: funcargs.append(m_argname)
-            
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("args : " + str(args))
+                logger.debug("kwargs : " + str(kwargs))
+                logger.debug("format_name : " + str(format_name))
             
-            # ArgSpec(args=['self', 'features', 'cvs'], varargs=None, keywords=None, defaults=(['x', 'y'], []))
-            defaults = argspec[3]
-            arg_defaults = {}
-            # logger.debug(defaults)
-            if defaults != None:
-                index_diff = len(funcargs) - len(defaults)
-                for defindex in range(len(defaults)):
-                    default = defaults[defindex]
-                    funcargindex = defindex + index_diff
-                    funcarg = funcargs[funcargindex]
-                    logger.debug ([defindex, funcargindex, default, funcarg])
-                    arg_defaults[funcarg] = default
-            
-            
-            
-            missing = ""
-            missingsep = ""
-            for funcarg in funcargs:
-                if funcarg != "self" and funcarg not in kwargs and funcarg not in arg_defaults:
-                    missing += missingsep + funcarg
-                    missingsep = ", "
-        
-            if len(missing) > 0:
-                raise ServerException("missing args: " + missing, ERROR_CODES["MISSING_PARAMETER"])
+            # remove any [] from array keys, and check the supplied arguments for missing arguments
+            kwargs = signature.bind(kwargs)
             
             
             # just execute if the server is not serving
@@ -181,6 +295,18 @@ def service_format(format_name = None):
             if '_' in kwargs:
                 _ = kwargs['_']
                 del kwargs['_']
+            
+            # ?stream=1 asks for the response to be sent as it is generated, rather than all at once
+            stream = False
+            if 'stream' in kwargs:
+                stream = kwargs['stream'] == "1" or to_bool(kwargs['stream'])
+                del kwargs['stream']
+            
+            # JSON is compact unless ?pretty=1 is supplied
+            pretty = False
+            if 'pretty' in kwargs:
+                pretty = kwargs['pretty'] == "1" or to_bool(kwargs['pretty'])
+                del kwargs['pretty']
 
             # set the appropriate headers
             self.init_handler()
@@ -189,10 +315,26 @@ def service_format(format_name = None):
             format_type = self.get_format_type()
             self.set_headers(format_type)
             
-            data = func(self, *args, **kwargs)
+            # streamed responses are written out chunk by chunk as the results come out of the database, the 
+            # PGTransaction tool only releases the connection once they are done
+            # (JSONP wrapped XML needs the whole document for its quoting, so that isn't streamed)
+            if format_type == "ndjson" or (stream and (format_type == "json" or callback is None)):
+                data = func(self, *args, **kwargs)
+                cherrypy.response.stream = True
+                return self.stream(data, format_type, format_name, callback, pretty)
+            
+            def run():
+                data = func(self, *args, **kwargs)
+                
+                # format the data
+                return self.format(data, format_type, format_name, pretty)
             
-            # format the data
-            returned = self.format(data, format_type, format_name)
+            # identical requests that arrive while one is already being run just wait for its result
+            if coalesce and single_flight.enabled:
+                key = (split_format(cherrypy.request.path_info)[0].rstrip("/"), format_type, pretty, _canonical_arguments(args, kwargs))
+                returned = single_flight.do(key, run)
+            else:
+                returned = run()
             
             # assign a JSONP callback if needed
             if callback is not None:
@@ -203,9 +345,13 @@ def service_format(format_name = None):
         
             return returned
         
-        # assign the docstring as being the same as the function's
+        # assign the docstring as being the same as the function's, and its signature
         # required by the reflection based service description function in RESTController.index()
         wrapper.__doc__ = func.__doc__
+        wrapper.signature = signature
+        
+        # so that the data can be had without any formatting, see Root.batch()
+        wrapper.undecorated = func
     
         return wrapper
         
@@ -309,7 +455,8 @@ def error_page_default(status, message, traceback, version):
 
 def generate_mappings(obj, mapper, path = ""):
     """
-        Recursively maps a tree of RESTController objects onto a cherrypy.dispatch.RoutesDispatcher() mapper object. Assigns .xml and .json paths for them too.
+        Recursively maps a tree of RESTController objects onto a RESTDispatcher. The dispatcher takes care of the .xml, 
+        .json and .ndjson paths for them.
     """
     for member_info in inspect.getmembers(obj):
         member_name = member_info[0]
@@ -323,31 +470,90 @@ def generate_mappings(obj, mapper, path = ""):
                 if member_name == "index":
                     endpoint = ""
                 
-                mapper.connect(
-                    path + "/" + member_name,
-                    path + "/" + endpoint, 
-                    action=member_name, 
-                    controller=obj,
-                    conditions=dict(method=['POST', 'GET']))
-                
-                mapper.connect(
-                    path + "/" + member_name,
-                    path + "/" + endpoint + ".xml", 
-                    action=member_name, 
-                    controller=obj,
-                    conditions=dict(method=['POST', 'GET']))
-                
-                mapper.connect(
-                    path + "/" + member_name,
-                    path + "/" + endpoint + ".json", 
-                    action=member_name, 
-                    controller=obj,
-                    conditions=dict(method=['POST', 'GET']))
+                mapper.connect(path + "/" + endpoint, obj, member_name)
                     
         elif isinstance(member, RESTController):
             generate_mappings(member, mapper, path + "/" + member_name)
 
 
+# the recognised path extensions, and the format_type they ask for 
+FORMAT_EXTENSIONS = {
+    ".xml" : "xml",
+    ".json" : "json",
+    ".ndjson" : "ndjson"
+}
+
+def split_format(path_info):
+    """
+        Splits the extension off a path, returning the path and the format_type it asks for (xml by default).
+    """
+    dot = path_info.rfind(".")
+    if dot != -1 and path_info[dot:] in FORMAT_EXTENSIONS:
+        return path_info[0:dot], FORMAT_EXTENSIONS[path_info[dot:]]
+    return path_info, "xml"
+
+
+class RESTDispatcher(object):
+    """
+        A cherrypy dispatcher that looks request paths up in a dictionary of controller methods, populated by 
+        generate_mappings, so routing costs the same however many web methods there are. The extension is split off 
+        once here, and the format_type it asks for is stored on the request. Trailing slashes are ignored. Like the 
+        Routes based mappings it replaces, only GET and POST requests are routed. 
+    """
+    
+    methods = ("GET", "POST")
+    
+    def __init__(self):
+        # path -> (controller, action)
+        self.handlers = {}
+    
+    def connect(self, path, controller, action):
+        self.handlers[path.rstrip("/")] = (controller, action)
+    
+    def __call__(self, path_info):
+        request = cherrypy.request
+        
+        path, format_type = split_format(path_info)
+        request.format_type = format_type
+        
+        handler = None
+        found = self.handlers.get(path.rstrip("/"))
+        if found is not None and request.method in self.methods:
+            controller, action = found
+            handler = getattr(controller, action)
+        
+        self._merge_config(path_info, handler)
+        
+        if handler is not None:
+            request.handler = cherrypy.dispatch.LateParamPageHandler(handler)
+        else:
+            request.handler = cherrypy.NotFound()
+    
+    def _merge_config(self, path_info, handler):
+        """
+            Sets request.config, from the global config, then the app's config for each section of the path.
+        """
+        request = cherrypy.request
+        app = request.app
+        
+        request.config = base = cherrypy.config.copy()
+        
+        if hasattr(app.root, "_cp_config"):
+            base.update(app.root._cp_config)
+        if "/" in app.config:
+            base.update(app.config["/"])
+        
+        curpath = ""
+        for atom in path_info.split("/"):
+            if len(atom) > 0:
+                curpath = curpath + "/" + atom
+                if curpath in app.config:
+                    base.update(app.config[curpath])
+        
+        if handler is not None and hasattr(handler, "_cp_config"):
+            base.update(handler._cp_config)
+
+
 def to_array(obj = None):
     arr = []
     if obj != None:
@@ -380,8 +586,22 @@ class RESTController(object):
         """
         pass
     
+    def recover(self):
+        """
+            An abstract hook called when a method called as part of a batch fails, so that any shared resources can be 
+            made ready for the next call, designed to be overriden. 
+        """
+        pass
+    
     def get_format_type(self):
+        # already worked out if the request went through the RESTDispatcher
+        if hasattr(cherrypy.request, "format_type"):
+            return cherrypy.request.format_type
+        
         path_info = cherrypy.request.path_info
+        # must be checked first, because it also ends in .json
+        if path_info.find(".ndjson") != -1:
+            return "ndjson"
         format_type = "json" if path_info.find(".json") != -1 else "xml"
         return format_type
     
@@ -393,20 +613,46 @@ class RESTController(object):
             cherrypy.response.headers['Content-Type'] = "text/xml"
         elif responseType == "json":
             cherrypy.response.headers['Content-Type'] = "application/json"
+        elif responseType == "ndjson":
+            cherrypy.response.headers['Content-Type'] = "application/x-ndjson"
 
-    def format(self, data, format_type, name = None):
+    def format(self, data, format_type, name = None, pretty = False):
         # print self.templateFilePath
         templateFilePath = self.templateFilePath or os.path.dirname(__file__)
         
-        formatter = Formatter(data, templateFilePath)
+        formatter = Formatter(data, templateFilePath, pretty)
         if (format_type == "json"):
             return str(formatter.formatJSON())
+        elif (format_type == "ndjson"):
+            # only errors get here, everything else is streamed
+            return formatter.encoder.encode(data) + "\n"
         else:
             if name != None:
                 return str(formatter.formatXML(name + ".xml.tpl"))
             else:
                 return str(formatter.formatXML())
 
+    def stream(self, data, format_type, name = None, callback = None, pretty = False):
+        """
+            Returns a generator of chunks of the formatted data, for use as a streamed response body, either as a whole 
+            XML or JSON document, or as newline delimited JSON records (ndjson). 
+        """
+        templateFilePath = self.templateFilePath or os.path.dirname(__file__)
+        
+        formatter = Formatter(data, templateFilePath, pretty)
+        if format_type == "ndjson":
+            chunks = formatter.iterNDJSON()
+        elif format_type == "xml":
+            templateFile = None
+            if name != None:
+                templateFile = name + ".xml.tpl"
+            chunks = formatter.iterXML(templateFile)
+        else:
+            chunks = formatter.iterJSON()
+            if callback is not None:
+                chunks = _wrap_chunks(callback + "(", chunks, ")")
+        return _buffer_chunks(chunks)
+
     @cherrypy.expose
     @service_format("info")
     def index(self):
@@ -424,9 +670,11 @@ class RESTController(object):
             if inspect.ismethod(member):
                 if hasattr(member, "exposed") and member_name != "default" and member_name != "index":
                     
-                    arguments_spec = inspect.getargspec(member)
-                    arguments = arguments_spec[0]
-                    arguments.pop(0)
+                    if hasattr(member, "signature"):
+                        arguments = list(member.signature.arguments)
+                    else:
+                        arguments = inspect.getargspec(member)[0]
+                        arguments.pop(0)
                     
                     doc = inspect.getdoc(member)
                     
@@ -463,6 +711,9 @@ class Root(RESTController):
     """
         A standard RESTController designed to display a list of child RESTControllers in the top level index.
     """
+    
+    # a function that runs a list of functions concurrently and returns their results, for parallel batches
+    batch_executor = None
     def __init__(self, name):
         self.name = name
         self.templateFilePath = os.path.dirname(__file__) + "/../tpl/"
@@ -498,6 +749,100 @@ class Root(RESTController):
     
     
     
+    @cherrypy.expose
+    @service_format(coalesce = False)
+    def batch(self, calls, parallel = False):
+        """
+            Runs several web method calls in one request, returning each of their responses (or errors) in order. 
+        """
+        try:
+            calls = json.loads(calls)
+            if type(calls) is not types.ListType:
+                raise ValueError("not a list")
+        except (ValueError, TypeError), e:
+            raise ServerException("The calls must be a JSON array of {\"path\" : ..., \"params\" : {...}} objects: %s" % e, ERROR_CODES["BAD_PARAMETER"])
+        
+        funcs = [self._batch_call(call) for call in calls]
+        
+        if to_bool(parallel) and self.batch_executor is not None:
+            results = self.batch_executor(funcs)
+        else:
+            results = [func() for func in funcs]
+        
+        return {
+            "response" : {
+                "name" : "batch",
+                "results" : results
+            }
+        }
+    
+    batch.arguments = {
+        "calls" : "a JSON array of {\"path\" : ..., \"params\" : {...}} objects, e.g. [{\"path\" : \"features/terms\", \"params\" : {\"features\" : [\"PFA0170c\"]}}]",
+        "parallel" : "to run the calls concurrently, on separate connections (optional, defaults to false)"
+    }
+    
+    def _batch_call(self, call):
+        """
+            Returns a function that runs one call of a batch, and returns its response, or its error as it would have 
+            been reported if the call had been made on its own.
+        """
+        def run():
+            path = None
+            controller = None
+            try:
+                if type(call) is not types.DictType or "path" not in call:
+                    raise ServerException("Each call must have a path.", ERROR_CODES["BAD_PARAMETER"])
+                path = call["path"]
+                
+                params = {}
+                for k, v in call.get("params", {}).items():
+                    params[str(k)] = v
+                
+                controller, method = self._resolve(path)
+                kwargs = method.signature.bind(params)
+                controller.init_handler()
+                data = method.undecorated(controller, **kwargs)
+                
+                # streamed results must be read before the connection moves on to the next call
+                return {
+                    "path" : path,
+                    "response" : _consume_streams(data["response"])
+                }
+            except Exception:
+                error_data = generate_error_data()
+                if controller is not None:
+                    try:
+                        controller.recover()
+                    except Exception, e:
+                        logger.error("Could not recover from a failed batch call")
+                        logger.error(e)
+                return {
+                    "path" : path,
+                    "response" : error_data["response"]
+                }
+        return run
+    
+    def _resolve(self, path):
+        """
+            Finds the controller and web method for a path, the way the RESTDispatcher mapped them. 
+        """
+        path = split_format(path)[0]
+        atoms = path.strip("/").split("/")
+        
+        controller = self
+        for atom in atoms[0:-1]:
+            controller = getattr(controller, atom, None)
+            if atom.startswith("_") or not isinstance(controller, RESTController):
+                raise ServerException("Unknown path %s" % path, ERROR_CODES["BAD_PARAMETER"])
+        
+        action = atoms[-1] or "index"
+        method = getattr(controller, action, None)
+        if action.startswith("_") or not hasattr(method, "exposed") or not hasattr(method, "undecorated") or method == self.batch:
+            raise ServerException("Unknown path %s" % path, ERROR_CODES["BAD_PARAMETER"])
+        
+        return controller, method
+    
+    
     @cherrypy.expose
     @service_format("error_codes")
     def error_codes(self):
@@ -532,13 +877,179 @@ class XMLFilter(Filter):
         return quoteattr(unquoted)
     
 
+class TemplateRegistry(object):
+    """
+        Compiles Cheetah templates into classes once, so that each request only has to instantiate one. Missing files 
+        are remembered too. If reload is True, template files are checked for changes on each lookup, for development. 
+    """
+    
+    def __init__(self, reload = False):
+        self.reload = reload
+        
+        # path -> (template class or None if there's no such file, mtime)
+        self.templates = {}
+        
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+    
+    def load(self, directory):
+        """
+            Compiles all the .tpl files in a directory up front.
+        """
+        for file_name in sorted(os.listdir(directory)):
+            if file_name.endswith(".tpl"):
+                self._compile(os.path.normpath(directory + "/" + file_name))
+        logger.info("Compiled %s templates from %s" % (len(self.templates), directory))
+    
+    def get(self, path):
+        """
+            Returns the compiled template class for a path, or None if there isn't a template file there.
+        """
+        path = os.path.normpath(path)
+        cached = self.templates.get(path)
+        
+        if cached is not None:
+            if not self.reload or cached[1] == self._mtime(path):
+                self._count(True)
+                return cached[0]
+        
+        self._count(False)
+        return self._compile(path)
+    
+    def stats(self):
+        compiled = 0
+        for template_class, mtime in self.templates.values():
+            if template_class is not None:
+                compiled += 1
+        return {
+            "compiled" : compiled,
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "reload" : self.reload
+        }
+    
+    def _compile(self, path):
+        mtime = self._mtime(path)
+        template_class = None
+        if mtime is not None:
+            logger.debug("Compiling template %s" % path)
+            template_class = Template.compile(file=path)
+        self.templates[path] = (template_class, mtime)
+        return template_class
+    
+    def _mtime(self, path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+    
+    def _count(self, hit):
+        self.lock.acquire()
+        try:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        finally:
+            self.lock.release()
+
+
+# the compiled templates, shared by all Formatters, see load_templates()
+templates = TemplateRegistry()
+
+def load_templates(reload = False):
+    """
+        Compiles the templates in the tpl folder. Should be called once at startup, otherwise they are compiled as 
+        they are first used. If reload is True, modified templates are picked up without a restart. 
+    """
+    global templates
+    registry = TemplateRegistry(reload)
+    registry.load(os.path.dirname(__file__) + "/../tpl/")
+    templates = registry
+    return templates
+
+
+class JSONEncoder(object):
+    """
+        Serialises data structures to JSON, with sorted keys so that the same data always gives the same bytes. Compact 
+        by default, or indented by 4 spaces if pretty. 
+    """
+    
+    def __init__(self, pretty = False):
+        self.pretty = pretty
+        if pretty:
+            self.indent = 4
+            self.item_separator = ","
+            self.key_separator = ": "
+        else:
+            self.indent = None
+            self.item_separator = ","
+            self.key_separator = ":"
+    
+    def encode(self, data):
+        return json.dumps(data, indent=self.indent, separators=(self.item_separator, self.key_separator), sort_keys=True)
+    
+    def iterencode(self, data):
+        """
+            Yields the same output as encode, in chunks, consuming any generators in the data (which are written out as 
+            lists) one item at a time. 
+        """
+        return self._iterencode(data, 0)
+    
+    def _iterencode(self, data, level):
+        if self.pretty:
+            outer = "\n" + " " * (4 * level)
+            inner = outer + "    "
+        else:
+            outer = inner = ""
+        
+        if type(data) is types.GeneratorType:
+            empty = True
+            for item in data:
+                if empty:
+                    yield "[" + inner
+                    empty = False
+                else:
+                    yield self.item_separator + inner
+                yield self._indent(self.encode(item), inner)
+            if empty:
+                yield "[]"
+            else:
+                yield outer + "]"
+        
+        elif type(data) is types.DictType and _contains_stream(data):
+            yield "{" + inner
+            first = True
+            for key in sorted(data.keys()):
+                if not first:
+                    yield self.item_separator + inner
+                first = False
+                yield json.dumps(key) + self.key_separator
+                for chunk in self._iterencode(data[key], level + 1):
+                    yield chunk
+            yield outer + "}"
+        
+        else:
+            yield self._indent(self.encode(data), outer)
+    
+    def _indent(self, encoded, indentation):
+        if self.pretty:
+            return encoded.replace("\n", indentation)
+        return encoded
+
+
 class Formatter(object):
     """
         A class to handle all the formatting, invoked by web methods after they have generated their data structures. 
     """
     
-    def __init__(self, data, templateFilePath = None):
+    # the class used to serialise JSON, can be swapped for anything with the same constructor, encode and iterencode
+    encoder_class = JSONEncoder
+    
+    def __init__(self, data, templateFilePath = None, pretty = False):
         self.data = data
+        self.encoder = self.encoder_class(pretty)
         
         self.templateFilePaths = []
         self.templateFilePaths.append (os.path.dirname(__file__) + "/../tpl/")
@@ -547,21 +1058,62 @@ class Formatter(object):
             self.templateFilePaths.append(templateFilePath)
     
     def formatJSON(self):
-        return json.dumps(self.data, indent=4, sort_keys=True) 
+        if not _contains_stream(self.data):
+            return self.encoder.encode(self.data)
+        return "".join(self.iterJSON())
+    
+    def iterJSON(self):
+        """
+            Yields the JSON in chunks, consuming any generators (e.g. streamed query results) in the data as it goes, so 
+            that only one of their items needs to be held in memory at a time. 
+        """
+        return self.encoder.iterencode(self.data)
+    
+    def iterNDJSON(self):
+        """
+            Yields newline delimited JSON. The first line holds everything in the response except its lists, then 
+            each item of each list (in key order) is written on a line of its own. If there is more than one list, 
+            each item is wrapped in an object keyed on the name of its list, e.g. {"genes" : {...}}. 
+        """
+        response = self.data["response"]
+        
+        header = {}
+        lists = []
+        for key in sorted(response.keys()):
+            val = response[key]
+            if type(val) is types.ListType or type(val) is types.GeneratorType:
+                lists.append((key, val))
+            else:
+                header[key] = val
+        
+        # always one line per record, even if pretty printing was asked for
+        encoder = self.encoder_class()
+        
+        yield encoder.encode({ "response" : header }) + "\n"
+        
+        for (key, records) in lists:
+            for record in records:
+                if len(lists) > 1:
+                    record = { key : record }
+                yield encoder.encode(record) + "\n"
         
     def formatXML(self, templateFile = None):
         
-        if templateFile != None:
-            logger.debug("Using template file %s" % templateFile)
-            for templateFilePath in self.templateFilePaths:
-                tplfile = templateFilePath + templateFile
-                # print tplfile
-                if os.path.isfile(tplfile):
-                    tpl = Template(file=tplfile, searchList=self.data, filter=XMLFilter)
-                    return tpl
-            logger.error("Could not find template file %s" % tplfile)
-            logger.error("Falling back to generic XML generation.")
+        tpl = self._getTemplate(templateFile)
+        if tpl is not None:
+            return tpl
         
+        return "".join(self.iterXML())
+    
+    def iterXML(self, templateFile = None):
+        """
+            Yields the XML in chunks. Templates are rendered whole, but the generic XML is written out as it goes, 
+            consuming any generators in the data one item at a time. 
+        """
+        tpl = self._getTemplate(templateFile)
+        if tpl is not None:
+            yield str(tpl)
+            return
         
         # logger.debug(json.dumps(self.data, indent=4, sort_keys=True))
         
@@ -570,55 +1122,90 @@ class Formatter(object):
         # slightly different to results data structures
         # if that changes, then this will have to change too
         
-        # if no template could be found, do it generically
-        impl = xml.dom.minidom.getDOMImplementation()
-        self.xml = impl.createDocument(None, None, None)
+        # if no template could be found, do it generically, writing the same document as xml.dom.minidom's toxml() 
+        # would for a tree built from the data
+        response = self.data["response"]
         
-        root = self.xml.createElement("response")
-        root.attributes["name"] = self.data["response"]["name"]
-        self.xml.childNodes.append(root)
+        yield '<?xml version="1.0" ?><response name="%s">' % _escape_xml(response["name"])
         
-        results_container = self.xml.createElement("results")
-        root.childNodes.append(results_container)
-        
-        for k,v in self.data["response"].items():
+        empty = True
+        for k,v in response.items():
             if k != "name":
-                self._parseXML(results_container, v, k)
+                if empty:
+                    yield "<results>"
+                    empty = False
+                for chunk in self._iterXMLElement(k, v):
+                    yield chunk
         
-        # print (self.xml.toprettyxml())
-        return self.xml.toxml()
+        if empty:
+            yield "<results/></response>"
+        else:
+            yield "</results></response>"
     
+    def _getTemplate(self, templateFile):
+        if templateFile != None:
+            logger.debug("Using template file %s" % templateFile)
+            for templateFilePath in self.templateFilePaths:
+                tplfile = templateFilePath + templateFile
+                # print tplfile
+                template_class = templates.get(tplfile)
+                if template_class is not None:
+                    tpl = template_class(searchList=self.data, filter=XMLFilter)
+                    return tpl
+            logger.error("Could not find template file %s" % tplfile)
+            logger.error("Falling back to generic XML generation.")
+        return None
     
-    def _parseXML(self, node, data, node_name, attribute = False):
+    def _iterXMLElement(self, node_name, data):
+        """
+            Lists become elements containing one (singularly named) element per item, dictionaries become elements 
+            with their scalar values as attributes and their lists and dictionaries as child elements, and anything else 
+            becomes an element containing text. 
+        """
         
-        if type(data) is types.ListType:
+        if type(data) is types.ListType or type(data) is types.GeneratorType:
             
-            sub = self.xml.createElement(node_name)
-            node.childNodes.append(sub)
+            sub_node_name = self._singularize(node_name)
             
+            empty = True
             for val in data:
-                sub_node_name = self._singularize(node_name)
-                self._parseXML(sub, val, sub_node_name )
+                if empty:
+                    yield "<%s>" % node_name
+                    empty = False
+                for chunk in self._iterXMLElement(sub_node_name, val):
+                    yield chunk
+            
+            if empty:
+                yield "<%s/>" % node_name
+            else:
+                yield "</%s>" % node_name
                 
         elif type(data) is types.DictType:
             
-            sub = self.xml.createElement(node_name)
-            node.childNodes.append(sub)
-            
+            attributes = {}
+            children = []
             for key, val in data.items():
-                self._parseXML(sub, val, key, True)
-                
-        else:
+                if type(val) in (types.ListType, types.GeneratorType, types.DictType):
+                    children.append((key, val))
+                else:
+                    attributes[key] = str(val)
+            
+            start = "<" + node_name
+            for key in sorted(attributes.keys()):
+                start += ' %s="%s"' % (key, _escape_xml(attributes[key]))
             
-            if attribute is True:
-                node.attributes[node_name] = str(data)
+            if len(children) == 0:
+                yield start + "/>"
             else:
+                yield start + ">"
+                for key, val in children:
+                    for chunk in self._iterXMLElement(key, val):
+                        yield chunk
+                yield "</%s>" % node_name
                 
-                sub = self.xml.createElement(node_name)
-                node.childNodes.append(sub)
-                
-                t = self.xml.createTextNode(str(data))
-                sub.childNodes.append(t)
+        else:
+            
+            yield "<%s>%s</%s>" % (node_name, _escape_xml(str(data)), node_name)
         
         
     def _singularize(self, plural):
@@ -636,6 +1223,61 @@ class Formatter(object):
     
 
 
+def _escape_xml(data):
+    """
+        Escapes text and attribute values the way xml.dom.minidom does.
+    """
+    return data.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+def _contains_stream(data):
+    """
+        Streams are only looked for in dictionary values, which is where the controllers put their results.
+    """
+    if type(data) is types.GeneratorType:
+        return True
+    if type(data) is types.DictType:
+        for val in data.itervalues():
+            if _contains_stream(val):
+                return True
+    return False
+
+def _consume_streams(data):
+    """
+        Turns any generators in a dictionary's values (or their values) into lists.
+    """
+    if type(data) is types.GeneratorType:
+        return list(data)
+    if type(data) is types.DictType and _contains_stream(data):
+        consumed = {}
+        for key, val in data.items():
+            consumed[key] = _consume_streams(val)
+        return consumed
+    return data
+
+def _wrap_chunks(before, chunks, after):
+    yield before
+    for chunk in chunks:
+        yield chunk
+    yield after
+
+def _buffer_chunks(chunks, size = 8192):
+    """
+        Joins small chunks together, so that each write to the client is at least size bytes (apart from the last).
+    """
+    buf = []
+    buffered = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            yield "".join(buf)
+            buf = []
+            buffered = 0
+    if len(buf) > 0:
+        yield "".join(buf)
+
+
+
 def main():
     pass
 
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+sequences.py
+
+A local, packed copy of the top level regions' residues, read through mmap so that slicing a chromosome doesn't need
+a database round trip. Each region is a file of 2 bits per base, with a side table of the runs that aren't A, C, G or
+T (Ns, ambiguity codes, lower case), or plain bytes if there are so many runs that packing doesn't pay. Each file
+records the full timelastmodified (as text) of the feature it was exported from, and is only used while that still
+matches.
+
+Build or refresh the store for an organism with :
+
+    python bin/build_sequences.py -s /path/to/store -o com:Pfalciparum [-d localhost:5432/pathogens?pathdb] [-r]
+
+"""
+
+import os
+import re
+import sys
+import time
+import struct
+import urllib
+import bisect
+import logging
+import optparse
+import threading
+
+try:
+    import mmap
+except ImportError:
+    # e.g. under Jython, where the files are read with seek and read instead
+    mmap = None
+
+logger = logging.getLogger("crawl")
+
+MAGIC = "CRAWLSEQ"
+
+PACKED = 0
+PLAIN = 1
+
+# magic, format, length of the sequence, number of exceptions, length of the version
+HEADER = "<8sBQIH"
+
+# the start and length of a run of bases that can't be packed, followed by the bases themselves
+EXCEPTION = "<II"
+
+BASES = "ACGT"
+
+# packing stops paying once the side table gets this big, relative to the sequence
+MAX_EXCEPTION_RATIO = 0.25
+
+_unpackable = re.compile("[^ACGT]+")
+_to_codes = "".join([str(max(BASES.find(chr(i)), 0)) for i in range(256)])
+
+# 4 base codes (e.g. "0123") -> a byte, and back again (e.g. "ACGT")
+_encode = {}
+_decode = []
+for _i in range(256):
+    _codes = "".join([str((_i >> shift) & 3) for shift in (6, 4, 2, 0)])
+    _encode[_codes] = chr(_i)
+    _decode.append("".join([BASES[int(code)] for code in _codes]))
+
+
+def pack(residues):
+    """
+        Returns the format, the exceptions (as (start, bases) tuples) and the data for some residues.
+    """
+    exceptions = [(match.start(), match.group()) for match in _unpackable.finditer(residues)]
+
+    if len(residues) > 0 and len(exceptions) * struct.calcsize(EXCEPTION) > len(residues) * MAX_EXCEPTION_RATIO:
+        return (PLAIN, [], residues)
+
+    codes = residues.translate(_to_codes)
+    if len(codes) % 4 > 0:
+        codes += "0" * (4 - len(codes) % 4)
+    data = "".join([_encode[codes[i:i + 4]] for i in xrange(0, len(codes), 4)])
+    return (PACKED, exceptions, data)
+
+
+def write(path, version, residues):
+    """
+        Writes some residues to a file, via a temporary one that is renamed into place, so that readers with the old
+        file open are unaffected.
+    """
+    (format, exceptions, data) = pack(residues)
+
+    temporary = "%s.%s.tmp" % (path, os.getpid())
+    out = open(temporary, "wb")
+    try:
+        out.write(struct.pack(HEADER, MAGIC, format, len(residues), len(exceptions), len(version)))
+        out.write(version)
+        for (start, bases) in exceptions:
+            out.write(struct.pack(EXCEPTION, start, len(bases)))
+            out.write(bases)
+        out.write(data)
+    finally:
+        out.close()
+    os.rename(temporary, path)
+
+
+class PackedSequence(object):
+    """
+        One region's file, opened for reading. Readers acquire it, and release it when they're done, so that when
+        the file is rebuilt the old one is only closed once nothing is reading it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        self.file = open(path, "rb")
+        self.lock = threading.Lock()
+
+        self.users = 0
+        self.retired = False
+        self.closed = False
+
+        header = self.file.read(struct.calcsize(HEADER))
+        (magic, self.format, self.length, exception_count, version_length) = struct.unpack(HEADER, header)
+        if magic != MAGIC:
+            self.file.close()
+            raise ValueError("%s is not a packed sequence file" % path)
+
+        self.version = self.file.read(version_length)
+
+        self.exception_starts = []
+        self.exception_bases = []
+        for i in range(exception_count):
+            (start, length) = struct.unpack(EXCEPTION, self.file.read(struct.calcsize(EXCEPTION)))
+            self.exception_starts.append(start)
+            self.exception_bases.append(self.file.read(length))
+
+        self.offset = self.file.tell()
+
+        self.map = None
+        if mmap is not None and os.path.getsize(path) > 0:
+            self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+
+    def read(self, start, end):
+        """
+            Returns the residues from start to end, counting from 0 and excluding the end, like a slice.
+        """
+        start = max(start, 0)
+        end = min(end, self.length)
+        if end <= start:
+            return ""
+
+        if self.format == PLAIN:
+            return self._read(self.offset + start, end - start)
+
+        first = start // 4
+        data = self._read(self.offset + first, (end + 3) // 4 - first)
+        residues = "".join([_decode[ord(byte)] for byte in data])[start - first * 4:end - first * 4]
+
+        # put back the runs that were packed as As
+        index = max(bisect.bisect_right(self.exception_starts, start) - 1, 0)
+        while index < len(self.exception_starts) and self.exception_starts[index] < end:
+            run_start = self.exception_starts[index]
+            bases = self.exception_bases[index]
+            index += 1
+
+            overlap_start = max(run_start, start)
+            overlap_end = min(run_start + len(bases), end)
+            if overlap_end <= overlap_start:
+                continue
+
+            residues = residues[:overlap_start - start] + bases[overlap_start - run_start:overlap_end - run_start] + residues[overlap_end - start:]
+
+        return residues
+
+    def _read(self, position, size):
+        if self.map is not None:
+            return self.map[position:position + size]
+
+        self.lock.acquire()
+        try:
+            self.file.seek(position)
+            return self.file.read(size)
+        finally:
+            self.lock.release()
+
+    def acquire(self):
+        self.lock.acquire()
+        try:
+            self.users += 1
+        finally:
+            self.lock.release()
+
+    def release(self):
+        self.lock.acquire()
+        try:
+            self.users -= 1
+            if self.retired and self.users == 0:
+                self._close()
+        finally:
+            self.lock.release()
+
+    def retire(self):
+        """
+            Closes the file as soon as nothing is reading it.
+        """
+        self.lock.acquire()
+        try:
+            self.retired = True
+            if self.users == 0:
+                self._close()
+        finally:
+            self.lock.release()
+
+    def _close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+
+class SequenceStore(object):
+    """
+        A directory of packed region files, opened on demand and kept open.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.opened = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def path(self, uniqueName):
+        return os.path.join(self.directory, urllib.quote(uniqueName, "") + ".seq")
+
+    def __contains__(self, uniqueName):
+        return uniqueName in self.opened or os.path.exists(self.path(uniqueName))
+
+    def get(self, uniqueName, version):
+        """
+            Returns the region's PackedSequence, acquired, or None if it's not in the store, or was exported before
+            the region's last modification. The version is the region's full timelastmodified, as text. The caller
+            must release it when done.
+        """
+        self.lock.acquire()
+        try:
+            packed = self.opened.get(uniqueName)
+
+            if packed is None or packed.version != version:
+                packed = self._open(uniqueName)
+
+            if packed is None:
+                self.misses += 1
+                return None
+
+            if packed.version != version:
+                self.stale += 1
+                return None
+
+            self.hits += 1
+            packed.acquire()
+            return packed
+        finally:
+            self.lock.release()
+
+    def _open(self, uniqueName):
+        # called with the lock held
+        path = self.path(uniqueName)
+        if not os.path.exists(path):
+            return None
+
+        packed = self.opened.get(uniqueName)
+
+        # only reopen if the file has been rebuilt since
+        if packed is not None and packed.mtime == os.stat(path).st_mtime:
+            return packed
+
+        try:
+            reopened = PackedSequence(path)
+        except Exception, e:
+            logger.error("could not open the packed sequence " + path)
+            logger.error(e)
+            return None
+
+        # the old one is closed once any threads still reading it are done
+        if packed is not None:
+            packed.retire()
+        self.opened[uniqueName] = reopened
+        return reopened
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            for packed in self.opened.values():
+                packed.retire()
+            self.opened = {}
+        finally:
+            self.lock.release()
+
+    def build(self, queries, organism_id, refresh = False):
+        """
+            Exports an organism's top level regions that are missing or out of date (or all of them, if refresh is
+            true). Returns the number of regions written and skipped.
+        """
+        written = 0
+        skipped = 0
+        for uniqueName in queries.getTopLevel(organism_id):
+            rows = queries.getRegionSequenceInfo(uniqueName)
+            if len(rows) == 0:
+                continue
+            version = rows[0]["timelastmodified"]
+
+            if not refresh:
+                packed = self.get(uniqueName, version)
+                if packed is not None:
+                    packed.release()
+                    skipped += 1
+                    continue
+
+            # the version is read first, so that a change in between leaves the file out of date rather than wrong
+            residues = queries.getRegionSequence(uniqueName)[0]["dna"]
+            if residues == "None":
+                continue
+
+            write(self.path(uniqueName), version, residues)
+            logger.info("wrote %s (%s bases)" % (uniqueName, len(residues)))
+            written += 1
+        return (written, skipped)
+
+    def stats(self):
+        return {
+            "directory" : self.directory,
+            "opened" : len(self.opened),
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "stale" : self.stale
+        }
+
+
+def main():
+    import cli
+    import db
+    import query
+    import controllers
+
+    parser = optparse.OptionParser()
+    parser.add_option("-s", "--store", dest="store", action="store", help="the directory of the sequence store")
+    parser.add_option("-o", "--organism", dest="organisms", action="append", help="an organism to export (as org:, tax: or com:), may be repeated")
+    parser.add_option("-d", "--database", dest="database", action="store", default=cli.DEFAULT_URL, help="the database, as host:5432/database?user")
+    parser.add_option("-r", "--refresh", dest="refresh", action="store_true", default=False, help="rewrite regions even if they are up to date")
+
+    (options, args) = parser.parse_args()
+    if options.store is None or options.organisms is None:
+        parser.print_help()
+        sys.exit(1)
+
+    logging.basicConfig(level = logging.INFO)
+
+    (host, port, database, user) = cli.parse_database_uri(options.database)
+    connectionFactory = query.ConnectionFactory(host, database, user, cli.get_password("CRAWL_PASSWORD"), port)
+    try:
+        queries = db.Queries(connectionFactory)
+        controller = controllers.BaseController(queries)
+        store = SequenceStore(options.store)
+
+        for organism in options.organisms:
+            began = time.time()
+            (written, skipped) = store.build(queries, controller.getOrganismID(organism), options.refresh)
+            print "%s : wrote %s regions, skipped %s up to date, in %.1fs" % (organism, written, skipped, time.time() - began)
+    finally:
+        connectionFactory.close()
+
+
+if __name__ == '__main__':
+    main()
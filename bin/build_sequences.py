@@ -0,0 +1,7 @@
+'''
+Builds or refreshes the packed sequence store, see api/sequences.py.
+'''
+
+if __name__ == '__main__':
+    from crawl.api.sequences import main
+    main()
\ No newline at end of file
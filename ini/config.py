@@ -4,7 +4,60 @@ crawl = {
         "database" : 'pathogens',
         "user" : 'pathdb',
         "password" : 'pathdb',
-        "port" : 5433
+        "port" : 5433,
+        "minconn" : 2,
+        "maxconn" : 20,
+        "timeout" : 30,
+        "max_idle" : 300,
+        "max_lifetime" : 3600,
+        "ping_after" : 60
+    },
+    "Queries" : {
+        "reload" : False
+    },
+    "Coalescing" : {
+        "enabled" : True,
+        "timeout" : 30
+    },
+    "Templates" : {
+        "reload" : False
+    },
+    "Vocabulary" : {
+        "refresh_frequency" : 3600
+    },
+    "Organisms" : {
+        "refresh_frequency" : 600,
+        "metadata_ttl" : 300
+    },
+    "FanOut" : {
+        "workers" : 4,
+        "timeout" : 30,
+        # connections out of Connection.maxconn that only the fan-out workers may lease, so that requests waiting 
+        # on them can't take them all (the workers never use more than one each)
+        "reserved" : 4
+    },
+    "Sequences" : {
+        "block_size" : 65536,
+        "cache_blocks" : 512,
+        "store" : None
+    },
+    "RegionIndex" : {
+        "enabled" : True,
+        "max_memory" : 268435456,
+        "ttl" : 60,
+        "max_features" : 500000
+    },
+    "Tiles" : {
+        "enabled" : True,
+        "tile_size" : 25000,
+        "capacity" : 1024,
+        "max_memory" : 134217728,
+        "ttl" : 300
+    },
+    "SlowQueries" : {
+        "threshold" : 1.0,
+        "sample_rate" : 1.0,
+        "capacity" : 100
     },
     "server.socket_port" : 7666,
     "server.socket_host" : '0.0.0.0',
@@ -12,17 +12,22 @@ except ImportError:
 import cherrypy
 from cherrypy.process import plugins
 
-from api.ropy import Root, handle_error, error_page_default, generate_mappings
-from api.query import ConnectionFactory
+from api.ropy import Root, RESTDispatcher, handle_error, error_page_default, generate_mappings
+from api.query import ConnectionPool, PooledConnectionFactory
 
 import api.controllers
+import api.db
+import api.query
+import api.sequences
 
 logger = logging.getLogger("crawl")
 
-# note, should these two listeners might be moved into the server module? the setup depends on cherrypy.config['Connection'], which may be considered to be an app specific setting.
-def setup_connection(thread_index):
+# the pool shared by all the server threads, see setup_pool()
+connection_pool = None
+
+def setup_pool():
     """
-        make one connection per thread at startup
+        make the connection pool shared by all the threads
     """
     # expecting to find a Connection in section in the config 
     connection_details = cherrypy.config['Connection'] # connection_details = cherrypy.config.app['Connection']
@@ -31,20 +36,55 @@ def setup_connection(thread_index):
     user = connection_details["user"]
     password = connection_details["password"]
     port = connection_details["port"]
+    
+    pool = ConnectionPool(host, database, user, password, port, 
+        minconn = connection_details.get("minconn", 1), 
+        maxconn = connection_details.get("maxconn", 20), 
+        timeout = connection_details.get("timeout", 30), 
+        max_idle = connection_details.get("max_idle", 300), 
+        max_lifetime = connection_details.get("max_lifetime", 3600), 
+        ping_after = connection_details.get("ping_after", 60))
+    pool.fill()
+    
+    logger.info ("setup connection pool " + str(pool))
+    return pool
 
-    cherrypy.thread_data.connectionFactory = ConnectionFactory(host, database, user, password, port)
+# note, should these two listeners might be moved into the server module? the setup depends on cherrypy.config['Connection'], which may be considered to be an app specific setting.
+def setup_connection(thread_index):
+    """
+        give each thread a factory that leases connections from the shared pool
+    """
+    cherrypy.thread_data.connectionFactory = PooledConnectionFactory(connection_pool)
     logger.debug ("setup connection in thread " + str(thread_index) + " ... is in thread_data? " + str(hasattr(cherrypy.thread_data, "connectionFactory")) )
 
 
 def close_connection(thread_index):
     """
-        close the connections when the server stops
+        hand back any leased connection when the thread stops
     """
-    logger.info ("attempting to close connection in thread " + str(thread_index))
+    logger.info ("attempting to release connection in thread " + str(thread_index))
     if hasattr(cherrypy.thread_data, "connectionFactory"):
-        cherrypy.thread_data.connectionFactory.close()
+        cherrypy.thread_data.connectionFactory.release()
     else:
-        logger.warn ("no connection factory to close in thread " + str(thread_index))
+        logger.warn ("no connection factory to release in thread " + str(thread_index))
+
+
+def cache_loader(name, load):
+    """
+        make a function that (re)loads a cache, on a connection leased just for the purpose
+    """
+    def loader():
+        connectionFactory = PooledConnectionFactory(connection_pool)
+        try:
+            try:
+                load(connectionFactory)
+            except Exception, e:
+                # lookups fall back on the database until it does load
+                logger.error("could not load the " + name)
+                logger.error(e)
+        finally:
+            connectionFactory.release()
+    return loader
 
 
 class StaticRoot(object):
@@ -62,6 +102,7 @@ def main():
     parser.add_option('-d', "--daemonize", dest='daemonize', action="store_true", help="run as daemon")
     parser.add_option('-p', '--pidfile', dest='pidfile', default=None, help="store the process id in the given file")
     parser.add_option('-t', '--test', dest='test', action="store_true", default=False, help="switch on testing controllers")
+    parser.add_option('-a', '--admin', dest='admin', action="store_true", default=False, help="switch on administration controllers")
     
     (options, args) = parser.parse_args()
     for option in ['config', 'logging']:
@@ -104,8 +145,11 @@ def main():
     if options.test == True:
         root.testing = api.controllers.Testing()
     
-    # we want to use a custom dispatcher that's configured to know about .json and .xml extensions
-    mapper = cherrypy.dispatch.RoutesDispatcher()
+    if options.admin == True:
+        root.admin = api.controllers.Admin()
+    
+    # we want to use a custom dispatcher that's configured to know about .json, .xml and .ndjson extensions
+    mapper = RESTDispatcher()
     generate_mappings(root, mapper)
     
     
@@ -142,6 +186,65 @@ def main():
     
     #logger.debug(os.path.join(current_dir, 'htm/'))
     
+    # only needs to be configured if the defaults aren't good enough
+    if "SlowQueries" in cherrypy.config:
+        api.query.slow_queries.configure(**cherrypy.config["SlowQueries"])
+    
+    # share the results of identical concurrent requests
+    api.ropy.single_flight.enabled = cherrypy.config.get("Coalescing", {}).get("enabled", True)
+    api.ropy.single_flight.timeout = cherrypy.config.get("Coalescing", {}).get("timeout", 30)
+    
+    # compile the XML templates once, rather than per request
+    api.ropy.load_templates(cherrypy.config.get("Templates", {}).get("reload", False))
+    
+    # load and validate the sql folder once, rather than per request
+    api.db.load_queries(cherrypy.config.get("Queries", {}).get("reload", False))
+    
+    # one pool for the whole server, with threads leasing connections from it per request
+    global connection_pool
+    connection_pool = setup_pool()
+    cherrypy.engine.subscribe('stop', connection_pool.close)
+    
+    # how long the organisms' properties are kept for
+    api.db.organism_metadata.ttl = cherrypy.config.get("Organisms", {}).get("metadata_ttl", 300)
+    
+    # how much of the source features' sequences is kept in memory
+    sequences_config = cherrypy.config.get("Sequences", {})
+    sequence_store = None
+    if sequences_config.get("store") is not None:
+        sequence_store = api.sequences.SequenceStore(sequences_config["store"])
+        cherrypy.engine.subscribe('stop', sequence_store.close)
+    api.db.sequences.configure(sequences_config.get("block_size", 65536), sequences_config.get("cache_blocks", 512), sequence_store)
+    
+    # index the feature locations of the regions being browsed, in the background
+    if "RegionIndex" in cherrypy.config:
+        api.db.region_locations.configure(**cherrypy.config["RegionIndex"])
+    api.db.region_locations.start(connection_pool)
+    cherrypy.engine.subscribe('stop', api.db.region_locations.close)
+    
+    # reuse the results of overlapping region queries
+    if "Tiles" in cherrypy.config:
+        api.db.region_tiles.configure(**cherrypy.config["Tiles"])
+    
+    # keep the cvterms and organisms in memory, and reload them every so often to pick up new ones
+    for (name, section, load, refresh_frequency) in (
+            ("vocabulary", "Vocabulary", api.db.load_vocabulary, 3600), 
+            ("organism directory", "Organisms", api.db.load_organisms, 600)):
+        loader = cache_loader(name, load)
+        loader()
+        plugins.Monitor(cherrypy.engine, loader, frequency = cherrypy.config.get(section, {}).get("refresh_frequency", refresh_frequency)).subscribe()
+    
+    # for running independent queries at the same time, on their own connections
+    fan_out_config = cherrypy.config.get("FanOut", {})
+    fan_out = api.db.setup_fan_out(connection_pool, fan_out_config.get("workers", 4), fan_out_config.get("timeout", 30), fan_out_config.get("reserved"))
+    cherrypy.engine.subscribe('stop', fan_out.close)
+    
+    # lets batches of calls run in parallel
+    root.batch_executor = api.controllers.run_concurrently
+    
+    # periodically close idle and worn out connections
+    plugins.Monitor(cherrypy.engine, connection_pool.reap, frequency = cherrypy.config['Connection'].get("reap_frequency", 60)).subscribe()
+    
     # assign these listeners to manage connections per thread
     cherrypy.engine.subscribe('start_thread', setup_connection)
     cherrypy.engine.subscribe('stop_thread', close_connection)
@@ -0,0 +1 @@
+SELECT cv.name as cv, cvterm.name as cvterm, cvterm.cvterm_id FROM cvterm JOIN cv ON cvterm.cv_id = cv.cv_id
\ No newline at end of file
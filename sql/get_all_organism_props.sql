@@ -1,8 +1,6 @@
-SELECT o.common_name, cv.name as vocubulary, cvterm.name as term, op.value 
+SELECT op.organism_id, o.common_name, cv.name as vocubulary, cvterm.name as term, op.value 
 FROM organismprop op
 JOIN organism o ON op.organism_id = o.organism_id
 JOIN cvterm ON op.type_id = cvterm_id
 JOIN cv ON cvterm.cv_id = cv.cv_id
-WHERE op.organism_id = %(organism_id)s
-
-
+ORDER BY op.organism_id, op.rank
\ No newline at end of file
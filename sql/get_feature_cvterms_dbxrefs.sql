@@ -0,0 +1,5 @@
+SELECT feature_cvterm_dbxref.feature_cvterm_id, dbxref.accession, db.name
+FROM feature_cvterm_dbxref
+JOIN dbxref ON feature_cvterm_dbxref.dbxref_id = dbxref.dbxref_id
+JOIN db ON dbxref.db_id = db.db_id
+WHERE feature_cvterm_dbxref.feature_cvterm_id IN %(feature_cvterm_ids)s
@@ -0,0 +1,9 @@
+SELECT feature_cvterm.feature_cvterm_id, pub.uniquename
+FROM feature_cvterm 
+JOIN pub on feature_cvterm.pub_id = pub.pub_id
+WHERE feature_cvterm.feature_cvterm_id IN %(feature_cvterm_ids)s
+UNION
+SELECT feature_cvterm_pub.feature_cvterm_id, pub.uniquename 
+FROM feature_cvterm_pub
+JOIN pub on feature_cvterm_pub.pub_id = pub.pub_id
+WHERE feature_cvterm_pub.feature_cvterm_id IN %(feature_cvterm_ids)s
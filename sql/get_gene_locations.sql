@@ -0,0 +1,10 @@
+SELECT 
+    src.uniquename as region, 
+    fl.fmin, 
+    fl.fmax, 
+    f.uniquename as feature
+FROM feature src 
+JOIN featureloc fl ON src.feature_id = fl.srcfeature_id
+JOIN feature f ON fl.feature_id = f.feature_id AND f.uniquename IN %(genes)s
+WHERE src.uniquename = %(region)s
+AND f.type_id IN (792, 423)
\ No newline at end of file
@@ -0,0 +1,48 @@
+WITH boundaries AS (
+    SELECT 
+        least(min(fl.fmin), %(start)s) as actual_start, 
+        greatest(max(fl.fmax), %(end)s) as actual_end
+    FROM feature f
+    JOIN featureloc fl ON (f.feature_id = fl.feature_id AND fl.srcfeature_id = %(regionid)s )
+    WHERE f.type_id in %(types)s 
+    AND (
+        (fl.fmin BETWEEN %(start)s AND %(end)s ) 
+        OR (fl.fmax BETWEEN %(start)s AND %(end)s ) 
+        OR ( fl.fmin <= %(start)s AND fl.fmax >= %(end)s ) 
+    )
+)
+
+SELECT
+	b.actual_start,
+	b.actual_end,
+	f.uniqueName as feature, 
+	type.name as type, 
+	fl.fmin as start, 
+	fl.fmax as end, 
+	fl.strand,
+	fl.phase,
+	f.is_obsolete,
+	f2.uniquename as part_of,
+	fl.is_fmin_partial,
+	fl.is_fmax_partial
+
+FROM boundaries b
+
+-- the boundaries always make one row, even if there are no features to join
+LEFT JOIN (
+    featureloc fl 
+    JOIN feature f ON f.feature_id = fl.feature_id 
+    JOIN cvterm type ON f.type_id = type.cvterm_id
+) ON (
+    fl.srcfeature_id = %(regionid)s 
+    AND (
+        (fl.fmin BETWEEN b.actual_start AND b.actual_end ) 
+        OR (fl.fmax BETWEEN b.actual_start AND b.actual_end ) 
+        OR ( fl.fmin <= b.actual_start AND fl.fmax >= b.actual_end ) 
+    )
+)
+
+LEFT OUTER JOIN feature_relationship fr ON f.feature_id = fr.subject_id AND fr.type_id = (select cvterm_id from cvterm where name = 'part_of')
+LEFT OUTER JOIN feature f2 ON fr.object_id = f2.feature_id
+
+ORDER BY fl.fmin, fl.fmax;
\ No newline at end of file
@@ -0,0 +1,4 @@
+select o.organism_id, o.common_name, op.value as taxonomyID
+from organism o
+
+left join (organismprop op join cvterm c on op.type_id = c.cvterm_id and c.name = 'taxonId') on o.organism_id = op.organism_id
\ No newline at end of file
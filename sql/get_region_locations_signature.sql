@@ -0,0 +1,7 @@
+SELECT 
+    count(*) as count, 
+    max(f.timelastmodified) as modified, 
+    sum(fl.fmin::bigint + fl.fmax) as checksum 
+FROM featureloc fl 
+JOIN feature f ON fl.feature_id = f.feature_id 
+WHERE fl.srcfeature_id = %(regionid)s
\ No newline at end of file
@@ -0,0 +1,43 @@
+WITH RECURSIVE relations (feature, direction, depth, parent_path, path, feature_id, relationship_type_id) AS (
+
+    SELECT target.uniquename, direction.name, 0, ARRAY[]::integer[], ARRAY[target.feature_id], target.feature_id, NULL::integer
+    FROM feature target
+    CROSS JOIN (VALUES ('parents'), ('children')) AS direction (name)
+    WHERE target.uniquename in %(features)s
+    
+    UNION ALL
+    
+    SELECT r.feature, r.direction, r.depth + 1, r.path, r.path || edge.to_id, edge.to_id, edge.type_id
+    FROM relations r
+    JOIN (
+        SELECT 'parents'::text as direction, subject_id as from_id, object_id as to_id, type_id FROM feature_relationship
+        UNION ALL
+        SELECT 'children'::text as direction, object_id as from_id, subject_id as to_id, type_id FROM feature_relationship
+    ) edge ON edge.direction = r.direction AND edge.from_id = r.feature_id
+    WHERE edge.type_id IN %(relationships)s
+    AND r.depth < %(max_depth)s
+    -- don't go round in circles
+    AND NOT edge.to_id = ANY(r.path)
+)
+
+SELECT 
+
+r.feature,
+r.direction,
+array_to_string(r.parent_path, ',') as parent_path,
+array_to_string(r.path, ',') as path,
+relation.uniquename as uniquename,
+relation.name as name,
+relationship_type.name as relationship_type,
+type.name as type
+
+FROM relations r
+
+JOIN feature relation ON r.feature_id = relation.feature_id
+JOIN cvterm relationship_type ON r.relationship_type_id = relationship_type.cvterm_id
+JOIN cvterm type ON relation.type_id = type.cvterm_id
+
+WHERE r.depth > 0
+
+-- parents before their children
+ORDER BY r.feature, r.direction, r.path
\ No newline at end of file
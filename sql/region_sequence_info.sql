@@ -0,0 +1 @@
+SELECT uniqueName, seqlen as length, organism_id, CAST(timelastmodified AS text) as timelastmodified FROM feature WHERE uniqueName = %s
\ No newline at end of file
@@ -0,0 +1 @@
+SELECT substr(residues, %(start)s, %(length)s) as dna FROM feature WHERE uniqueName = %(uniquename)s
\ No newline at end of file
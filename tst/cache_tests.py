@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+cache_tests.py
+
+Tests the in-memory caches and indexes against what the database would have answered.
+"""
+
+import random
+import unittest
+
+from crawl.api.cache import LRUCache, IntervalIndex, TileCache
+from crawl.api import db
+from crawl.api.db import RegionIndex, _location_coordinates, _location_identity
+
+
+def sql_overlaps(fmin, fmax, start, end):
+    """
+        The overlap predicate of the location queries, e.g. get_locations.sql.
+    """
+    return (start <= fmin <= end) or (start <= fmax <= end) or (fmin <= start and fmax >= end)
+
+
+def random_locations(count, length = 100000):
+    rows = []
+    for i in range(count):
+        fmin = random.randint(0, length)
+        fmax = fmin + random.choice([0, 1, random.randint(0, 500), random.randint(0, 20000)])
+        rows.append({
+            "feature" : "PF%04d" % i,
+            "type" : random.choice(["gene", "mRNA", "exon", "polypeptide"]),
+            "start" : str(fmin),
+            "end" : str(fmax),
+            "strand" : random.choice(["1", "-1", "None"]),
+            "phase" : random.choice(["0", "1", "2", "None"]),
+            "is_obsolete" : "False",
+            "part_of" : random.choice(["None", "PF0001", "PF0002"]),
+            "is_fmin_partial" : random.choice(["True", "False"]),
+            "is_fmax_partial" : "False",
+            "feature_id" : str(i),
+            "type_id" : random.choice(["792", "321", "234"])
+        })
+    rows.sort(key = lambda row: (int(row["start"]), int(row["end"])))
+    return rows
+
+
+class IntervalIndexTest(unittest.TestCase):
+
+    def check(self, starts, ends, windows):
+        index = IntervalIndex(starts, ends)
+        self.assertEqual(len(index), len(starts))
+        for (start, end) in windows:
+            expected = [i for i in range(len(starts)) if sql_overlaps(starts[i], ends[i], start, end)]
+            self.assertEqual(sorted(index.overlapping(start, end)), expected, (start, end))
+
+    def testAgainstTheSQLPredicate(self):
+        starts = []
+        ends = []
+        for i in range(2000):
+            start = random.randint(0, 100000)
+            starts.append(start)
+            ends.append(start + random.choice([0, random.randint(0, 100), random.randint(0, 50000)]))
+        windows = [(0, 0), (100000, 200000), (-10, -1), (0, 150000)]
+        for i in range(300):
+            start = random.randint(-1000, 110000)
+            windows.append((start, start + random.choice([0, random.randint(0, 1000), random.randint(0, 30000)])))
+        self.check(starts, ends, windows)
+
+    def testNestedAndIdenticalIntervals(self):
+        starts = [0, 0, 10, 10, 20, 30, 30, 5]
+        ends = [100, 100, 90, 20, 20, 40, 35, 5]
+        windows = [(start, end) for start in range(-1, 102, 3) for end in range(start, 102, 7)]
+        self.check(starts, ends, windows)
+
+    def testEmpty(self):
+        self.assertEqual(IntervalIndex([], []).overlapping(0, 100), [])
+
+
+class RegionIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = random_locations(1000)
+        self.region_index = RegionIndex((len(self.rows), "2011-03-04", 0), iter(self.rows))
+
+    def overlapping(self, start, end):
+        return [row for row in self.rows if sql_overlaps(int(row["start"]), int(row["end"]), start, end)]
+
+    def testLocationsAreTheSQLRows(self):
+        for i in range(100):
+            start = random.randint(0, 100000)
+            end = start + random.randint(0, 20000)
+            expected = []
+            for row in self.overlapping(start, end):
+                if row["type"] not in ("exon", "mRNA"):
+                    location = dict(row)
+                    del location["feature_id"]
+                    del location["type_id"]
+                    expected.append(location)
+            self.assertEqual(self.region_index.getLocations(start, end, ["exon", "mRNA", "unknown"]), expected)
+
+    def testBoundariesAndFeatureIDs(self):
+        for i in range(100):
+            start = random.randint(0, 100000)
+            end = start + random.randint(0, 20000)
+            rows = self.overlapping(start, end)
+
+            genes = [row for row in rows if row["type_id"] in ("792", "234")]
+            if len(genes) == 0:
+                expected = (None, None)
+            else:
+                expected = (min([int(row["start"]) for row in genes]), max([int(row["end"]) for row in genes]))
+            self.assertEqual(self.region_index.getBoundaries(start, end, [792, 234, 1]), expected)
+
+            self.assertEqual(self.region_index.getFeatureIDs(start, end), [int(row["feature_id"]) for row in rows])
+
+    def testTooBigToIndex(self):
+        region_index = RegionIndex((1000000, "2011-03-04", 0))
+        self.assertEqual(region_index.index, None)
+        self.assertEqual(region_index.size, 0)
+
+
+class TileCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = random_locations(1000)
+        self.tiles = TileCache(tile_size = 5000, capacity = 1000, ttl = 300)
+        self.computed = []
+
+    def compute(self, start, end):
+        self.computed.append((start, end))
+        return [row for row in self.rows if sql_overlaps(int(row["start"]), int(row["end"]), start, end)]
+
+    def get(self, start, end, version = None):
+        return self.tiles.get("locations", version, start, end, self.compute, _location_coordinates, _location_identity)
+
+    def testSameRowsAsOneQuery(self):
+        for i in range(200):
+            start = random.randint(0, 100000)
+            end = start + random.choice([0, random.randint(0, 3000), random.randint(0, 30000)])
+            expected = [row for row in self.rows if sql_overlaps(int(row["start"]), int(row["end"]), start, end)]
+            self.assertEqual(self.get(start, end), expected, (start, end))
+
+    def testRowsSpanningTilesAreOnlyReturnedOnce(self):
+        self.rows = [
+            { "feature" : "long", "start" : "100", "end" : "22000", "part_of" : "None" },
+            { "feature" : "edge", "start" : "4999", "end" : "5000", "part_of" : "None" },
+            { "feature" : "inside", "start" : "6000", "end" : "7000", "part_of" : "long" }
+        ]
+        self.assertEqual([row["feature"] for row in self.get(0, 24999)], ["long", "edge", "inside"])
+        self.assertEqual(self.computed, [(0, 4999), (5000, 9999), (10000, 14999), (15000, 19999), (20000, 24999)])
+
+    def testTrimmedToTheWindow(self):
+        self.rows = [
+            { "feature" : "before", "start" : "100", "end" : "199", "part_of" : "None" },
+            { "feature" : "touching", "start" : "150", "end" : "200", "part_of" : "None" },
+            { "feature" : "after", "start" : "301", "end" : "400", "part_of" : "None" }
+        ]
+        self.assertEqual([row["feature"] for row in self.get(200, 300)], ["touching"])
+
+    def testTilesAreReusedPerVersion(self):
+        self.get(1000, 12000)
+        self.assertEqual(len(self.computed), 3)
+        self.get(6000, 14000)
+        self.assertEqual(len(self.computed), 3)
+        self.assertEqual(self.tiles.stats()["hits"], 2)
+
+        # a new version of the region doesn't see the old tiles
+        self.get(6000, 14000, version = 2)
+        self.assertEqual(len(self.computed), 5)
+
+    def testMemoryIsBounded(self):
+        self.get(0, 100000)
+        memory = self.tiles.stats()["memory"]
+        self.assert_(memory > 0)
+
+        self.tiles.configure(tile_size = 5000, capacity = 1000, ttl = 300, max_memory = memory / 4)
+        self.get(0, 100000)
+        self.assert_(self.tiles.stats()["memory"] <= memory / 4)
+        self.assert_(self.tiles.stats()["evictions"] > 0)
+
+    def testStaleTilesAreRecomputed(self):
+        self.tiles.ttl = 0
+        self.get(0, 100)
+        self.get(0, 100)
+        self.assertEqual(len(self.computed), 2)
+
+
+class CountingQueries(db.Queries):
+    """
+        Answers the location queries from some rows, as the database would, counting the round trips.
+    """
+    def __init__(self, rows):
+        self.rows = rows
+        self.round_trips = []
+
+    def overlapping(self, start, end, exclude = ()):
+        results = []
+        for row in self.rows:
+            if sql_overlaps(int(row["start"]), int(row["end"]), int(start), int(end)) and row["type"] not in exclude:
+                location = dict(row)
+                del location["feature_id"]
+                del location["type_id"]
+                results.append(location)
+        return results
+
+    def runQueryAndMakeDictionary(self, queryName, args = None):
+        self.round_trips.append(queryName)
+        if queryName in ("get_locations", "get_locations_excluding"):
+            return self.overlapping(args["start"], args["end"], args.get("exclude", ()))
+        if queryName in ("get_locations_expanded", "get_locations_expanded_excluding"):
+            types = [str(type) for type in args["types"]]
+            genes = [row for row in self.rows if row["type_id"] in types and sql_overlaps(int(row["start"]), int(row["end"]), args["start"], args["end"])]
+            actual_start = min([args["start"]] + [int(row["start"]) for row in genes])
+            actual_end = max([args["end"]] + [int(row["end"]) for row in genes])
+            rows = self.overlapping(actual_start, actual_end, args.get("exclude", ()))
+            if len(rows) == 0:
+                rows = [{ "feature" : "None" }]
+            for row in rows:
+                row["actual_start"] = str(actual_start)
+                row["actual_end"] = str(actual_end)
+            return rows
+        raise Exception("unexpected query " + queryName)
+
+
+class ExpandedLocationsTest(unittest.TestCase):
+    """
+        With the default configuration (tiles on), for a region that isn't indexed.
+    """
+
+    def setUp(self):
+        self.rows = random_locations(1000)
+        self.queries = CountingQueries(self.rows)
+
+        db.region_tiles.configure()
+        db.region_locations.configure()
+        db.region_locations.start(object())
+
+        # too big to index, but with a known signature, like a big chromosome
+        db.region_locations.indexes.put("5", RegionIndex((1000000, "2011-03-04", 0)))
+
+    def tearDown(self):
+        db.region_locations.configure()
+        db.region_locations.start(None)
+        db.region_tiles.configure()
+
+    def testOneRoundTripAndTheTilesAreFilled(self):
+        (actual_start, actual_end, locations) = self.queries.getFeatureLocationsExpanded(5, 30000, 80000, [792], ["exon"])
+        self.assertEqual(self.queries.round_trips, ["get_locations_expanded_excluding"])
+        self.assertEqual(locations, self.queries.overlapping(actual_start, actual_end, ["exon"]))
+
+        # the tiles wholly within the widened window need no more round trips
+        tile_size = db.region_tiles.tile_size
+        first = (actual_start + tile_size - 1) // tile_size * tile_size
+        last = (actual_end + 1) // tile_size * tile_size - 1
+        self.assert_(first < last)
+        self.assertEqual(self.queries.getFeatureLocations(5, first, last, ["exon"]), self.queries.overlapping(first, last, ["exon"]))
+        self.assertEqual(len(self.queries.round_trips), 1)
+
+        # while the tiles around it still have to be fetched
+        self.queries.getFeatureLocations(5, first, last + 1, ["exon"])
+        self.assertEqual(self.queries.round_trips[1:], ["get_locations_excluding"])
+
+    def testOneRoundTripPerRequest(self):
+        for i in range(20):
+            start = random.randint(0, 100000)
+            self.queries.getFeatureLocationsExpanded(5, start, start + 5000, [792, 234], [])
+        self.assertEqual(self.queries.round_trips, ["get_locations_expanded"] * 20)
+
+    def testOneRoundTripWithoutAVersion(self):
+        db.region_locations.indexes.clear()
+        db.region_locations.start(None)
+        self.queries.getFeatureLocationsExpanded(5, 40000, 42000, [792], [])
+        self.assertEqual(self.queries.round_trips, ["get_locations_expanded"])
+        self.assertEqual(db.region_tiles.stats()["size"], 0)
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def testLeastRecentlyUsedIsEvicted(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+
+    def testWeightIsBounded(self):
+        cache = LRUCache(10, 100, len)
+        self.assert_(cache.put("a", "x" * 60))
+        self.assert_(cache.put("b", "x" * 30))
+        self.assert_(cache.put("c", "x" * 30))
+        self.failIf("a" in cache)
+        self.assertEqual(cache.weight, 60)
+
+        # too heavy on its own
+        self.failIf(cache.put("d", "x" * 101))
+        self.assertEqual(cache.weight, 60)
+
+        cache.put("b", "x" * 5)
+        self.assertEqual(cache.weight, 35)
+        cache.remove("c")
+        self.assertEqual(cache.weight, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
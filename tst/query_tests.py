@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+query_tests.py
+
+Tests the rewriting of named queries into server-side prepared statements, and the fallback to plain SQL when a
+statement can't be prepared. Needs no database, the cursors are fakes that record what they are asked to run.
+"""
+
+import unittest
+
+from crawl.api.query import NamedQuery, QueryProcessor, QueryProcessorException, ConnectionPool, PooledConnection
+
+
+# a syntax error, and a lock timeout
+SYNTAX_ERROR = "42601"
+LOCK_NOT_AVAILABLE = "55P03"
+
+
+class DatabaseError(Exception):
+    """
+        Like a psycopg2 error, with the SQLSTATE in pgcode.
+    """
+    def __init__(self, message, pgcode):
+        Exception.__init__(self, message)
+        self.pgcode = pgcode
+
+
+class RecordingCursor(object):
+    """
+        Records the statements it's given, and fails any PREPARE with the given SQLSTATE, if told to.
+    """
+    def __init__(self, fail_prepare = None):
+        self.fail_prepare = fail_prepare
+        self.executed = []
+
+    def execute(self, sql, args = None):
+        self.executed.append((sql, args))
+        if self.fail_prepare is not None and "PREPARE " in sql and not "ROLLBACK" in sql:
+            raise DatabaseError("could not prepare", self.fail_prepare)
+
+
+class StatementCachingFactory(object):
+    def __init__(self):
+        self.statements = {}
+
+    def getStatementCache(self):
+        return self.statements
+
+
+class NamedQueryTest(unittest.TestCase):
+
+    def testInBecomesAny(self):
+        query = NamedQuery("locs", "SELECT * FROM featureloc WHERE srcfeature_id = %(regionid)s AND feature_id IN %(features)s;")
+        self.assertEqual(query.prepare_sql, "PREPARE crawl_locs AS SELECT * FROM featureloc WHERE srcfeature_id = $1 AND feature_id = ANY($2)")
+        self.assertEqual(query.execute_sql, "EXECUTE crawl_locs (%s, %s)")
+        self.assertEqual(query.array_parameters, { 1 : True })
+
+    def testNotInBecomesAll(self):
+        query = NamedQuery("types", "SELECT * FROM cvterm WHERE name not in %(exclude)s")
+        self.assertEqual(query.prepare_sql, "PREPARE crawl_types AS SELECT * FROM cvterm WHERE name <> ALL($1)")
+
+    def testRepeatedParameterKeepsItsPosition(self):
+        query = NamedQuery("window", "SELECT 1 WHERE %(start)s < %(end)s AND %(start)s > 0")
+        self.assertEqual(query.parameters, ("start", "end"))
+        self.assertEqual(query.prepare_sql, "PREPARE crawl_window AS SELECT 1 WHERE $1 < $2 AND $1 > 0")
+        self.assertEqual(query.execute_sql, "EXECUTE crawl_window (%s, %s)")
+
+    def testEscapedPercent(self):
+        query = NamedQuery("like", "SELECT * FROM feature WHERE uniquename LIKE 'PF%%' AND organism_id = %(organism)s")
+        self.assertEqual(query.prepare_sql, "PREPARE crawl_like AS SELECT * FROM feature WHERE uniquename LIKE 'PF%' AND organism_id = $1")
+
+    def testPositional(self):
+        query = NamedQuery("positional", "SELECT * FROM feature WHERE feature_id IN %s AND type_id = %s")
+        self.assertEqual(query.prepare_sql, "PREPARE crawl_positional AS SELECT * FROM feature WHERE feature_id = ANY($1) AND type_id = $2")
+        self.assertEqual(query.execute_args([(1, 2), 3]), ['{"1","2"}', 3])
+
+    def testNoParameters(self):
+        query = NamedQuery("all", "SELECT * FROM organism")
+        self.assertEqual(query.execute_sql, "EXECUTE crawl_all")
+        self.assertEqual(query.execute_args({}), None)
+
+    def testArraysAreQuotedAndEscaped(self):
+        query = NamedQuery("names", "SELECT * FROM feature WHERE uniquename IN %(names)s AND type_id = %(type)s")
+        args = query.execute_args({ "type" : 792, "names" : ('a"b', "c\\d", None) })
+        self.assertEqual(args, ['{"a\\"b","c\\\\d",NULL}', 792])
+
+    def testMixedPlaceholdersAreRejected(self):
+        self.assertRaises(Exception, NamedQuery, "mixed", "SELECT %s, %(named)s")
+
+
+class PrepareFallbackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = StatementCachingFactory()
+        self.processor = QueryProcessor(connection=self.factory)
+
+    def testPreparedThenExecuted(self):
+        query = NamedQuery("locs", "SELECT * FROM featureloc WHERE feature_id IN %(features)s")
+        cursor = RecordingCursor()
+
+        self.processor._prepare(cursor, query, self.factory.statements)
+
+        self.assertEqual(cursor.executed, [("SAVEPOINT crawl_prepare; " + query.prepare_sql + "; RELEASE SAVEPOINT crawl_prepare", None)])
+        self.assert_(self.factory.statements["locs"] is query)
+        self.assert_(query.preparable)
+
+    def testFailedPrepareRollsBackToTheSavepoint(self):
+        query = NamedQuery("broken", "SELECT * FROM featureloc WHERE feature_id IN %(features)s")
+        cursor = RecordingCursor(fail_prepare = SYNTAX_ERROR)
+
+        self.processor._prepare(cursor, query, self.factory.statements)
+
+        self.assertEqual(cursor.executed[-1], ("ROLLBACK TO SAVEPOINT crawl_prepare; RELEASE SAVEPOINT crawl_prepare", None))
+        self.assertEqual(self.factory.statements["broken"], None)
+        self.failIf(query.preparable)
+
+    def testTransientFailureOnlyAffectsItsConnection(self):
+        query = NamedQuery("locked", "SELECT * FROM featureloc WHERE feature_id IN %(features)s")
+        self.processor._getNamedQuery = lambda queryName: query
+
+        cursor = RecordingCursor(fail_prepare = LOCK_NOT_AVAILABLE)
+        self.processor._execute(cursor, "locked", { "features" : (1, 2) })
+        self.assertEqual(cursor.executed[-1], (query.sql, { "features" : (1, 2) }))
+        self.assertEqual(self.factory.statements["locked"], None)
+        self.assert_(query.preparable)
+
+        # not tried again on the same connection
+        cursor = RecordingCursor()
+        self.processor._execute(cursor, "locked", { "features" : (1, 2) })
+        self.assertEqual(cursor.executed, [(query.sql, { "features" : (1, 2) })])
+
+        # but still prepared on another
+        other = QueryProcessor(connection=StatementCachingFactory())
+        other._getNamedQuery = lambda queryName: query
+        cursor = RecordingCursor()
+        other._execute(cursor, "locked", { "features" : (1, 2) })
+        self.assertEqual(cursor.executed[-1], ("EXECUTE crawl_locked (%s)", ['{"1","2"}']))
+
+    def testReloadedQueryIsDeallocatedFirst(self):
+        old = NamedQuery("locs", "SELECT 1")
+        new = NamedQuery("locs", "SELECT 2")
+        self.factory.statements["locs"] = old
+        cursor = RecordingCursor()
+
+        self.processor._prepare(cursor, new, self.factory.statements)
+
+        self.assertEqual(cursor.executed[0][0], "SAVEPOINT crawl_prepare; DEALLOCATE crawl_locs; PREPARE crawl_locs AS SELECT 2; RELEASE SAVEPOINT crawl_prepare")
+        self.assert_(self.factory.statements["locs"] is new)
+
+    def testFailedQueryIsSentAsPlainSQL(self):
+        query = NamedQuery("broken", "SELECT * FROM featureloc WHERE feature_id IN %(features)s")
+        self.processor._getNamedQuery = lambda queryName: query
+
+        cursor = RecordingCursor(fail_prepare = SYNTAX_ERROR)
+        self.processor._execute(cursor, "broken", { "features" : (1, 2) })
+        self.assertEqual(cursor.executed[-1], (query.sql, { "features" : (1, 2) }))
+
+        # and isn't tried again, on any connection
+        self.processor.connectionFactory = StatementCachingFactory()
+        cursor = RecordingCursor()
+        self.processor._execute(cursor, "broken", { "features" : (1, 2) })
+        self.assertEqual(cursor.executed, [(query.sql, { "features" : (1, 2) })])
+
+    def testPreparedQueryIsExecutedWithArrays(self):
+        query = NamedQuery("locs", "SELECT * FROM featureloc WHERE srcfeature_id = %(regionid)s AND feature_id IN %(features)s")
+        self.processor._getNamedQuery = lambda queryName: query
+
+        cursor = RecordingCursor()
+        self.processor._execute(cursor, "locs", { "features" : [1, 2], "regionid" : 5 })
+        self.assertEqual(cursor.executed[-1], ("EXECUTE crawl_locs (%s, %s)", [5, '{"1","2"}']))
+
+
+class FakeConnection(object):
+    closed = 0
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeConnectionPool(ConnectionPool):
+    def _connect(self):
+        return PooledConnection(FakeConnection())
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = FakeConnectionPool("localhost", "pathogens", "pathdb", "", maxconn = 3, timeout = 0.1)
+        self.pool.reserve(1)
+
+    def testReservedConnectionsAreKeptFromTheOthers(self):
+        leased = [self.pool.checkout(), self.pool.checkout()]
+        self.assertRaises(QueryProcessorException, self.pool.checkout)
+
+        leased.append(self.pool.checkout(reserved = True))
+        self.assertRaises(QueryProcessorException, self.pool.checkout, reserved = True)
+
+        # an unreserved connection coming free can be leased by either
+        self.pool.checkin(leased.pop(0))
+        leased.append(self.pool.checkout(reserved = True))
+        self.assertEqual(self.pool.stats()["reserved_in_use"], 2)
+
+        for pooled in leased:
+            self.pool.checkin(pooled)
+        stats = self.pool.stats()
+        self.assertEqual((stats["in_use"], stats["reserved_in_use"], stats["idle"]), (0, 0, 3))
+        self.pool.checkout()
+
+    def testSomethingMustBeLeftUnreserved(self):
+        self.assertRaises(QueryProcessorException, self.pool.reserve, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+sequences_tests.py
+
+Tests that residues written to the packed sequence store read back unchanged, whatever they contain, and that the
+store only serves files exported from the current version of a region.
+"""
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from crawl.api.sequences import pack, write, PackedSequence, SequenceStore, PACKED, PLAIN
+
+
+class PackedSequenceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "region.seq")
+        self.opened = []
+
+    def tearDown(self):
+        for packed in self.opened:
+            packed.retire()
+        shutil.rmtree(self.directory)
+
+    def roundTrip(self, residues, version = "2011-03-04 12:34:56.789012"):
+        write(self.path, version, residues)
+        packed = PackedSequence(self.path)
+        self.opened.append(packed)
+        self.assertEqual(packed.version, version)
+        self.assertEqual(packed.length, len(residues))
+        self.assertEqual(packed.read(0, len(residues)), residues)
+
+        # every slice between points near the ends and the edges of the unpackable runs, and some random ones
+        edges = [0, 1, 2, 3, 4, 5, len(residues) - 5, len(residues) - 1, len(residues)]
+        for i in range(1, len(residues)):
+            if (residues[i] in "ACGT") != (residues[i - 1] in "ACGT"):
+                edges.extend([i - 1, i, i + 1])
+        edges = [edge for edge in edges if 0 <= edge <= len(residues)]
+        for start in edges:
+            for end in edges:
+                self.assertEqual(packed.read(start, end), residues[start:end], (start, end))
+        for i in range(200):
+            start = random.randint(0, len(residues))
+            end = random.randint(start, len(residues))
+            self.assertEqual(packed.read(start, end), residues[start:end], (start, end))
+        return packed
+
+    def testPlainBases(self):
+        packed = self.roundTrip("".join([random.choice("ACGT") for i in range(1001)]))
+        self.assertEqual(packed.format, PACKED)
+        self.assertEqual(packed.exception_starts, [])
+
+    def testRunsOfNAndLowerCase(self):
+        residues = "NNNN" + "".join([random.choice("ACGT") for i in range(500)]) + "acgtnnn" + "ACGT" * 50 + "NNNNNNNNNN" + "RYK" + "ACG"
+        packed = self.roundTrip(residues)
+        self.assertEqual(packed.format, PACKED)
+        self.assertEqual(len(packed.exception_starts), 3)
+
+    def testTooManyRunsToPack(self):
+        residues = "".join([random.choice("ACGTNacgt") for i in range(1000)])
+        self.assertEqual(pack(residues)[0], PLAIN)
+        self.assertEqual(self.roundTrip(residues).format, PLAIN)
+
+    def testShortAndEmpty(self):
+        for residues in ["", "A", "N", "ACG", "ACGTA", "n"]:
+            self.roundTrip(residues)
+
+    def testOutOfRangeReads(self):
+        packed = self.roundTrip("ACGTNNACGT")
+        self.assertEqual(packed.read(-5, 3), "ACG")
+        self.assertEqual(packed.read(8, 100), "GT")
+        self.assertEqual(packed.read(6, 2), "")
+
+
+class SequenceStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = SequenceStore(self.directory)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def testOnlyTheCurrentVersionIsServed(self):
+        write(self.store.path("Pf3D7_01"), "2011-03-04 12:34:56.789012", "ACGTNNNN")
+
+        packed = self.store.get("Pf3D7_01", "2011-03-04 12:34:56.789012")
+        self.assertEqual(packed.read(0, 8), "ACGTNNNN")
+        packed.release()
+
+        # modified later on the same day
+        self.assertEqual(self.store.get("Pf3D7_01", "2011-03-04 18:00:00.000001"), None)
+        self.assertEqual(self.store.get("Pf3D7_02", "2011-03-04 12:34:56.789012"), None)
+
+    def testRebuiltFileIsReopenedAndTheOldOneClosedWhenReleased(self):
+        path = self.store.path("Pf3D7_01")
+        write(path, "1", "AAAA")
+        old = self.store.get("Pf3D7_01", "1")
+
+        write(path, "2", "CCCC")
+        os.utime(path, (old.mtime + 10, old.mtime + 10))
+        new = self.store.get("Pf3D7_01", "2")
+        self.assertEqual(new.read(0, 4), "CCCC")
+
+        # still being read, so not closed yet
+        self.failIf(old.closed)
+        self.assertEqual(old.read(0, 4), "AAAA")
+        old.release()
+        self.assert_(old.closed)
+
+        new.release()
+        self.failIf(new.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
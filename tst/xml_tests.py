@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+xml_tests.py
+
+Tests that the generic XML, now written out incrementally, is the same document xml.dom.minidom used to make.
+"""
+
+import types
+import unittest
+import xml.dom.minidom
+
+from crawl.api.ropy import Formatter
+
+
+def minidom_xml(data):
+    """
+        The generic XML as it was made before, by building a minidom tree.
+    """
+    document = xml.dom.minidom.getDOMImplementation().createDocument(None, None, None)
+
+    root = document.createElement("response")
+    root.attributes["name"] = data["response"]["name"]
+    document.childNodes.append(root)
+
+    results = document.createElement("results")
+    root.childNodes.append(results)
+
+    formatter = Formatter({})
+    def parse(node, data, node_name, attribute = False):
+        if type(data) is types.ListType or type(data) is types.GeneratorType:
+            sub = document.createElement(node_name)
+            node.childNodes.append(sub)
+            for val in data:
+                parse(sub, val, formatter._singularize(node_name))
+        elif type(data) is types.DictType:
+            sub = document.createElement(node_name)
+            node.childNodes.append(sub)
+            for key, val in data.items():
+                parse(sub, val, key, True)
+        elif attribute is True:
+            node.attributes[node_name] = str(data)
+        else:
+            sub = document.createElement(node_name)
+            node.childNodes.append(sub)
+            sub.childNodes.append(document.createTextNode(str(data)))
+
+    for k, v in data["response"].items():
+        if k != "name":
+            parse(results, v, k)
+
+    return document.toxml()
+
+
+def features():
+    yield { "uniqueName" : "PFA0170c", "start" : 123, "end" : 456 }
+    yield { "uniqueName" : "PFA0315w", "start" : 789, "end" : 1011 }
+
+
+class XMLTest(unittest.TestCase):
+
+    def assertSameXML(self, make_data):
+        # the data is made twice, as any generators in it can only be consumed once
+        expected = minidom_xml(make_data())
+        chunks = list(Formatter(make_data()).iterXML())
+        self.assertEqual("".join(chunks), expected)
+        self.assertEqual(Formatter(make_data()).formatXML(), expected)
+
+    def testEmptyResponse(self):
+        self.assertSameXML(lambda: { "response" : { "name" : "genes/list" } })
+
+    def testNestedResults(self):
+        self.assertSameXML(lambda: { "response" : {
+            "name" : "regions/locations",
+            "region" : "Pf3D7_01",
+            "start" : 1,
+            "features" : [
+                { "uniqueName" : "PFA0170c", "type" : "gene", "fmin" : 100, "parts" : [ { "uniqueName" : "PFA0170c:mRNA" } ] },
+                { "uniqueName" : "PFA0315w", "type" : "gene", "children" : [], "properties" : { "colour" : 3 } }
+            ],
+            "children" : [ "a", "b" ],
+            "misc" : [ 1, 2 ],
+            "empty" : []
+        } })
+
+    def testEscaping(self):
+        self.assertSameXML(lambda: { "response" : {
+            "name" : "search \"<&>\"",
+            "terms" : [ { "name" : "a < b & \"c\" > d" } ],
+            "text" : "x < y & z > 'w'"
+        } })
+
+    def testGenerators(self):
+        self.assertSameXML(lambda: { "response" : { "name" : "features/stream", "features" : features() } })
+        self.assertSameXML(lambda: { "response" : { "name" : "features/stream", "features" : (feature for feature in []) } })
+
+
+if __name__ == '__main__':
+    unittest.main()